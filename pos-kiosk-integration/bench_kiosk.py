@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+"""
+Load generator and latency benchmark for the MobyPay Kiosk protocol
+Simulates POS terminals against a local TcpSender on 127.0.0.1
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import random
+import socket
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import kiosk
+from kiosk import AsyncTcpSender, SecurityHelper, TcpSender, TerminalRouter, Transaction, TransactionState
+
+# Outcomes a simulated terminal can produce for one payment
+OUTCOMES = ("success", "failed", "error", "ipp")
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """Parse 'success=80,failed=10,error=5,ipp=5' into normalised weights"""
+    weights = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OUTCOMES:
+            raise argparse.ArgumentTypeError(f"unknown outcome '{name}' (expected one of {', '.join(OUTCOMES)})")
+        weights[name] = float(weight or 1)
+    total = sum(weights.values())
+    if total <= 0:
+        raise argparse.ArgumentTypeError("mix weights must add up to more than zero")
+    return {name: weight / total for name, weight in weights.items()}
+
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def latency_summary(samples: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p95/p99/max/mean in milliseconds"""
+    values = sorted(samples)
+    summary = {f"p{p}": percentile(values, p) for p in (50, 95, 99)}
+    summary["max"] = values[-1] if values else None
+    summary["mean"] = sum(values) / len(values) if values else None
+    return {key: round(value * 1000, 3) if value is not None else None for key, value in summary.items()}
+
+
+class SimulatedTerminal:
+    """A POS terminal that answers every request according to the outcome mix
+
+    A terminal given a codec other than json offers it in its hello frame and
+    switches to it once the Kiosk's hello_ack confirms it.
+    """
+
+    def __init__(self, terminal_id: str, port: int, mix: Dict[str, float], padding: str, seed: int,
+                 codec: str = "json"):
+        self.terminal_id = terminal_id
+        self.port = port
+        self.padding = padding
+        self.offer = codec
+        self.codec: kiosk.WireCodec = kiosk.JSON_CODEC
+        # IPP is chosen by the driver through payment_mode, not by the terminal
+        self.outcomes = [name for name in mix if name != "ipp"] or ["success"]
+        self.weights = [mix.get(name, 1) for name in self.outcomes]
+        self.rng = random.Random(seed)
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def _result(self, txn_id: str, **fields) -> bytes:
+        data = {"type": "transaction_result", "txn_id": txn_id, **fields}
+        if self.padding:
+            data["receipt"] = self.padding
+        return self._frame(data)
+
+    def _frame(self, data: Dict[str, Any]) -> bytes:
+        """Sign data the way a POS terminal does and encode it with the current codec"""
+        return self.codec.encode(SecurityHelper.create_secure_message(data))
+
+    async def run(self, ready: asyncio.Event, connected: List[str], expected: int):
+        reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port, limit=4 * 1024 * 1024)
+        hello = {"type": "hello", "terminal_id": self.terminal_id}
+        if self.offer != "json":
+            hello["codecs"] = [self.offer]
+        self.writer.write(self._frame(hello))
+
+        if self.offer != "json":
+            # Nothing is sent until hello_ack; frames after it use the agreed codec
+            while True:
+                payload = self.codec.decode(await reader.readline())["payload"]
+                if payload.get("type") == "hello_ack":
+                    self.codec = kiosk.CODECS[payload["codec"]]
+                    break
+                self._respond(payload)
+
+        connected.append(self.terminal_id)
+        if len(connected) >= expected:
+            ready.set()
+
+        framer = self.codec.framer(kiosk.DEFAULT_MAX_FRAME_SIZE)
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            for frame in framer.feed(data):
+                self._respond(self.codec.decode(frame)["payload"])
+
+    def _respond(self, payload: Dict[str, Any]):
+        msg_type = payload.get("type")
+        txn_id = payload.get("txn_id", "")
+        write = self.writer.write
+
+        if msg_type == "transaction_request":
+            write(self._frame({"type": "ack", "txn_id": txn_id, "status": "processing"}))
+            if payload.get("payment_mode") == "ipp":
+                write(self._result(txn_id, status="ipp_plans", amount=payload.get("amount", 0), plans=IPP_PLANS))
+                return
+            outcome = self.rng.choices(self.outcomes, self.weights)[0]
+            if outcome == "error":
+                write(self._frame({"type": "error", "txn_id": txn_id, "message": "Simulated reader fault"}))
+            elif outcome == "failed":
+                write(self._result(txn_id, status="failed"))
+            else:
+                write(self._result(txn_id, status="success", authorization_code="AUTH123", card_last4="4242"))
+
+        elif msg_type == "ipp_plan_selection":
+            write(self._frame({"type": "ack", "txn_id": txn_id, "status": "processing"}))
+            write(self._result(txn_id, status="success", authorization_code="AUTH456", plan_id=payload.get("plan_id")))
+
+        elif msg_type == "cancel_transaction":
+            write(self._frame({"type": "ack", "txn_id": txn_id, "status": "received"}))
+
+
+IPP_PLANS = [
+    {
+        "planId": f"IPP_{months}M",
+        "frequency": "Monthly",
+        "totalInstallments": months,
+        "installmentDetails": [
+            {"installmentNumber": n, "date": "2024-02-15", "amount": 35.0,
+             "installmentFee": 1.5, "installmentFeePercentage": 1.5}
+            for n in range(1, months + 1)
+        ],
+    }
+    for months in (3, 6, 12)
+]
+
+
+class BenchSenderMixin:
+    """Instrumentation for the sender under test
+
+    Hands each generated txn_id to the load run before the request is sent.
+    """
+
+    bench_run: "LoadRun"
+
+    def _next_txn_id(self) -> str:
+        txn_id = super()._next_txn_id()
+        self.bench_run.bind(txn_id)
+        return txn_id
+
+
+class LoadRun:
+    """Drives concurrent payments and records their latencies"""
+
+    def __init__(self, sender: TcpSender, args: argparse.Namespace):
+        self.sender = sender
+        self.args = args
+        self.lock = threading.Lock()
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self.ack_latency: List[float] = []
+        self.result_latency: List[float] = []
+        self.outcomes: Dict[str, int] = {}
+        self.send_failures = 0
+        self.timeouts = 0
+        self.issued = 0
+        self.recording = False
+        self.local = threading.local()
+        sender.bench_run = self
+        sender.transactions.add_listener(self._on_transition)
+
+    def bind(self, txn_id: str):
+        """Associate a new txn_id with the payment its driver thread is issuing"""
+        entry = self.local.entry
+        entry["txn_id"] = txn_id
+        with self.lock:
+            self.pending[txn_id] = entry
+
+    def _on_transition(self, txn: Transaction):
+        now = time.perf_counter()
+        with self.lock:
+            entry = self.pending.get(txn.txn_id)
+        if entry is None:
+            return
+        if txn.state == TransactionState.ACKED and entry["acked"] is None:
+            entry["acked"] = now
+        elif txn.state.is_final:
+            result = txn.result or {}
+            status = "error" if result.get("type") == "error" else result.get("status", txn.state.value)
+            entry["finished"] = now
+            entry["outcome"] = f"{txn.payment_mode}:{status}"
+            entry["done"].set()
+
+    def _next_mode(self, rng: random.Random) -> str:
+        return "ipp" if rng.random() < self.args.mix.get("ipp", 0) else "card"
+
+    def _drive(self, worker: int, deadline: float, count: List[int]):
+        rng = random.Random(self.args.seed * 1000 + worker)
+        while True:
+            with self.lock:
+                if count[0] <= 0 or time.perf_counter() > deadline:
+                    return
+                count[0] -= 1
+                self.issued += 1
+
+            entry = {"txn_id": None, "acked": None, "finished": None, "outcome": None, "done": threading.Event()}
+            self.local.entry = entry
+            started = time.perf_counter()
+            if not self.sender.send_payment_request(self._next_mode(rng), 10.0):
+                with self.lock:
+                    self.send_failures += 1
+                    self.pending.pop(entry["txn_id"], None)
+                continue
+
+            txn_id = entry["txn_id"]
+            if not entry["done"].wait(self.args.timeout):
+                with self.lock:
+                    self.timeouts += 1
+                    self.pending.pop(txn_id, None)
+                continue
+
+            with self.lock:
+                self.pending.pop(txn_id, None)
+                if self.recording:
+                    if entry["acked"] is not None:
+                        self.ack_latency.append(entry["acked"] - started)
+                    self.result_latency.append(entry["finished"] - started)
+                    key = entry["outcome"]
+                    self.outcomes[key] = self.outcomes.get(key, 0) + 1
+
+    def phase(self, requests: int, duration: Optional[float]) -> float:
+        """Run one phase with the configured concurrency; returns elapsed seconds"""
+        count = [requests]
+        deadline = time.perf_counter() + (duration if duration else float("inf"))
+        workers = [
+            threading.Thread(target=self._drive, args=(i, deadline, count), daemon=True)
+            for i in range(self.args.concurrency)
+        ]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return time.perf_counter() - started
+
+
+class Flooder:
+    """A hostile connection that sends bad frames as fast as the Kiosk takes them
+
+    "forged" frames are well-formed envelopes with a wrong signature, so
+    each costs the Kiosk a parse and an HMAC check; "garbage" frames are
+    not JSON at all. A closed or refused connection is opened again.
+    """
+
+    def __init__(self, port: int, kind: str, stop: threading.Event):
+        self.port = port
+        self.stop = stop
+        if kind == "forged":
+            frame = kiosk.JSON_CODEC.encode({
+                "payload": {"type": "ping", "timestamp": SecurityHelper.get_current_timestamp(),
+                            "nonce": SecurityHelper.generate_nonce()},
+                "signature": "0" * 64,
+            })
+        else:
+            frame = b"x" * 200 + b"\n"
+        self.per_chunk = max(1, 65536 // len(frame))
+        self.chunk = frame * self.per_chunk
+        self.sent = 0
+        self.reconnects = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stop.is_set():
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=1) as sock:
+                    while not self.stop.is_set():
+                        sock.sendall(self.chunk)
+                        self.sent += self.per_chunk
+            except OSError:
+                self.reconnects += 1
+                self.stop.wait(0.01)
+
+
+def stop_terminals(loop: asyncio.AbstractEventLoop, terminals: List[SimulatedTerminal]):
+    """Cancel the simulated terminals and stop their event loop"""
+    async def stop():
+        tasks = [terminal.task for terminal in terminals if terminal.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run_coroutine_threadsafe(stop(), loop).result(timeout=10)
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def start_terminals(args: argparse.Namespace, port: int,
+                    mix: Dict[str, float]) -> Tuple[asyncio.AbstractEventLoop, List[SimulatedTerminal]]:
+    """Connect the simulated terminals on their own event loop thread
+
+    The caller must keep the returned terminals: the event loop holds only
+    weak references to their tasks and streams.
+    """
+    loop = asyncio.new_event_loop()
+    padding = "x" * args.payload_bytes
+    terminals = [
+        SimulatedTerminal(f"BENCH{i:04d}", port, mix, padding, args.seed + i, args.codec)
+        for i in range(args.terminals)
+    ]
+    connected: List[str] = []
+
+    async def start():
+        ready = asyncio.Event()
+        for terminal in terminals:
+            terminal.task = loop.create_task(terminal.run(ready, connected, len(terminals)))
+        await asyncio.wait_for(ready.wait(), timeout=30)
+
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(start(), loop).result()
+    return loop, terminals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and latency benchmark for the Kiosk TCP protocol")
+    parser.add_argument("--terminals", type=int, default=4, help="simulated POS terminals")
+    parser.add_argument("--concurrency", type=int, default=8, help="payments in flight at once")
+    parser.add_argument("--requests", type=int, default=2000, help="measured payments")
+    parser.add_argument("--duration", type=float, help="stop measuring after this many seconds")
+    parser.add_argument("--warmup", type=int, default=200, help="unmeasured payments before the run")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("success=90,failed=5,error=3,ipp=2"),
+                        help="outcome weights, e.g. success=80,failed=10,error=5,ipp=5")
+    parser.add_argument("--payload-bytes", type=int, default=0, help="extra bytes in every transaction_result")
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread")
+    parser.add_argument("--dispatch", choices=TerminalRouter.POLICIES, default=TerminalRouter.LEAST_OUTSTANDING)
+    parser.add_argument("--journal", metavar="DIR", help="journal transactions in DIR to measure its overhead")
+    parser.add_argument("--codec", choices=sorted(kiosk.CODECS), default="json",
+                        help="wire codec the simulated terminals negotiate")
+    parser.add_argument("--rate-limit", type=float, default=0,
+                        help="per-connection frame rate limit of the Kiosk (default: off, as the simulated "
+                             "terminals send far faster than real ones)")
+    parser.add_argument("--quarantine-after", type=int, default=kiosk.DEFAULT_QUARANTINE_AFTER,
+                        help="rejected frames that get a connection closed (0: never)")
+    parser.add_argument("--flood", type=int, default=0,
+                        help="hostile connections sending bad frames during the measured run")
+    parser.add_argument("--flood-kind", choices=["forged", "garbage"], default="forged",
+                        help="forged: valid JSON with a wrong signature; garbage: not JSON")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--timeout", type=float, default=10.0, help="seconds to wait for each result")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", metavar="PATH", help="write results as JSON to PATH ('-' for stdout)")
+    args = parser.parse_args()
+
+    kiosk.configure_logging(logging.ERROR, stream=sys.stderr)
+
+    base = AsyncTcpSender if args.engine == "asyncio" else TcpSender
+    sender_class = type(f"Bench{base.__name__}", (BenchSenderMixin, base), {})
+    journal = kiosk.TransactionJournal(args.journal) if args.journal else None
+    admission = kiosk.AdmissionControl(args.rate_limit, quarantine_after=args.quarantine_after)
+    sender = sender_class(host="127.0.0.1", port=args.port, dispatch_policy=args.dispatch, journal=journal,
+                          plan_policy=kiosk.lowest_fee_plan, admission=admission)
+    run = LoadRun(sender, args)
+    if not sender.start_server():
+        sys.exit("Failed to start the Kiosk server")
+
+    loop, terminals = start_terminals(args, args.port, args.mix)
+    time.sleep(0.2)
+
+    if args.warmup:
+        run.phase(args.warmup, None)
+    run.recording = True
+    flood_stop = threading.Event()
+    flooders = [Flooder(args.port, args.flood_kind, flood_stop) for _ in range(args.flood)]
+    for flooder in flooders:
+        flooder.thread.start()
+    elapsed = run.phase(args.requests, args.duration)
+    flood_stop.set()
+    for flooder in flooders:
+        flooder.thread.join()
+
+    stop_terminals(loop, terminals)
+    sender.stop_server()
+
+    completed = len(run.result_latency)
+    report = {
+        "benchmark": "kiosk_load",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "engine": args.engine,
+            "dispatch": args.dispatch,
+            "terminals": args.terminals,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "duration": args.duration,
+            "mix": args.mix,
+            "payload_bytes": args.payload_bytes,
+            "journal": bool(args.journal),
+            "codec": args.codec,
+            "json_backend": kiosk.JSON_CODEC.backend,
+            "rate_limit": args.rate_limit,
+            "quarantine_after": args.quarantine_after,
+            "flood": args.flood,
+            "flood_kind": args.flood_kind,
+        },
+        "elapsed_s": round(elapsed, 3),
+        "completed": completed,
+        "throughput_per_s": round(completed / elapsed, 1) if elapsed else None,
+        "outcomes": run.outcomes,
+        "send_failures": run.send_failures,
+        "timeouts": run.timeouts,
+        "latency_ms": {
+            "request_to_ack": latency_summary(run.ack_latency),
+            "request_to_result": latency_summary(run.result_latency),
+        },
+    }
+    if flooders:
+        rejections = kiosk.metrics.counter_values("kiosk_admission_rejections_total")
+        report["flood"] = {
+            "frames_written": sum(flooder.sent for flooder in flooders),
+            "reconnects": sum(flooder.reconnects for flooder in flooders),
+            "rejected": {reason: count for (reason,), count in sorted(rejections.items())},
+            "quarantines": sum(kiosk.metrics.counter_values("kiosk_quarantines_total").values()),
+            "refused": sum(kiosk.metrics.counter_values("kiosk_quarantine_refusals_total").values()),
+        }
+
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    print(f"Engine {args.engine}, {args.terminals} terminals, concurrency {args.concurrency}, "
+          f"dispatch {args.dispatch}{', journal on' if args.journal else ''}, "
+          f"codec {args.codec} (JSON via {kiosk.JSON_CODEC.backend})")
+    print(f"Completed {completed} payments in {elapsed:.2f}s: {report['throughput_per_s']} payments/s")
+    print(f"Outcomes: {run.outcomes}  send failures: {run.send_failures}  timeouts: {run.timeouts}")
+    for name, summary in report["latency_ms"].items():
+        print(f"{name:<18} p50 {summary['p50']} ms  p95 {summary['p95']} ms  "
+              f"p99 {summary['p99']} ms  max {summary['max']} ms")
+    if flooders:
+        flood = report["flood"]
+        print(f"Flood: {args.flood} {args.flood_kind} connection(s) wrote {flood['frames_written']} frames, "
+              f"rejected {flood['rejected']}, quarantines {flood['quarantines']}, refused {flood['refused']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Signing micro-benchmark for MobyPay Kiosk
+Compares the original per-call HMAC scheme with MessageSigner
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import platform
+import sys
+import timeit
+from typing import Any, Callable, Dict, List
+
+from kiosk_security import MessageSigner, SecurityHelper
+
+
+def legacy_sign(payload: Dict[str, Any]) -> str:
+    """Signature exactly as SecurityHelper.generate_signature computed it originally"""
+    json_string = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    return hmac.new(
+        SecurityHelper.SHARED_SECRET.encode('utf-8'),
+        json_string.encode('utf-8'),
+        hashlib.sha256
+    ).hexdigest()
+
+
+def legacy_verify(payload: Dict[str, Any], signature: str) -> bool:
+    """Original validate_secure_message signature step, minus the prints
+
+    A failed check signed the payload a second time and dumped it for the
+    debug output.
+    """
+    if hmac.compare_digest(legacy_sign(payload), signature):
+        return True
+    expected = legacy_sign(payload)
+    json.dumps(payload, sort_keys=True)
+    return signature == expected
+
+
+def ack_payload() -> Dict[str, Any]:
+    return SecurityHelper.create_secure_message({
+        "type": "ack",
+        "txn_id": "TXN1705123456789",
+        "status": "processing"
+    })["payload"]
+
+
+def ipp_payload(installments: int) -> Dict[str, Any]:
+    details = [
+        {
+            "installmentNumber": n,
+            "date": "2024-02-15",
+            "amount": 35.0,
+            "installmentFee": 1.5,
+            "installmentFeePercentage": 1.5
+        }
+        for n in range(1, installments + 1)
+    ]
+    plans = [
+        {"planId": f"IPP_{months}M", "frequency": "Monthly", "totalInstallments": installments,
+         "installmentDetails": details}
+        for months in (3, 6, 12)
+    ]
+    return SecurityHelper.create_secure_message({
+        "type": "transaction_result",
+        "txn_id": "TXN1705123456789",
+        "status": "ipp_plans",
+        "amount": 100.0,
+        "plans": plans
+    })["payload"]
+
+
+def measure(func: Callable[[], Any], number: int, repeat: int) -> float:
+    """Best-of-repeat cost of one call, in microseconds"""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def run(number: int, repeat: int, installments: int) -> List[Dict[str, Any]]:
+    signer = MessageSigner(SecurityHelper.SHARED_SECRET)
+    payloads = {"ack": ack_payload(), f"ipp_plans[{installments}]": ipp_payload(installments)}
+    results = []
+
+    for name, payload in payloads.items():
+        good = legacy_sign(payload)
+        assert signer.sign(payload) == good, "MessageSigner output differs from the original scheme"
+        bad = "0" * len(good)
+        size = len(signer.canonicalize(payload))
+
+        cases = [
+            ("sign", lambda: legacy_sign(payload), lambda: signer.sign(payload)),
+            ("verify_ok", lambda: legacy_verify(payload, good), lambda: signer.verify(payload, good)),
+            ("verify_bad", lambda: legacy_verify(payload, bad), lambda: signer.verify(payload, bad)),
+        ]
+
+        for case, before, after in cases:
+            before_us = measure(before, number, repeat)
+            after_us = measure(after, number, repeat)
+            results.append({
+                "payload": name,
+                "payload_bytes": size,
+                "case": case,
+                "before_us": round(before_us, 3),
+                "after_us": round(after_us, 3),
+                "speedup": round(before_us / after_us, 2),
+                "after_per_second": int(1e6 / after_us),
+            })
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-message sign/verify cost, before and after MessageSigner")
+    parser.add_argument("--number", type=int, default=20000, help="calls per timing run")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs; the fastest is reported")
+    parser.add_argument("--installments", type=int, default=12, help="installments per IPP plan in the large payload")
+    parser.add_argument("--json", metavar="PATH", help="write results as JSON to PATH ('-' for stdout)")
+    args = parser.parse_args()
+
+    results = run(args.number, args.repeat, args.installments)
+
+    if args.json:
+        report = {
+            "benchmark": "signing",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results,
+        }
+        if args.json == "-":
+            json.dump(report, sys.stdout, indent=2)
+            print()
+            return
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    print(f"{'payload':<18}{'bytes':>7}  {'case':<17}{'before µs':>10}{'after µs':>10}{'speedup':>9}{'after/s':>11}")
+    for r in results:
+        print(f"{r['payload']:<18}{r['payload_bytes']:>7}  {r['case']:<17}{r['before_us']:>10.2f}"
+              f"{r['after_us']:>10.2f}{r['speedup']:>8.2f}x{r['after_per_second']:>11,}")
+
+
+if __name__ == "__main__":
+    main()
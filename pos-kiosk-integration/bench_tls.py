@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+TLS cost benchmark for MobyPay Kiosk
+Compares plain TCP with the native TLS listener: connection setup with a
+full and a resumed handshake, and steady-state ping/pong over one connection
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import socket
+import ssl
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import kiosk
+from kiosk import AsyncTcpSender, SecurityHelper, TcpSender
+from make_test_certs import generate
+
+ENGINES = {"thread": TcpSender, "asyncio": AsyncTcpSender}
+
+
+def frame(data: Dict[str, Any]) -> bytes:
+    return kiosk.JSON_CODEC.encode(SecurityHelper.create_secure_message(data))
+
+
+def pings(count: int) -> List[bytes]:
+    """Signed ping frames; each nonce is accepted only once, so they are never reused"""
+    return [frame({"type": "ping"}) for _ in range(count)]
+
+
+class BenchClient:
+    """A POS connection that only says hello and pings"""
+
+    def __init__(self, port: int, terminal_id: str, context: Optional[ssl.SSLContext] = None,
+                 session: Optional[ssl.SSLSession] = None):
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if context is not None:
+            self.sock = context.wrap_socket(self.sock, server_hostname="localhost", session=session)
+        self.file = self.sock.makefile("rb")
+        self.sock.sendall(frame({"type": "hello", "terminal_id": terminal_id}))
+
+    def round_trips(self, pings: List[bytes]):
+        """Send each ping and wait for its pong"""
+        for ping in pings:
+            self.sock.sendall(ping)
+            if not self.file.readline():
+                raise ConnectionError("Kiosk closed the connection")
+
+    def pipelined(self, pings: List[bytes], window: int = 32):
+        """Keep up to window pings in flight"""
+        for start in range(0, len(pings), window):
+            batch = pings[start:start + window]
+            self.sock.sendall(b"".join(batch))
+            for _ in batch:
+                if not self.file.readline():
+                    raise ConnectionError("Kiosk closed the connection")
+
+    @property
+    def session(self) -> Optional[ssl.SSLSession]:
+        return getattr(self.sock, "session", None)
+
+    @property
+    def resumed(self) -> bool:
+        return getattr(self.sock, "session_reused", False)
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+def best(func: Callable[[Any], Any], setup: Callable[[], Any], repeat: int) -> float:
+    """Fastest of repeat runs, in seconds, not counting setup"""
+    times = []
+    for _ in range(repeat):
+        prepared = setup()
+        start = time.perf_counter()
+        func(prepared)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def connect_cost(port: int, context: Optional[ssl.SSLContext], resume: bool,
+                 connections: int, repeat: int) -> float:
+    """Microseconds from connect to first pong, per connection"""
+    first = BenchClient(port, "BENCH-0", context)
+    first.round_trips(pings(1))
+    # TLS 1.3 tickets arrive after the handshake, so the session is read after the first pong
+    session = first.session if resume else None
+    first.close()
+
+    def run(frames: List[bytes]):
+        for n, ping in enumerate(frames):
+            client = BenchClient(port, f"BENCH-{n}", context, session)
+            client.round_trips([ping])
+            if resume and not client.resumed:
+                raise RuntimeError("TLS session was not resumed")
+            client.close()
+
+    return best(run, lambda: pings(connections), repeat) / connections * 1e6
+
+
+def steady_cost(port: int, context: Optional[ssl.SSLContext], messages: int, repeat: int) -> Dict[str, float]:
+    """Microseconds per ping/pong, sequential and pipelined, over one connection"""
+    client = BenchClient(port, "BENCH-STEADY", context)
+    try:
+        client.round_trips(pings(100))
+        return {
+            "round_trip_us": best(client.round_trips, lambda: pings(messages), repeat) / messages * 1e6,
+            "pipelined_us": best(client.pipelined, lambda: pings(messages), repeat) / messages * 1e6,
+        }
+    finally:
+        client.close()
+
+
+def run(engines: List[str], cert_dir: str, port: int, connections: int, messages: int,
+        repeat: int) -> List[Dict[str, Any]]:
+    server_tls = kiosk.create_tls_context(os.path.join(cert_dir, "kiosk.crt"), os.path.join(cert_dir, "kiosk.key"))
+    client_tls = ssl.create_default_context(cafile=os.path.join(cert_dir, "ca.crt"))
+    results = []
+
+    for n, engine in enumerate(engines):
+        # Pings come far faster than any terminal sends them, so the rate limit is off
+        plain = ENGINES[engine](host="127.0.0.1", port=port + 2 * n, admission=kiosk.AdmissionControl(rate=0))
+        secure = ENGINES[engine](host="127.0.0.1", port=port + 2 * n + 1, tls=server_tls,
+                                 admission=kiosk.AdmissionControl(rate=0))
+        if not plain.start_server() or not secure.start_server():
+            raise RuntimeError(f"{engine} engine failed to start")
+        try:
+            cases = [
+                ("plain", plain.port, None, False),
+                ("tls_full", secure.port, client_tls, False),
+                ("tls_resumed", secure.port, client_tls, True),
+            ]
+            baseline = None
+            for case, port, context, resume in cases:
+                connect_us = connect_cost(port, context, resume, connections, repeat)
+                steady = steady_cost(port, context, messages, repeat) if not resume else {}
+                baseline = baseline or {"connect_us": connect_us, **steady}
+                row = {"engine": engine, "case": case, "connect_us": round(connect_us, 1)}
+                row["connect_overhead"] = round(connect_us / baseline["connect_us"], 2)
+                for key, value in steady.items():
+                    row[key] = round(value, 2)
+                    row[key.replace("_us", "_overhead")] = round(value / baseline[key], 2)
+                results.append(row)
+        finally:
+            plain.stop_server()
+            secure.stop_server()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Handshake and steady-state cost of TLS against plain TCP")
+    parser.add_argument("--engine", choices=["thread", "asyncio", "both"], default="both", help="connection engine")
+    parser.add_argument("--port", type=int, default=18090, help="first of the ports used (two per engine)")
+    parser.add_argument("--connections", type=int, default=200, help="connections per timing run")
+    parser.add_argument("--messages", type=int, default=5000, help="ping/pong round trips per timing run")
+    parser.add_argument("--repeat", type=int, default=3, help="timing runs; the fastest is reported")
+    parser.add_argument("--certs", metavar="DIR",
+                        help="certificates from make_test_certs.py (default: generate throwaway ones)")
+    parser.add_argument("--json", metavar="PATH", help="write results as JSON to PATH ('-' for stdout)")
+    args = parser.parse_args()
+
+    kiosk.configure_logging(logging.WARNING, stream=sys.stderr)
+    engines = ["thread", "asyncio"] if args.engine == "both" else [args.engine]
+
+    with tempfile.TemporaryDirectory() as scratch:
+        cert_dir = args.certs
+        if cert_dir is None:
+            cert_dir = scratch
+            generate(cert_dir, ["localhost", "127.0.0.1"], [])
+        results = run(engines, cert_dir, args.port, args.connections, args.messages, args.repeat)
+
+    if args.json:
+        report = {
+            "benchmark": "tls",
+            "python": platform.python_version(),
+            "openssl": ssl.OPENSSL_VERSION,
+            "platform": platform.platform(),
+            "results": results,
+        }
+        if args.json == "-":
+            json.dump(report, sys.stdout, indent=2)
+            print()
+            return
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    def cell(row: Dict[str, Any], key: str) -> str:
+        if key not in row:
+            return f"{'-':>10}{'':>8}"
+        overhead = row[key.replace("_us", "_overhead")]
+        return f"{row[key]:>10.2f}{overhead:>7.2f}x"
+
+    print(f"{'engine':<9}{'case':<13}{'connect µs':>18}{'round trip µs':>18}{'pipelined µs':>18}")
+    for row in results:
+        print(f"{row['engine']:<9}{row['case']:<13}{cell(row, 'connect_us')}{cell(row, 'round_trip_us')}"
+              f"{cell(row, 'pipelined_us')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,160 +4,168 @@ TCP Sender for MobyPay Kiosk
 Python implementation of the Flutter TCP sender with security features
 """
 
+import argparse
+import asyncio
+import base64
+import concurrent.futures
+import logging
+import select
+import signal
 import socket
-import json
+import ssl
+import sys
+import tempfile
+import os
 import time
 import threading
-import hashlib
-import hmac
-import uuid
 from datetime import datetime
-from typing import Dict, Any, Optional, Set
+from typing import Dict, Any, Callable, List, Optional, Set, Tuple
 
-class SecurityHelper:
-    """Security helper for message signing and validation"""
-    
-    SHARED_SECRET = "POS-KIOSK-SECRET-KEY-2024"
-    _used_nonces: Set[str] = set()
-    
-    @staticmethod
-    def generate_signature(payload: Dict[str, Any]) -> str:
-        """Generate HMAC-SHA256 signature for payload"""
-        json_string = json.dumps(payload, sort_keys=True, separators=(',', ':'))
-        signature = hmac.new(
-            SecurityHelper.SHARED_SECRET.encode('utf-8'),
-            json_string.encode('utf-8'),
-            hashlib.sha256
-        ).hexdigest()
-        return signature
-    
-    @staticmethod
-    def verify_signature(payload: Dict[str, Any], signature: str) -> bool:
-        """Verify HMAC-SHA256 signature"""
-        expected_signature = SecurityHelper.generate_signature(payload)
-        return hmac.compare_digest(expected_signature, signature)
-    
-    @staticmethod
-    def validate_nonce(nonce: str) -> bool:
-        """Validate nonce to prevent replay attacks"""
-        if nonce in SecurityHelper._used_nonces:
-            return False
-        
-        SecurityHelper._used_nonces.add(nonce)
-        
-        # Clean old nonces after 1000 entries
-        if len(SecurityHelper._used_nonces) > 1000:
-            SecurityHelper._used_nonces.clear()
-        
-        return True
-    
-    @staticmethod
-    def validate_timestamp(timestamp: str) -> bool:
-        """Validate timestamp (within 60 seconds)"""
-        try:
-            request_time = int(timestamp)
-            current_time = int(datetime.now().timestamp() * 1000)
-            difference = abs(current_time - request_time)
-            print(f"🕐 Timestamp validation - Request: {request_time}, Current: {current_time}, Diff: {difference}ms")
-            
-            if difference >= 60000:
-                print(f"❌ Timestamp failed: Request too old/new (diff: {difference}ms > 60000ms)")
-                return False
-            
-            print(f"✅ Timestamp valid: Within 60 second window")
-            return True
-        except (ValueError, TypeError) as e:
-            print(f"❌ Timestamp failed: Invalid format '{timestamp}' - {type(e).__name__}: {e}")
-            return False
-    
-    @staticmethod
-    def generate_nonce() -> str:
-        """Generate unique nonce"""
-        return str(uuid.uuid4())
-    
-    @staticmethod
-    def get_current_timestamp() -> str:
-        """Get current timestamp in milliseconds"""
-        return str(int(datetime.now().timestamp() * 1000))
-    
-    @staticmethod
-    def create_secure_message(data: Dict[str, Any]) -> Dict[str, Any]:
-        """Create secure message with payload and signature"""
-        timestamp = SecurityHelper.get_current_timestamp()
-        nonce = SecurityHelper.generate_nonce()
-        
-        payload = {
-            **data,
-            "timestamp": timestamp,
-            "nonce": nonce
-        }
-        
-        signature = SecurityHelper.generate_signature(payload)
-        
-        return {
-            "payload": payload,
-            "signature": signature
-        }
-    
-    @staticmethod
-    def validate_secure_message(message: Dict[str, Any]) -> Dict[str, Any]:
-        """Validate secure message and return result"""
-        try:
-            if "payload" not in message or "signature" not in message:
-                return {"is_valid": False, "error": "Missing payload or signature"}
-            
-            payload = message["payload"]
-            signature = message["signature"]
-            
-            # Verify signature
-            if not SecurityHelper.verify_signature(payload, signature):
-                # Generate expected signature for debugging
-                expected_signature = SecurityHelper.generate_signature(payload)
-                print(f"🔐 Signature verification FAILED:")
-                print(f"   📨 Received signature: {signature}")
-                print(f"   🔑 Expected signature: {expected_signature}")
-                print(f"   📋 Payload: {json.dumps(payload, sort_keys=True)}")
-                print(f"   ❌ Signatures match: {signature == expected_signature}")
-                print(f"   🔍 Length comparison - Received: {len(signature)}, Expected: {len(expected_signature)}")
-                return {"is_valid": False, "error": "Invalid signature"}
-            else:
-                print(f"🔐 Signature verification PASSED:")
-                print(f"   ✅ Signature matches expected value")
-                print(f"   📨 Signature: {signature[:16]}...{signature[-16:]}")
-            
-            # Validate nonce
-            if "nonce" not in payload:
-                return {"is_valid": False, "error": "Missing nonce"}
-            
-            if not SecurityHelper.validate_nonce(payload["nonce"]):
-                return {"is_valid": False, "error": "Invalid or duplicate nonce"}
-            
-            # Validate timestamp
-            if "timestamp" not in payload:
-                return {"is_valid": False, "error": "Missing timestamp"}
-            
-            if not SecurityHelper.validate_timestamp(payload["timestamp"]):
-                return {"is_valid": False, "error": "Request expired or invalid timestamp"}
-            
-            return {"is_valid": True, "payload": payload}
-            
-        except Exception as e:
-            return {"is_valid": False, "error": f"Message validation error: {str(e)}"}
+# The protocol, transaction and connection building blocks live in the kiosk_*
+# modules; they are re-exported here so `import kiosk` still reaches all of them
+from kiosk_metrics import (  # noqa: F401
+    ConsoleFormatter, DISK_BUCKETS, JsonLinesFormatter, KioskMetrics, LATENCY_BUCKETS, MetricSpec, MetricsServer,
+    VERIFY_BUCKETS, configure_logging, metrics
+)
+from kiosk_codec import (  # noqa: F401
+    CODECS, DEFAULT_MAX_FRAME_SIZE, JSON_CODEC, JsonCodec, LengthPrefixedFramer, MessageFramer, MsgpackCodec,
+    WireCodec, negotiate_codec
+)
+from kiosk_security import (  # noqa: F401
+    MessageSigner, NonceReplayCache, SecurityHelper, SignatureCheck, TIMESTAMP_WINDOW_MS
+)
+from kiosk_transactions import (  # noqa: F401
+    DEFAULT_IDEMPOTENCY_CAPACITY, DEFAULT_IDEMPOTENCY_TTL, IdempotencyCache, IppPlan, PaymentHandle, PaymentResult,
+    PendingCancel, PlanOffer, PlanPolicy, Transaction, TransactionRegistry, TransactionState, lowest_fee_plan,
+    plan_by_id
+)
+from kiosk_journal import (  # noqa: F401
+    CaptureRecord, TrafficCapture, TransactionJournal
+)
+from kiosk_prefork import (  # noqa: F401
+    ControlServer, SharedNonceCache, SharedState, SocketHandoff
+)
+from kiosk_transport import (  # noqa: F401
+    AdmissionControl, DEFAULT_HEARTBEAT_INTERVAL, DEFAULT_IDLE_TIMEOUT, DEFAULT_QUARANTINE_AFTER,
+    DEFAULT_QUARANTINE_SECONDS, DEFAULT_RATE_BURST, DEFAULT_RATE_LIMIT, DEFAULT_SEND_QUEUE_BYTES, OutboundQueue,
+    PosConnection, TerminalRouter, TimerWheel, TlsStream, TokenBucket, certificate_name, configure_keepalive,
+    create_tls_context
+)
+
+logger = logging.getLogger("mobypay.kiosk")
+
+# Seconds an IPP plan offer waits for a selection before the payment is cancelled
+DEFAULT_PLAN_TIMEOUT = 120.0
 
 
 class TcpSender:
-    """TCP Sender for MobyPay Kiosk communication"""
+    """TCP Sender for MobyPay Kiosk communication
+    
+    With shared state, the sender is one of several worker processes
+    accepting on the same port (see run_prefork). Requests for a terminal
+    or transaction held by another worker are forwarded to it over that
+    worker's control socket.
     
-    def __init__(self, host: str = "0.0.0.0", port: int = 8080):
+    With a SocketHandoff, a new process started on the same handoff path
+    takes over the listening socket, the plain POS connections and the
+    transaction state, and this one stops serving them (thread engine
+    only). handed_off is set once it has. The listening socket of
+    metrics_server, if set, goes along, and the new process finds it in
+    metrics_socket.
+    """
+    
+    RECV_SIZE = 65536
+    # A terminal that answers pings is not responsive once a pong is this late
+    PONG_TIMEOUT = 10.0
+    # Worker that runs the interactive menu, and so prompts for IPP plans
+    UI_WORKER = 0
+    # How long a forwarded request may wait for its frame to be written
+    CONTROL_TIMEOUT = 5.0
+    # A TLS handshake that takes longer than this is abandoned
+    TLS_HANDSHAKE_TIMEOUT = 10.0
+    # How long a handoff may wait for readers to pause and send queues to empty
+    HANDOFF_TIMEOUT = 5.0
+    # A cancel the terminal neither confirms nor answers with a result in this time is cancelled on the Kiosk only
+    CANCEL_TIMEOUT = 15.0
+    
+    def __init__(self, host: str = "0.0.0.0", port: int = 8080,
+                 max_frame_size: int = DEFAULT_MAX_FRAME_SIZE,
+                 dispatch_policy: str = TerminalRouter.FIRST,
+                 heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL,
+                 idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+                 journal: Optional[TransactionJournal] = None,
+                 send_queue_bytes: int = DEFAULT_SEND_QUEUE_BYTES,
+                 shared: Optional[SharedState] = None,
+                 plan_policy: Optional[PlanPolicy] = None,
+                 plan_timeout: float = DEFAULT_PLAN_TIMEOUT,
+                 tls: Optional[ssl.SSLContext] = None,
+                 capture: Optional[TrafficCapture] = None,
+                 admission: Optional[AdmissionControl] = None,
+                 handoff: Optional[SocketHandoff] = None):
         self.host = host
         self.port = port
+        self.max_frame_size = max_frame_size
+        self.send_queue_bytes = send_queue_bytes
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.wheel = TimerWheel()
+        self._reaper_stop = threading.Event()
+        self._reaper_thread: Optional[threading.Thread] = None
         self.server_socket: Optional[socket.socket] = None
         self.client_socket: Optional[socket.socket] = None
-        self.connected_clients = []
+        self.transactions = TransactionRegistry()
+        self.router = TerminalRouter(self.transactions, dispatch_policy)
         self.current_txn_id: Optional[str] = None
-        self.is_listening = False
         self.kiosk_id = "KIOSK001"
-        
+        self._txn_lock = threading.Lock()
+        self._last_txn_ms = 0
+        self._seen_terminals: Set[str] = set()
+        self.transactions.add_listener(self._record_latency)
+        self.journal = journal
+        if journal is not None:
+            self.transactions.add_recorder(journal.record)
+        self.shared = shared
+        self.control: Optional[ControlServer] = None
+        self._forwarder: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        if shared is not None:
+            self.transactions.add_listener(shared.record_transaction)
+        self.plan_policy = plan_policy
+        self.plan_timeout = plan_timeout
+        self.tls = tls
+        self.capture = capture
+        self.admission = admission if admission is not None else AdmissionControl()
+        self._plan_lock = threading.Lock()
+        self._plan_offers: Dict[str, PlanOffer] = {}
+        self._plan_waiters: Dict[str, concurrent.futures.Future] = {}
+        self._plan_listeners: List[Callable[[PlanOffer], None]] = []
+        self._conflict_listeners: List[Callable[[Transaction, Dict[str, Any]], None]] = []
+        self.transactions.add_listener(self._withdraw_plan_offer)
+        self._payments_lock = threading.Lock()
+        self._payments: Dict[str, PaymentHandle] = {}
+        self.transactions.add_listener(self._follow_payment)
+        self.idempotency = IdempotencyCache()
+        self._idempotency_lock = threading.Lock()
+        self.handoff = handoff
+        self.handed_off = threading.Event()
+        # The metrics endpoint whose socket a handoff passes on, and the socket taken over from the previous process
+        self.metrics_server: Optional[MetricsServer] = None
+        self.metrics_socket: Optional[socket.socket] = None
+        # Readers and the acceptor wait on this pipe as well as their socket, so a handoff can pause them
+        self._wake: Optional[Tuple[int, int]] = None
+        self._handoff_cond = threading.Condition()
+        self._pausing = False
+        self._paused: Set[Any] = set()
+    
+    @property
+    def is_listening(self) -> bool:
+        """True while any transaction is waiting for a response"""
+        return self.transactions.has_active()
+    
+    @property
+    def connected_clients(self) -> list:
+        """Client connections, oldest first"""
+        return [connection.client for connection in self.router.connections()]
+    
     def get_local_ip(self) -> str:
         """Get local IP address"""
         try:
@@ -169,40 +177,69 @@ class TcpSender:
             return "127.0.0.1"
     
     def start_server(self) -> bool:
-        """Start TCP server"""
+        """Start TCP server, taking over from the Kiosk serving the handoff path if there is one"""
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
+            if self.handoff is not None:
+                self._wake = os.pipe()
+            takeover = self._take_over()
+            self._open_journal()
+            self._open_capture()
+            self._start_shared()
+            if takeover is not None:
+                self._adopt(*takeover)
+            else:
+                self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if self.shared is not None:
+                    # Every worker listens on the port; the kernel spreads connections across them
+                    self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                self.server_socket.bind((self.host, self.port))
+                self.server_socket.listen(5)
             
             local_ip = self.get_local_ip()
-            print(f"🚀 Server started on {local_ip}:{self.port}")
-            print(f"📱 Connect your POS terminal to: {local_ip}:{self.port}")
+            logger.info("🚀 Server started on %s:%s%s", local_ip, self.port, " (TLS)" if self.tls else "")
+            logger.info("📱 Connect your POS terminal to: %s:%s", local_ip, self.port)
             
             # Start listening for connections in a separate thread
             listen_thread = threading.Thread(target=self._listen_for_connections)
             listen_thread.daemon = True
             listen_thread.start()
             
+            self._start_reaper()
+            if self.handoff is not None:
+                self.handoff.serve(self._hand_off)
             return True
             
         except Exception as e:
-            print(f"❌ Failed to start server: {e}")
+            logger.error("❌ Failed to start server: %s", e)
+            self._stop_shared()
+            self._close_capture()
+            self._close_journal()
+            self._close_wake()
             return False
     
     def _listen_for_connections(self):
         """Listen for incoming connections"""
+        poller = self._poller(self.server_socket)
         while self.server_socket:
             try:
+                if poller is not None and not self._readable(poller, self):
+                    continue
                 client_socket, addr = self.server_socket.accept()
-                print(f"🔗 Client connected from {addr[0]}:{addr[1]}")
-                
-                self.connected_clients.append(client_socket)
+                # Refuse a quarantined host before it costs a thread or a TLS handshake
+                if not self.admission.admit_host(addr[0]):
+                    client_socket.close()
+                    continue
+                # As asyncio does: otherwise a reply written while the previous
+                # segment (such as a TLS session ticket) is unacknowledged waits
+                # for the terminal's delayed ACK
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if self.heartbeat_interval:
+                    configure_keepalive(client_socket, self.heartbeat_interval)
                 
                 # Handle client in separate thread
                 client_thread = threading.Thread(
-                    target=self._handle_client, 
+                    target=self._serve_client, 
                     args=(client_socket, addr)
                 )
                 client_thread.daemon = True
@@ -210,302 +247,2107 @@ class TcpSender:
                 
             except Exception as e:
                 if self.server_socket:
-                    print(f"❌ Connection error: {e}")
+                    logger.error("❌ Connection error: %s", e)
+                break
+    
+    def _serve_client(self, client_socket: socket.socket, addr):
+        """Client thread: complete any TLS handshake, then register the connection and read it"""
+        client = client_socket
+        if self.tls is not None:
+            client = TlsStream(client_socket, self.tls)
+            started = time.perf_counter()
+            try:
+                client.handshake(self.TLS_HANDSHAKE_TIMEOUT)
+            except (OSError, ssl.SSLError) as e:
+                metrics.inc("kiosk_tls_handshake_failures_total")
+                logger.warning("🔒 TLS handshake with %s:%s failed: %s", addr[0], addr[1], e)
+                client_socket.close()
+                return
+        
+        connection = self._register_client(client, addr)
+        if self.tls is not None:
+            self._tls_established(connection, client.ssl, time.perf_counter() - started)
+        
+        self._start_writer(connection)
+        self._handle_client(connection)
+    
+    def _tls_established(self, connection: PosConnection, ssl_object, elapsed: Optional[float] = None):
+        """Record a completed handshake and the identity of a client certificate"""
+        resumed = "true" if ssl_object.session_reused else "false"
+        metrics.inc("kiosk_tls_handshakes_total", resumed)
+        if elapsed is not None:
+            metrics.observe("kiosk_tls_handshake_seconds", elapsed, resumed)
+        connection.peer_name = certificate_name(ssl_object.getpeercert())
+        logger.debug("🔒 %s with %s from %s%s", ssl_object.version(), ssl_object.cipher()[0], connection.address,
+                     ", resumed" if ssl_object.session_reused else "")
+    
+    def _build_message(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Sign data; the message is encoded separately for each connection's codec"""
+        return SecurityHelper.create_secure_message(data)
+    
+    def _send_message(self, connection: PosConnection, message: Dict[str, Any],
+                      codec: Optional[WireCodec] = None) -> concurrent.futures.Future:
+        """Queue a signed message for a connection without waiting for the write
+        
+        Returns a Future that resolves once the frame is written. Raises
+        BufferError if the terminal's send queue is full and ConnectionError
+        if the connection has closed.
+        """
+        return connection.send(message, codec)
+    
+    def _start_writer(self, connection: PosConnection):
+        """Writes go through a thread of their own so a slow terminal never blocks a caller"""
+        connection.writer = threading.Thread(target=self._write_queued, args=(connection,))
+        connection.writer.daemon = True
+        connection.writer.start()
+    
+    def _write_queued(self, connection: PosConnection):
+        """Writer thread: drain a connection's send queue until it closes"""
+        while True:
+            batch = connection.outbound.take(timeout=None)
+            if not batch:
+                break
+            try:
+                # sendall() retries partial writes, so a frame is never cut short
+                connection.client.sendall(b"".join(frame for frame, _ in batch))
+            except OSError as e:
+                self._write_failed(connection, batch, e)
                 break
+            self._written(batch)
+    
+    @staticmethod
+    def _written(batch):
+        """Resolve the Futures of frames that were written"""
+        for frame, future in batch:
+            future.set_result(len(frame))
+    
+    def _write_failed(self, connection: PosConnection, batch, error: Exception):
+        """Fail the frames of a write that did not complete and drop the connection"""
+        metrics.inc("kiosk_send_failures_total", connection.metrics_label, value=len(batch))
+        logger.error("❌ Failed to write to POS terminal %s: %s", connection.terminal_id, error)
+        for _, future in batch:
+            future.set_exception(error)
+        connection.outbound.close(error)
+        self._drop_client(connection.client)
+    
+    def _send_refused(self, connection: PosConnection, error: Exception, what: str):
+        """Count and log a frame the connection would not queue; drops closed connections"""
+        metrics.inc("kiosk_send_failures_total", connection.metrics_label)
+        if isinstance(error, BufferError):
+            logger.warning("⏳ %s not sent: POS terminal %s is not reading (%s)", what, connection.terminal_id, error)
+        else:
+            logger.error("❌ Failed to send %s to POS terminal %s: %s", what, connection.terminal_id, error)
+            self._drop_client(connection.client)
+    
+    def _watch_delivery(self, txn_id: str, sent: concurrent.futures.Future):
+        """Fail a transaction if its frame is never written to the terminal"""
+        def delivered(future: concurrent.futures.Future):
+            error = "withdrawn" if future.cancelled() else future.exception()
+            if error is None:
+                return
+            if self.transactions.transition(txn_id, TransactionState.FAILED,
+                                            {"type": "error", "message": f"send failed: {error}"}):
+                logger.warning("❌ Transaction %s failed: its frame was not delivered (%s)", txn_id, error)
+            if txn_id == self.current_txn_id:
+                self.current_txn_id = None
+        
+        sent.add_done_callback(delivered)
+    
+    def _new_connection(self, client, address: str) -> PosConnection:
+        connection = PosConnection(client, address, self.max_frame_size, OutboundQueue(self.send_queue_bytes))
+        connection.bucket = self.admission.bucket()
+        return connection
     
-    def _handle_client(self, client_socket: socket.socket, addr):
+    def _connection_closed(self, connection: PosConnection):
+        """Release what a closed connection held"""
+        connection.outbound.close()
+        if connection.capture is not None:
+            connection.capture.closed(connection)
+        if self.shared is not None and connection.terminal_id != connection.address:
+            self.shared.release_terminal(connection.terminal_id, connection.address)
+    
+    def _register_client(self, client, addr) -> PosConnection:
+        """Track a newly accepted client connection"""
+        logger.info("🔗 Client connected from %s:%s", addr[0], addr[1])
+        connection = self._new_connection(client, f"{addr[0]}:{addr[1]}")
+        if self.capture is not None:
+            connection.capture = self.capture
+            self.capture.opened(connection)
+        self.router.register(connection)
+        metrics.inc("kiosk_connections_total")
+        if self.heartbeat_interval:
+            self.wheel.schedule(connection, connection.last_seen + self.heartbeat_interval)
+        return connection
+    
+    def _close_client(self, client):
+        """Close a client connection, waking the thread blocked reading it"""
+        try:
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        client.close()
+    
+    def _drop_client(self, client):
+        """Forget a client connection and close it"""
+        self.router.unregister(client)
+        self._close_client(client)
+    
+    def _handle_client(self, connection: PosConnection):
         """Handle client messages"""
-        while client_socket in self.connected_clients:
+        client_socket = connection.client
+        # TLS connections stay with this process, so only plain ones pause for a handoff
+        poller = None if isinstance(client_socket, TlsStream) else self._poller(client_socket)
+        
+        while self.router.connection_for(client_socket) is connection:
             try:
-                data = client_socket.recv(4096)
+                if poller is not None and not self._readable(poller, connection):
+                    continue
+                data = client_socket.recv(self.RECV_SIZE)
                 if not data:
                     break
                 
-                message = data.decode('utf-8').strip()
-                print(f"📨 Received from {addr[0]}: {message}")
-                
-                self._handle_response(message)
+                self._handle_data(connection, data)
                 
             except Exception as e:
-                print(f"❌ Client handling error: {e}")
+                # A connection closed by this Kiosk can fail the read that was about to start
+                if self.router.connection_for(client_socket) is connection:
+                    logger.error("❌ Client handling error: %s", e)
                 break
         
+        if connection.handed_off:
+            # The new process has the connection; only this process's descriptor goes
+            client_socket.close()
+            return
+        
         # Clean up
-        if client_socket in self.connected_clients:
-            self.connected_clients.remove(client_socket)
+        self.router.unregister(client_socket)
+        self._connection_closed(connection)
         client_socket.close()
-        print(f"🔌 Client {addr[0]} disconnected")
+        logger.info("🔌 Client %s (%s) disconnected", connection.terminal_id, connection.address)
     
-    def _handle_response(self, message: str):
-        """Handle incoming response messages"""
-        try:
-            parsed_message = json.loads(message)
-            
-            # Validate secure message
-            validation_result = SecurityHelper.validate_secure_message(parsed_message)
-            
-            if not validation_result["is_valid"]:
-                print(f"🔒 Security validation failed: {validation_result['error']}")
+    def _handle_data(self, connection: PosConnection, data: bytes):
+        """Feed received bytes through the framer and handle each complete message"""
+        connection.last_seen = time.monotonic()
+        connection.responsive = True
+        framer = connection.framer
+        dropped = framer.dropped_frames
+        rejected = connection.rejected
+        codec = connection.codec
+        messages = []
+        frames = framer.feed(data)
+        if frames and connection.capture is not None:
+            connection.capture.inbound(connection, frames, codec)
+        admitted = self.admission.admit(connection, frames, codec) if frames else frames
+        
+        for frame in admitted:
+            try:
+                message = codec.decode(frame)
+            except (ValueError, TypeError) as e:
+                self.admission.reject(connection, AdmissionControl.MALFORMED)
+                logger.warning("❌ %s decode error from %s: %s", codec.name, connection.terminal_id, e or type(e).__name__)
+                continue
+            logger.debug("📨 Received from %s: %s", connection.terminal_id, message)
+            messages.append(message)
+        
+        # Frames decoded from one read are verified together
+        if len(messages) == 1:
+            self._handle_validated(SecurityHelper.validate_secure_message(messages[0]), connection)
+        elif messages:
+            for validation_result in SecurityHelper.validate_secure_messages(messages):
+                self._handle_validated(validation_result, connection)
+        
+        # Counted after dispatch so a hello is attributed to the id it announced
+        if frames:
+            metrics.inc("kiosk_frames_received_total", connection.metrics_label, value=len(frames))
+        if framer.dropped_frames != dropped:
+            metrics.inc("kiosk_frames_dropped_total", connection.metrics_label, value=framer.dropped_frames - dropped)
+            self.admission.reject(connection, AdmissionControl.OVERSIZE, framer.dropped_frames - dropped)
+            logger.warning("❌ Dropped frame from %s: larger than %s bytes", connection.terminal_id, framer.max_frame_size)
+        if connection.quarantined:
+            self._drop_client(connection.client)
+            # A quarantined terminal cannot report these; fail them now rather than leave them waiting
+            for txn in self.transactions.active(connection.terminal_id):
+                self.transactions.transition(txn.txn_id, TransactionState.FAILED,
+                                             {"type": "error", "message": "terminal quarantined"})
+        elif connection.rejected != rejected:
+            # No new payments for a connection sending bad frames, until a read without any
+            connection.responsive = False
+    
+    def _handle_hello(self, connection: PosConnection, response: Dict[str, Any]):
+        """Bind a connection to the terminal id announced in its hello frame"""
+        terminal_id = response.get("terminal_id")
+        if not isinstance(terminal_id, str) or not terminal_id:
+            logger.warning("❌ Hello from %s without terminal_id", connection.address)
+            return
+        
+        if connection.peer_name is not None and terminal_id != connection.peer_name:
+            # With mutual TLS a terminal can only claim the id its certificate was issued to
+            logger.warning("🔒 Hello from %s as %s refused: its certificate is for %s",
+                           connection.address, terminal_id, connection.peer_name)
+            return
+        
+        previous = self.router.identify(connection, terminal_id)
+        if self.shared is not None:
+            other_worker = self.shared.claim_terminal(terminal_id, connection.address)
+            if other_worker is not None:
+                # The terminal reconnected to this worker; its old connection is elsewhere
+                self._forward(other_worker, {"op": "release", "terminal_id": terminal_id})
+        if terminal_id in self._seen_terminals:
+            metrics.inc("kiosk_reconnects_total", terminal_id)
+        else:
+            self._seen_terminals.add(terminal_id)
+        if previous is not None:
+            logger.info("♻️  Terminal %s reconnected; closing previous connection %s", terminal_id, previous.address)
+            self._close_client(previous.client)
+        logger.info("🪪 Terminal %s registered from %s", terminal_id, connection.address)
+        
+        # Terminals that list codecs wait for hello_ack before using the chosen one
+        if "codecs" in response:
+            codec = negotiate_codec(response["codecs"])
+            ack = self._build_message({"type": "hello_ack", "kiosk_id": self.kiosk_id, "codec": codec.name})
+            try:
+                self._send_message(connection, ack, codec)
+            except Exception as e:
+                self._send_refused(connection, e, "hello_ack")
                 return
-            
-            response = validation_result["payload"]
-            
+            logger.info("🧬 Terminal %s uses the %s codec", terminal_id, codec.name)
+        
+        if connection.capture is not None:
+            connection.capture.identified(connection)
+    
+    def _handle_response(self, message: str, connection: Optional[PosConnection] = None):
+        """Handle one incoming response message from a terminal"""
+        try:
+            parsed_message = JSON_CODEC.decode(message.encode('utf-8'))
+        except ValueError as e:
+            logger.warning("❌ JSON decode error: %s", e)
+            return
+        
+        # Validate secure message
+        self._handle_validated(SecurityHelper.validate_secure_message(parsed_message), connection)
+    
+    def _handle_validated(self, validation_result: Dict[str, Any], connection: Optional[PosConnection]):
+        """Dispatch a validated message, or log why validation failed"""
+        if not validation_result["is_valid"]:
+            # Drop exception details so the reason label has a fixed set of values
+            metrics.inc("kiosk_validation_failures_total", validation_result["error"].split(":", 1)[0])
+            if connection is not None:
+                self.admission.reject(connection, AdmissionControl.INVALID)
+            logger.warning("🔒 Security validation failed: %s", validation_result['error'])
+            return
+        
+        self._dispatch_response(validation_result["payload"], connection)
+    
+    def _dispatch_response(self, response: Dict[str, Any], connection: Optional[PosConnection]):
+        """Handle a validated payload according to its message type"""
+        try:
             # Handle different message types
             message_type = response.get("type")
+            txn_id = response.get("txn_id")
+            
+            if message_type == "hello":
+                if connection is not None:
+                    self._handle_hello(connection, response)
             
-            if message_type == "ack":
-                if response.get("txn_id") == self.current_txn_id:
-                    print(f"✅ Payment acknowledged by POS: {response.get('status')}")
+            elif message_type in ("ping", "pong"):
+                if connection is not None:
+                    connection.answers_ping = True
+                    if message_type == "ping":
+                        self._send_heartbeat(connection, "pong")
+                    logger.debug("💓 %s from %s", message_type.capitalize(), connection.terminal_id)
+            
+            elif message_type == "ack":
+                if response.get("status") != "processing" and self.transactions.transition(
+                        txn_id, TransactionState.CANCELLED, response, expect=(TransactionState.CANCELLING,)):
+                    # The ACK of a cancel says "received"; the ones of requests and plan selections "processing"
+                    logger.info("🚫 Cancel confirmed by POS: %s", txn_id)
+                    return
+                # ACKs also follow plan selections; only the first one moves the state
+                if (self.transactions.transition(txn_id, TransactionState.ACKED, expect=(TransactionState.REQUESTED,)) is None
+                        and self.transactions.get(txn_id) is None):
+                    logger.warning("❓ ACK for unknown transaction: %s", txn_id)
+                    return
+                logger.info("✅ Payment acknowledged by POS: %s (%s)", response.get('status'), txn_id)
             
             elif message_type == "transaction_result":
-                if response.get("txn_id") == self.current_txn_id:
-                    status = response.get("status")
-                    print(f"💳 Payment Result: {status}")
-                    
-                    if status == "ipp_plans":
-                        # Handle IPP plans selection
-                        self._handle_ipp_plans(response)
-                    elif "success" in status.lower() or "approved" in status.lower():
-                        self.is_listening = False
-                        print(f"🎉 Payment Successful!")
-                        if "authorization_code" in response:
-                            print(f"🔑 Auth Code: {response['authorization_code']}")
-                        if "card_last4" in response:
-                            print(f"💳 Card: **** **** **** {response['card_last4']}")
-                    else:
-                        self.is_listening = False
-                        print(f"❌ Payment Failed: {status}")
+                status = str(response.get("status") or "")
+                if status == "ipp_plans":
+                    # A repeated plan list must not reopen an offer that was already answered
+                    state, expect = TransactionState.IPP_PLANS, (TransactionState.REQUESTED, TransactionState.ACKED)
+                elif "success" in status.lower() or "approved" in status.lower():
+                    state, expect = TransactionState.COMPLETED, None
+                else:
+                    state, expect = TransactionState.FAILED, None
+                
+                # One locked lookup both applies the result and rejects duplicates
+                if self.transactions.transition(txn_id, state, response, expect) is None:
+                    self._ignore_result(txn_id, state, response)
+                    return
+                
+                logger.info("💳 Payment Result: %s (%s)", status, txn_id)
+                
+                if state == TransactionState.IPP_PLANS:
+                    # Handle IPP plans selection
+                    self._handle_ipp_plans(response)
+                elif state == TransactionState.COMPLETED:
+                    logger.info("🎉 Payment Successful!")
+                    if "authorization_code" in response:
+                        logger.info("🔑 Auth Code: %s", response['authorization_code'])
+                    if "card_last4" in response:
+                        logger.info("💳 Card: **** **** **** %s", response['card_last4'])
+                else:
+                    logger.warning("❌ Payment Failed: %s", status)
             
             elif message_type == "error":
-                self.is_listening = False
-                print(f"❌ Payment Error: {response.get('message')}")
+                if txn_id:
+                    if self.transactions.transition(txn_id, TransactionState.FAILED, response) is None:
+                        self._ignore_result(txn_id, TransactionState.FAILED, response)
+                        return
+                    failed = [txn_id]
+                else:
+                    # An error without txn_id fails everything the terminal owns
+                    terminal = connection.terminal_id if connection is not None else None
+                    failed = [txn.txn_id for txn in self.transactions.active(terminal)
+                              if self.transactions.transition(txn.txn_id, TransactionState.FAILED, response)]
+                logger.warning("❌ Payment Error: %s (%s)", response.get('message'), ', '.join(failed) or 'no active transaction')
             
             else:
-                print(f"❓ Unknown message type: {message_type}")
+                logger.warning("❓ Unknown message type: %s", message_type)
                 
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON decode error: {e}")
         except Exception as e:
-            print(f"❌ Error handling response: {e}")
+            logger.error("❌ Error handling response: %s", e)
     
-    def send_payment_request(self, payment_mode: str, amount: float) -> bool:
-        """Send payment request to connected POS terminals"""
-        if not self.connected_clients:
-            print("❌ No POS terminals connected")
+    def _ignore_result(self, txn_id: Optional[str], state: TransactionState, response: Dict[str, Any]):
+        """Handle a result that did not apply: unknown transaction, a repeat, or a conflicting outcome
+        
+        Only a repeat of the recorded final state is dropped. A result that
+        contradicts it, e.g. an approval after the Kiosk gave up on a cancel,
+        is kept on the transaction and journalled, and conflict listeners
+        are called, so the payment can be reconciled on the POS.
+        """
+        status = str(response.get("status") or response.get("type") or "unknown")
+        txn = self.transactions.get(txn_id)
+        if txn is None:
+            logger.warning("❓ Result for unknown transaction: %s", txn_id)
+            return
+        if not txn.state.is_final or txn.state == state:
+            metrics.inc("kiosk_duplicate_results_total", status)
+            logger.warning("❓ Duplicate %s result for %s ignored (%s)", status, txn_id, txn.state.value)
+            return
+        
+        txn = self.transactions.record_conflict(txn_id, response)
+        if txn is None:
+            return
+        metrics.inc("kiosk_conflicting_results_total", txn.state.value, state.value)
+        logger.error("❌ %s result for %s contradicts its recorded outcome (%s); kept for reconciliation",
+                     status, txn_id, txn.state.value)
+        for listener in self._conflict_listeners:
+            try:
+                listener(txn, response)
+            except Exception as e:
+                logger.error("❌ Conflict listener failed: %s", e)
+    
+    def add_conflict_listener(self, listener: Callable[[Transaction, Dict[str, Any]], None]):
+        """Subscribe to results that contradict a transaction's recorded final state
+        
+        Listeners get the transaction, whose `conflicts` holds every such
+        result so far, and the new result. They run on the connection's
+        reader (or the event loop), so they must return quickly.
+        """
+        self._conflict_listeners.append(listener)
+    
+    def _open_journal(self):
+        """Open the journal and reinstate the transactions that were unfinished at the last shutdown"""
+        if self.journal is None:
+            return
+        
+        for txn in self.journal.open():
+            if not self.transactions.restore(txn):
+                continue
+            if txn.state == TransactionState.CANCELLING:
+                # The cancel was in flight at the crash; its terminal gets CANCEL_TIMEOUT to answer from now
+                self._arm_cancel_timeout(txn.txn_id)
+            # Keep new ids clear of recovered ones even if the clock went back
+            digits = txn.txn_id[3:]
+            if digits.isdigit():
+                self._last_txn_ms = max(self._last_txn_ms, int(digits))
+            logger.warning("♻️  Recovered unfinished transaction %s: %s RM%.2f [%s] on %s",
+                           txn.txn_id, txn.payment_mode, txn.amount, txn.state.value, txn.terminal)
+    
+    def _close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+    
+    def _open_capture(self):
+        if self.capture is not None:
+            self.capture.open()
+    
+    def _close_capture(self):
+        if self.capture is not None:
+            self.capture.close()
+    
+    def _start_shared(self):
+        """Join the other workers: shared nonces, this worker's control socket, and its recovered transactions"""
+        if self.shared is None:
+            return
+        # Replay protection is process-wide, so the whole process switches to the shared cache
+        SecurityHelper._nonce_cache = SharedNonceCache(self.shared)
+        self.shared.forget_worker()
+        for txn in self.transactions.active():
+            self.shared.record_transaction(txn)
+        self._forwarder = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="kiosk-forward")
+        self.control = ControlServer(self.shared.control_path(self.shared.worker_id), self._handle_control)
+        self.control.start()
+        logger.info("🏬 Worker %s of %s", self.shared.worker_id, self.shared.workers)
+    
+    def _stop_shared(self):
+        if self.shared is None:
+            return
+        if self.control is not None:
+            self.control.stop()
+            self.control = None
+        if self._forwarder is not None:
+            self._forwarder.shutdown(wait=False)
+            self._forwarder = None
+        self.shared.forget_worker()
+    
+    def _forward(self, worker_id: int, request: Dict[str, Any]) -> concurrent.futures.Future:
+        """Hand a request to another worker without blocking the caller
+        
+        The Future resolves with the length of the frame the other worker
+        wrote, or fails with the reason it gave.
+        """
+        def call() -> int:
+            reply = self.shared.call(worker_id, request, self.CONTROL_TIMEOUT * 2)
+            if not reply.get("ok"):
+                raise ConnectionError(reply.get("error") or f"worker {worker_id} refused {request['op']}")
+            if reply.get("txn_id") and request["op"] == "send_payment":
+                self.current_txn_id = reply["txn_id"]
+            return reply.get("written", 0)
+        
+        def done(future: concurrent.futures.Future):
+            if future.exception() is not None:
+                logger.error("❌ Worker %s did not complete %s: %s", worker_id, request["op"], future.exception())
+        
+        metrics.inc("kiosk_forwarded_requests_total", request["op"])
+        logger.info("🏬 Forwarding %s to worker %s", request["op"], worker_id)
+        forwarded = self._forwarder.submit(call)
+        forwarded.add_done_callback(done)
+        return forwarded
+    
+    def _owner_of(self, txn_id: str) -> Optional[int]:
+        """Worker that owns a transaction this worker does not track, in prefork mode"""
+        if self.shared is None or self.transactions.get(txn_id) is not None:
+            return None
+        owner = self.shared.transaction_owner(txn_id)
+        return owner if owner != self.shared.worker_id else None
+    
+    def _handle_control(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Carry out a request forwarded by another worker; runs on a control socket thread"""
+        op = request.get("op")
+        txn_id = request.get("txn_id")
+        if op == "send_payment":
+            handle = self.pay(request["payment_mode"], float(request["amount"]), request.get("terminal_id"),
+                              idempotency_key=request.get("idempotency_key"))
+            if handle is None:
+                return {"ok": False, "error": "no terminal took the payment request"}
+            txn_id, future = handle.txn_id, handle.sent
+        elif op == "cancel":
+            future = self.cancel_transaction(txn_id)
+        elif op == "plan_selection":
+            future = self._send_plan_selection(request["plan_id"], txn_id)
+        elif op == "ipp_plans":
+            self._handle_ipp_plans(request["response"])
+            return {"ok": True}
+        elif op == "release":
+            connection = self.router.get(request.get("terminal_id"))
+            if connection is not None:
+                logger.info("♻️  Terminal %s reconnected to another worker; closing %s",
+                            connection.terminal_id, connection.address)
+                self._drop_client(connection.client)
+            return {"ok": True}
+        else:
+            return {"ok": False, "error": f"unknown op {op!r}"}
+        
+        if future is None:
+            return {"ok": False, "error": f"{op} could not be sent"}
+        return {"ok": True, "txn_id": txn_id, "written": future.result(timeout=self.CONTROL_TIMEOUT)}
+    
+    def reconcile_transaction(self, txn_id: str, state: TransactionState) -> bool:
+        """Record an outcome the operator confirmed on the POS, e.g. for a recovered transaction"""
+        if not state.is_final:
+            raise ValueError(f"Not a final state: {state.value}")
+        
+        txn = self.transactions.transition(txn_id, state, {"type": "reconciled", "status": state.value})
+        if txn is None:
+            logger.warning("❌ No active transaction %s to reconcile", txn_id)
             return False
+        if txn_id == self.current_txn_id:
+            self.current_txn_id = None
+        logger.info("🧾 Transaction %s reconciled as %s", txn_id, state.value)
+        return True
+    
+    def _start_reaper(self):
+        """Run heartbeat checks and plan offer timeouts every wheel tick on a background thread"""
+        self._reaper_stop.clear()
+        self._reaper_thread = threading.Thread(target=self._run_reaper, name="kiosk-reaper")
+        self._reaper_thread.daemon = True
+        self._reaper_thread.start()
+    
+    def _run_reaper(self):
+        while not self._reaper_stop.wait(self.wheel.tick):
+            self._reap_tick()
+    
+    def _reap_tick(self):
+        """Check the connections whose heartbeat deadline has come, and expire plan offers and cancels"""
+        now = time.monotonic()
+        for connection in self.wheel.advance(now):
+            if isinstance(connection, PlanOffer):
+                self._expire_plan_offer(connection, now)
+                continue
+            if isinstance(connection, PaymentHandle):
+                self._check_payment_stage(connection, now)
+                continue
+            if isinstance(connection, PendingCancel):
+                self._expire_cancel(connection, now)
+                continue
+            try:
+                due = self._check_heartbeat(connection, now)
+            except Exception as e:
+                logger.error("❌ Heartbeat check failed for %s: %s", connection.terminal_id, e)
+                due = now + self.wheel.tick
+            if due is not None:
+                self.wheel.schedule(connection, due)
+    
+    def _check_heartbeat(self, connection: PosConnection, now: float) -> Optional[float]:
+        """Ping, mark or reap one connection; returns when to check it next, or None once it is gone"""
+        if self.router.connection_for(connection.client) is not connection:
+            return None
+        
+        idle = now - connection.last_seen
+        if connection.answers_ping and idle >= self.idle_timeout:
+            logger.warning("💀 Terminal %s silent for %.0fs; closing connection", connection.terminal_id, idle)
+            metrics.inc("kiosk_reaped_connections_total", connection.metrics_label)
+            self._drop_client(connection.client)
+            return None
+        
+        # Checked before pinging again, which would restart the pong timer
+        awaiting_pong = connection.last_ping > connection.last_seen
+        if connection.answers_ping and awaiting_pong and now - connection.last_ping >= self.PONG_TIMEOUT:
+            if connection.responsive:
+                logger.warning("💔 Terminal %s did not answer ping; not dispatching to it", connection.terminal_id)
+            connection.responsive = False
+        
+        if idle >= self.heartbeat_interval and now - connection.last_ping >= self.heartbeat_interval:
+            if not self._send_heartbeat(connection, "ping"):
+                return None
+            connection.last_ping = now
+        
+        deadlines = [max(connection.last_seen, connection.last_ping) + self.heartbeat_interval]
+        if connection.answers_ping:
+            deadlines.append(connection.last_seen + self.idle_timeout)
+            if connection.responsive and connection.last_ping > connection.last_seen:
+                deadlines.append(connection.last_ping + self.PONG_TIMEOUT)
+        return max(min(deadlines), now + self.wheel.tick)
+    
+    def _send_heartbeat(self, connection: PosConnection, message_type: str) -> bool:
+        """Queue a signed ping or pong; returns False if the connection was dropped"""
+        try:
+            self._send_message(connection, self._build_message({"type": message_type, "kiosk_id": self.kiosk_id}))
+            return True
+        except Exception as e:
+            self._send_refused(connection, e, message_type)
+            # A full queue leaves the connection open, to be checked again
+            return isinstance(e, BufferError)
+    
+    def _record_latency(self, txn: Transaction):
+        """Registry listener: observe request-to-ACK and request-to-result latency"""
+        if txn.state == TransactionState.ACKED:
+            metrics.observe("kiosk_ack_latency_seconds", txn.updated_at - txn.created_at)
+        elif txn.state.is_final:
+            metrics.observe("kiosk_result_latency_seconds", txn.updated_at - txn.created_at, txn.state.value)
+    
+    def render_metrics(self) -> str:
+        """Prometheus exposition of the shared metrics plus this server's gauges"""
+        outstanding: Dict[Tuple[str, ...], float] = {}
+        queued: Dict[Tuple[str, ...], float] = {}
+        for connection in self.router.connections():
+            key = (connection.metrics_label,)
+            outstanding[key] = outstanding.get(key, 0) + self.transactions.outstanding(connection.terminal_id)
+            queued[key] = queued.get(key, 0) + connection.outbound.pending_bytes
+        
+        return metrics.render({
+            "kiosk_connected_terminals": {(): len(self.router)},
+            "kiosk_active_transactions": {(): len(self.transactions.active())},
+            "kiosk_outstanding_transactions": outstanding,
+            "kiosk_nonce_cache_entries": {(): len(SecurityHelper._nonce_cache)},
+            "kiosk_send_queue_bytes": queued,
+            "kiosk_quarantined_hosts": {(): len(self.admission.quarantined())},
+        })
+    
+    def _next_txn_id(self) -> str:
+        """Generate a TXN<milliseconds> id that is unique within this process
+        
+        In prefork mode each worker only uses the milliseconds congruent to
+        its worker id, so ids stay unique across workers.
+        """
+        with self._txn_lock:
+            txn_ms = max(int(datetime.now().timestamp() * 1000), self._last_txn_ms + 1)
+            if self.shared is not None:
+                txn_ms += (self.shared.worker_id - txn_ms) % self.shared.workers
+            self._last_txn_ms = txn_ms
+        return f"TXN{txn_ms}"
+    
+    def _affinity_candidates(self, txn_id: str) -> List[PosConnection]:
+        """Connections that may receive a follow-up frame for a transaction
+        
+        A transaction's cancel and plan selection go to the terminal that
+        owns it for as long as its connection is open. Responsiveness only
+        steers new payments: a late pong or a rejected frame must not cut
+        a terminal off from its own transaction.
+        """
+        txn = self.transactions.get(txn_id)
+        if txn is None or txn.terminal is None:
+            # Not tracked by this Kiosk: fall back to the dispatch order
+            return self.router.candidates()
+        
+        connection = self.router.get(txn.terminal)
+        if connection is None or connection.outbound.closed:
+            logger.warning("❌ Terminal %s owning %s is not connected", txn.terminal, txn_id)
+            return []
+        return [connection]
+    
+    def send_payment_request(self, payment_mode: str, amount: float, terminal_id: Optional[str] = None,
+                             idempotency_key: Optional[str] = None) -> Optional[concurrent.futures.Future]:
+        """Send payment request to a POS terminal
+        
+        The request goes to terminal_id if given, otherwise to the terminal
+        chosen by the router's dispatch policy. The request is queued, never
+        written on the caller's thread: the returned Future resolves once
+        the frame is written, and the transaction fails if it cannot be.
+        Returns None if no terminal would take the request. In prefork mode,
+        a terminal connected to another worker is reached through it.
+        A retry with the same idempotency_key sends nothing (see pay()).
+        """
+        remote = self._remote_terminal(terminal_id)
+        if remote is not None:
+            return self._forward(remote[1], {"op": "send_payment", "payment_mode": payment_mode,
+                                             "amount": amount, "terminal_id": remote[0],
+                                             "idempotency_key": idempotency_key})
+        if idempotency_key is not None:
+            handle = self.pay(payment_mode, amount, terminal_id, idempotency_key=idempotency_key)
+            return handle.sent if handle is not None else None
+        sent = self._send_payment(payment_mode, amount, terminal_id)
+        return sent[1] if sent is not None else None
+    
+    def pay(self, payment_mode: str, amount: float, terminal_id: Optional[str] = None,
+            ack_timeout: Optional[float] = None, result_timeout: Optional[float] = None,
+            idempotency_key: Optional[str] = None) -> Optional[PaymentHandle]:
+        """Send a payment request and return a handle that resolves with its PaymentResult
+        
+        ack_timeout bounds the wait for the terminal's ACK; result_timeout
+        the wait for the result after the ACK, and again after a plan
+        selection. A stage that runs over cancels the payment. Only this
+        process's terminals are used (this worker's, in prefork mode).
+        Returns None if no terminal took the request.
+        
+        A retry with the idempotency_key of a payment made in the last
+        idempotency.ttl seconds sends nothing: it gets that payment's
+        handle, still running or already resolved. Only a request that was
+        never written to a terminal is sent again. Reusing a key for a
+        different mode or amount raises ValueError.
+        """
+        if idempotency_key is None:
+            return self._start_payment(payment_mode, amount, terminal_id, ack_timeout, result_timeout)
+        
+        # Held across the send, so concurrent retries cannot both miss the cache
+        with self._idempotency_lock:
+            handle = self.idempotency.get(idempotency_key)
+            if handle is not None and handle.sent.done() and (handle.sent.cancelled() or handle.sent.exception()):
+                # The terminal never saw that request, so sending it again cannot charge twice
+                handle = None
+            if handle is None:
+                handle = self._start_payment(payment_mode, amount, terminal_id, ack_timeout, result_timeout)
+                if handle is not None:
+                    self.idempotency.put(idempotency_key, handle)
+                return handle
         
-        self.current_txn_id = f"TXN{int(datetime.now().timestamp() * 1000)}"
+        if (handle.payment_mode, handle.amount) != (payment_mode, amount):
+            raise ValueError(f"Idempotency key {idempotency_key!r} was used for {handle.payment_mode} "
+                             f"RM{handle.amount:.2f} ({handle.txn_id})")
+        metrics.inc("kiosk_idempotent_retries_total")
+        logger.info("🔁 Retry of %s (key %s): %s, not sent again", handle.txn_id, idempotency_key,
+                    "finished" if handle.done() else "still running")
+        return handle
+    
+    def _start_payment(self, payment_mode: str, amount: float, terminal_id: Optional[str],
+                       ack_timeout: Optional[float], result_timeout: Optional[float]) -> Optional[PaymentHandle]:
+        sent = self._send_payment(payment_mode, amount, terminal_id)
+        if sent is None:
+            return None
+        
+        txn_id, future = sent
+        handle = PaymentHandle(self, txn_id, future, ack_timeout, result_timeout, payment_mode, amount)
+        with self._payments_lock:
+            self._payments[txn_id] = handle
+        # The ACK, or even the result, may have arrived before the handle was registered
+        txn = self.transactions.get(txn_id)
+        if txn is not None:
+            self._follow_payment(txn)
+        return handle
+    
+    def _follow_payment(self, txn: Transaction):
+        """Registry listener: move a transaction's PaymentHandle along"""
+        handle = self._payments.get(txn.txn_id)
+        if handle is None:
+            return
+        due = handle._update(txn)
+        if handle.done():
+            with self._payments_lock:
+                self._payments.pop(txn.txn_id, None)
+        elif due is not None:
+            self.wheel.schedule(handle, due)
+    
+    def _check_payment_stage(self, handle: PaymentHandle, now: float):
+        """Cancel a payment whose current stage has outlasted its timeout"""
+        # Cleared before the deadline is read, so a stage change in between schedules its own check
+        handle._due = None
+        deadline = handle.deadline
+        if handle.done() or deadline is None:
+            return
+        if now < deadline:
+            handle._due = deadline
+            self.wheel.schedule(handle, deadline)
+            return
+        
+        stage = "ACK" if handle._state == TransactionState.REQUESTED else "result"
+        handle.timed_out = stage
+        logger.warning("⌛ No %s for %s within %.0fs; cancelling", stage, handle.txn_id,
+                       handle._stage_timeout(handle._state) or 0)
+        if self.cancel_transaction(handle.txn_id) is None:
+            # No terminal to tell, but one that reconnects may still report the outcome
+            self._await_cancel(handle.txn_id)
+    
+    def _abandon_payments(self):
+        """Fail the handles of payments still running when the server stops"""
+        with self._payments_lock:
+            handles = list(self._payments.values())
+            self._payments.clear()
+        for handle in handles:
+            error = ConnectionError(f"Kiosk stopped before {handle.txn_id} finished")
+            with handle._lock:
+                if not handle.acked.done():
+                    handle.acked.set_exception(error)
+                if not handle.future.done():
+                    handle.future.set_exception(error)
+    
+    def _remote_terminal(self, terminal_id: Optional[str]) -> Optional[Tuple[str, int]]:
+        """(terminal_id, worker) to forward a payment to when no terminal of this worker can take it"""
+        if self.shared is None or self.router.candidates(terminal_id):
+            return None
+        if terminal_id is None:
+            return self.shared.least_loaded_terminal()
+        owner = self.shared.terminal_owner(terminal_id)
+        return (terminal_id, owner) if owner is not None and owner != self.shared.worker_id else None
+    
+    def _send_payment(self, payment_mode: str, amount: float,
+                      terminal_id: Optional[str]) -> Optional[Tuple[str, concurrent.futures.Future]]:
+        """Create a transaction and queue its request on one of this worker's terminals"""
+        candidates = self.router.candidates(terminal_id)
+        if not candidates:
+            if terminal_id is not None:
+                logger.warning("❌ POS terminal %s is not connected or not responding", terminal_id)
+            else:
+                logger.warning("❌ No POS terminals connected")
+            return None
+        
+        txn_id = self._next_txn_id()
         
         payment_data = {
             "type": "transaction_request",
-            "txn_id": self.current_txn_id,
+            "txn_id": txn_id,
             "amount": amount,
             "payment_mode": payment_mode,
             "kiosk_id": self.kiosk_id
         }
         
         # Create secure message
-        secure_message = SecurityHelper.create_secure_message(payment_data)
-        message_json = json.dumps(secure_message) + '\n'
+        message = self._build_message(payment_data)
         
-        print(f"📤 Sending {payment_mode} payment request for RM{amount:.2f}")
-        print(f"🆔 Transaction ID: {self.current_txn_id}")
+        logger.info("📤 Sending %s payment request for RM%.2f", payment_mode, amount)
+        logger.info("🆔 Transaction ID: %s", txn_id)
         
-        # Send to all connected clients
-        for client in self.connected_clients[:]:  # Copy list to avoid modification during iteration
+        # Try candidate terminals in dispatch order
+        for connection in candidates:
+            # Register first so a fast ACK always finds the transaction
+            self.transactions.create(txn_id, connection.terminal_id, payment_mode, amount)
             try:
-                client.send(message_json.encode('utf-8'))
-                print(f"✅ Payment request sent to POS terminal")
-                self.is_listening = True
-                return True
+                sent = self._send_message(connection, message)
             except Exception as e:
-                print(f"❌ Failed to send to POS terminal: {e}")
-                if client in self.connected_clients:
-                    self.connected_clients.remove(client)
-                client.close()
+                self._send_refused(connection, e, "payment request")
+                self.transactions.discard(txn_id)
+                continue
+            
+            self.current_txn_id = txn_id
+            self._watch_delivery(txn_id, sent)
+            logger.info("✅ Payment request queued for POS terminal %s", connection.terminal_id)
+            return txn_id, sent
         
-        return False
+        return None
     
-    def cancel_transaction(self) -> bool:
-        """Cancel current transaction"""
-        if not self.current_txn_id:
-            print("❌ No active transaction to cancel")
-            return False
+    def cancel_transaction(self, txn_id: Optional[str] = None) -> Optional[concurrent.futures.Future]:
+        """Cancel a transaction (the current one by default)
         
-        if not self.connected_clients:
-            print("❌ No POS terminals connected")
-            return False
+        The transaction waits in CANCELLING until the terminal confirms the
+        cancel, or sends the result of a payment it had already made, or
+        CANCEL_TIMEOUT passes. Returns the Future of the queued cancel
+        frame, or None if it could not be queued.
+        """
+        txn_id = txn_id or self.current_txn_id
+        if not txn_id:
+            logger.warning("❌ No active transaction to cancel")
+            return None
+        
+        owner = self._owner_of(txn_id)
+        if owner is not None:
+            if txn_id == self.current_txn_id:
+                self.current_txn_id = None
+            return self._forward(owner, {"op": "cancel", "txn_id": txn_id})
+        
+        candidates = self._affinity_candidates(txn_id)
+        if not candidates:
+            logger.warning("❌ No POS terminals connected")
+            return None
         
         cancel_data = {
             "type": "cancel_transaction",
-            "txn_id": self.current_txn_id,
+            "txn_id": txn_id,
             "kiosk_id": self.kiosk_id
         }
         
         # Create secure message
-        secure_message = SecurityHelper.create_secure_message(cancel_data)
-        message_json = json.dumps(secure_message) + '\n'
+        message = self._build_message(cancel_data)
         
-        print(f"🚫 Cancelling transaction: {self.current_txn_id}")
+        logger.info("🚫 Cancelling transaction: %s", txn_id)
         
-        # Send to all connected clients
-        for client in self.connected_clients[:]:
+        # Send to the terminal that owns the transaction
+        for connection in candidates:
             try:
-                client.send(message_json.encode('utf-8'))
-                print(f"✅ Cancel request sent to POS terminal")
-                self.is_listening = False
-                self.current_txn_id = None
-                return True
+                sent = self._send_message(connection, message)
             except Exception as e:
-                print(f"❌ Failed to send cancel request: {e}")
-                if client in self.connected_clients:
-                    self.connected_clients.remove(client)
-                client.close()
+                self._send_refused(connection, e, "cancel request")
+                continue
+            
+            logger.info("✅ Cancel request queued for POS terminal %s", connection.terminal_id)
+            self._await_cancel(txn_id)
+            return sent
         
-        return False
+        return None
+    
+    def _await_cancel(self, txn_id: str):
+        """Move a transaction to CANCELLING and clear it as the current one"""
+        if txn_id == self.current_txn_id:
+            self.current_txn_id = None
+        if self.transactions.transition(txn_id, TransactionState.CANCELLING, expect=(
+                TransactionState.REQUESTED, TransactionState.ACKED,
+                TransactionState.IPP_PLANS, TransactionState.PLAN_SELECTED)) is not None:
+            self._arm_cancel_timeout(txn_id)
+    
+    def _arm_cancel_timeout(self, txn_id: str):
+        """Cancel a CANCELLING transaction on the Kiosk side unless the terminal answers within CANCEL_TIMEOUT"""
+        deadline = time.monotonic() + self.CANCEL_TIMEOUT
+        self.wheel.schedule(PendingCancel(txn_id, deadline), deadline)
     
-    def _handle_ipp_plans(self, response: Dict[str, Any]):
-        """Handle IPP plans selection"""
-        print("💳 IPP Plans received from terminal!")
-        plans = response.get("plans", [])
-        amount = response.get("amount", 0)
+    def _expire_cancel(self, pending: PendingCancel, now: float):
+        """Cancel on the Kiosk side a transaction whose terminal never confirmed the cancel"""
+        if now < pending.deadline:
+            # Beyond the wheel's span; check again later
+            self.wheel.schedule(pending, pending.deadline)
+            return
+        if self.transactions.transition(pending.txn_id, TransactionState.CANCELLED,
+                                        {"type": "error", "message": "cancel not confirmed by the terminal"},
+                                        expect=(TransactionState.CANCELLING,)):
+            logger.warning("⌛ POS did not confirm the cancel of %s within %.0fs; cancelled on the Kiosk only",
+                           pending.txn_id, self.CANCEL_TIMEOUT)
+    
+    def _handle_ipp_plans(self, response: Dict[str, Any], deadline: Optional[float] = None):
+        """Offer the plans in an ipp_plans result for selection; never blocks the reader
+        
+        The plan policy picks one right away if it can. Otherwise the offer
+        waits for select_plan() or decline_plans(), and the payment is
+        cancelled if neither comes within plan_timeout seconds, or by
+        deadline for an offer handed over by a previous process.
+        """
+        offer = PlanOffer.from_response(response, deadline or time.monotonic() + self.plan_timeout)
+        if not offer.plans:
+            logger.warning("❌ No IPP plans offered for %s", offer.txn_id)
+            return
+        logger.info("💳 %d IPP plan(s) offered for %s", len(offer.plans), offer.txn_id)
+        
+        plan_id = None
+        if self.plan_policy is not None:
+            try:
+                plan_id = self.plan_policy(offer)
+            except Exception as e:
+                logger.error("❌ Plan policy failed for %s: %s", offer.txn_id, e)
         
-        if not plans:
-            print("❌ No plans available")
+        if plan_id is None and self.shared is not None and self.shared.worker_id != self.UI_WORKER:
+            # Only the worker running the menu can ask the customer to pick a plan
+            self._forward(self.UI_WORKER, {"op": "ipp_plans", "response": response})
             return
         
-        print(f"💰 Amount: RM{amount:.2f}")
-        print("📋 Available Installment Plans:")
-        print("-" * 50)
+        with self._plan_lock:
+            self._plan_offers[offer.txn_id] = offer
+            waiter = self._plan_waiters.pop(offer.txn_id, None)
+        self.wheel.schedule(offer, offer.deadline)
         
-        for i, plan in enumerate(plans, 1):
-            plan_id = plan.get("planId", "unknown")
-            frequency = plan.get("frequency", "N/A")
-            total_installments = plan.get("totalInstallments", 0)
-            installment_details = plan.get("installmentDetails", [])
-            
-            print(f"{i}. Plan ID: {plan_id}")
-            if frequency:
-                print(f"   Frequency: {frequency}")
-            if total_installments > 0:
-                print(f"   Total Installments: {total_installments}")
-            
-            if installment_details:
-                print("   Installment Details:")
-                for detail in installment_details:
-                    installment_num = detail.get("installmentNumber", "?")
-                    date = detail.get("date", "N/A")
-                    installment_amount = detail.get("amount", 0)
-                    fee = detail.get("installmentFee", 0)
-                    fee_pct = detail.get("installmentFeePercentage", 0)
-                    
-                    print(f"     #{installment_num}: RM{installment_amount:.2f} on {date}")
-                    if fee > 0:
-                        print(f"       Fee: RM{fee:.2f} ({fee_pct:.1f}%)")
-            print()
-        
-        # Get user selection
-        while True:
+        if plan_id is not None:
+            logger.info("🤖 Plan policy selected %s for %s", plan_id, offer.txn_id)
+            self.select_plan(offer.txn_id, plan_id)
+        if waiter is not None and waiter.set_running_or_notify_cancel():
+            waiter.set_result(offer)
+        for listener in self._plan_listeners:
             try:
-                choice = input(f"Select plan (1-{len(plans)}) or 'q' to quit: ").strip().lower()
-                
-                if choice == 'q':
-                    print("❌ IPP payment cancelled")
-                    self.is_listening = False
-                    self.current_txn_id = None
-                    return
-                
-                plan_index = int(choice) - 1
-                if 0 <= plan_index < len(plans):
-                    selected_plan = plans[plan_index]
-                    plan_id = selected_plan.get("planId", "")
-                    
-                    if plan_id:
-                        print(f"✅ Selected Plan: {plan_id}")
-                        self._send_plan_selection(plan_id)
-                        return
-                    else:
-                        print("❌ Invalid plan ID")
-                else:
-                    print(f"❌ Please enter a number between 1 and {len(plans)}")
-                    
-            except ValueError:
-                print("❌ Please enter a valid number or 'q' to quit")
-            except KeyboardInterrupt:
-                print("\n❌ IPP payment cancelled")
-                self.is_listening = False
-                self.current_txn_id = None
+                listener(offer)
+            except Exception as e:
+                logger.error("❌ Plan listener failed: %s", e)
+    
+    def add_plan_listener(self, listener: Callable[[PlanOffer], None]):
+        """Subscribe to IPP plan offers
+        
+        Listeners run on the connection's reader (or the event loop), so
+        they must return quickly; answer the offer later with select_plan()
+        or decline_plans().
+        """
+        self._plan_listeners.append(listener)
+    
+    def plans_for(self, txn_id: str) -> concurrent.futures.Future:
+        """Future that resolves with the PlanOffer for a transaction
+        
+        It is cancelled if the transaction finishes without one.
+        """
+        waiter: concurrent.futures.Future = concurrent.futures.Future()
+        with self._plan_lock:
+            offer = self._plan_offers.get(txn_id)
+            if offer is None:
+                self._plan_waiters[txn_id] = waiter
+        if offer is not None:
+            waiter.set_result(offer)
+        return waiter
+    
+    def pending_plan_offers(self) -> List[PlanOffer]:
+        """Offers still waiting for a selection, oldest first"""
+        with self._plan_lock:
+            return sorted(self._plan_offers.values(), key=lambda offer: offer.offered_at)
+    
+    def select_plan(self, txn_id: str, plan_id: str) -> Optional[concurrent.futures.Future]:
+        """Answer a plan offer; returns the Future of the queued plan selection frame
+        
+        If the selection cannot be queued, e.g. because the terminal has
+        disconnected, the offer stays open until it is answered again or
+        times out.
+        """
+        with self._plan_lock:
+            offer = self._plan_offers.get(txn_id)
+            if offer is None:
+                logger.warning("❌ No IPP plans awaiting selection for %s", txn_id)
+                return None
+            if offer.plan(plan_id) is None:
+                logger.warning("❌ Plan %s was not offered for %s", plan_id, txn_id)
+                return None
+            # Taken out while sending so a second selection cannot go out as well
+            del self._plan_offers[txn_id]
+        
+        sent = self._send_plan_selection(plan_id, txn_id)
+        if sent is not None:
+            offer.selection.set_result(plan_id)
+            return sent
+        
+        with self._plan_lock:
+            # Checked under the lock, so a transaction finishing now still withdraws the offer afterwards
+            txn = self.transactions.get(txn_id)
+            if txn is not None and txn.state == TransactionState.IPP_PLANS:
+                self._plan_offers[txn_id] = offer
+                logger.warning("❌ Plan selection for %s not sent; the offer stays open", txn_id)
+                return None
+        offer.selection.set_result(None)
+        return None
+    
+    def decline_plans(self, txn_id: str) -> Optional[concurrent.futures.Future]:
+        """Refuse every plan offered and cancel the payment; returns the Future of the cancel frame"""
+        with self._plan_lock:
+            offer = self._plan_offers.pop(txn_id, None)
+        if offer is None:
+            logger.warning("❌ No IPP plans awaiting selection for %s", txn_id)
+            return None
+        offer.selection.set_result(None)
+        sent = self.cancel_transaction(txn_id)
+        if sent is None:
+            self._await_cancel(txn_id)
+        return sent
+    
+    def _expire_plan_offer(self, offer: PlanOffer, now: float):
+        """Cancel a payment whose plan offer got no answer in time"""
+        if now < offer.deadline:
+            # Beyond the wheel's span; check again later
+            self.wheel.schedule(offer, offer.deadline)
+            return
+        with self._plan_lock:
+            if self._plan_offers.get(offer.txn_id) is not offer:
                 return
+            del self._plan_offers[offer.txn_id]
+        logger.warning("⌛ No IPP plan selected for %s within %.0fs; cancelling", offer.txn_id, self.plan_timeout)
+        offer.selection.set_result(None)
+        if self.cancel_transaction(offer.txn_id) is None:
+            # No terminal to tell, but one that reconnects may still report the outcome
+            self._await_cancel(offer.txn_id)
     
-    def _send_plan_selection(self, plan_id: str):
-        """Send selected plan to terminal"""
-        if not self.current_txn_id:
-            print("❌ No active transaction")
+    def _withdraw_plan_offer(self, txn: Transaction):
+        """Registry listener: drop the plan offer and waiters of a transaction that has finished or is being cancelled"""
+        if not (txn.state.is_final or txn.discarded or txn.state == TransactionState.CANCELLING):
             return
+        with self._plan_lock:
+            offer = self._plan_offers.pop(txn.txn_id, None)
+            waiter = self._plan_waiters.pop(txn.txn_id, None)
+        if offer is not None:
+            offer.selection.set_result(None)
+        if waiter is not None:
+            waiter.cancel()
+    
+    def _send_plan_selection(self, plan_id: str, txn_id: Optional[str] = None) -> Optional[concurrent.futures.Future]:
+        """Send selected plan to terminal; returns the Future of the queued frame"""
+        txn_id = txn_id or self.current_txn_id
+        if not txn_id:
+            logger.warning("❌ No active transaction")
+            return None
         
-        if not self.connected_clients:
-            print("❌ No POS terminals connected")
-            return
+        owner = self._owner_of(txn_id)
+        if owner is not None:
+            return self._forward(owner, {"op": "plan_selection", "txn_id": txn_id, "plan_id": plan_id})
+        
+        candidates = self._affinity_candidates(txn_id)
+        if not candidates:
+            logger.warning("❌ No POS terminals connected")
+            return None
         
         selection_data = {
             "type": "ipp_plan_selection",
-            "txn_id": self.current_txn_id,
+            "txn_id": txn_id,
             "plan_id": plan_id,
             "kiosk_id": self.kiosk_id
         }
         
         # Create secure message
-        secure_message = SecurityHelper.create_secure_message(selection_data)
-        message_json = json.dumps(secure_message) + '\n'
+        message = self._build_message(selection_data)
         
-        print(f"📤 Sending plan selection: {plan_id}")
+        logger.info("📤 Sending plan selection: %s", plan_id)
         
-        # Send to all connected clients
-        for client in self.connected_clients[:]:
+        # Send to the terminal that owns the transaction
+        for connection in candidates:
             try:
-                client.send(message_json.encode('utf-8'))
-                print(f"✅ Plan selection sent to terminal")
-                print("⏳ Waiting for payment completion...")
-                return
+                sent = self._send_message(connection, message)
             except Exception as e:
-                print(f"❌ Failed to send plan selection: {e}")
-                if client in self.connected_clients:
-                    self.connected_clients.remove(client)
-                client.close()
+                self._send_refused(connection, e, "plan selection")
+                continue
+            
+            self.transactions.transition(txn_id, TransactionState.PLAN_SELECTED)
+            self._watch_delivery(txn_id, sent)
+            logger.info("✅ Plan selection queued for terminal %s", connection.terminal_id)
+            logger.info("⏳ Waiting for payment completion...")
+            return sent
+        
+        return None
+    
+    def _poller(self, sock) -> Optional["select.poll"]:
+        """Poll object for a socket and the wake pipe, or None without a handoff path"""
+        if self._wake is None:
+            return None
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        poller.register(self._wake[0], select.POLLIN)
+        return poller
+    
+    def _readable(self, poller: "select.poll", token: Any) -> bool:
+        """Wait until the socket can be read; False after waiting out a handoff instead"""
+        for fd, _ in poller.poll():
+            if fd == self._wake[0]:
+                with self._handoff_cond:
+                    self._paused.add(token)
+                    self._handoff_cond.notify_all()
+                    self._handoff_cond.wait_for(lambda: not self._pausing)
+                    self._paused.discard(token)
+                return False
+        return True
+    
+    def _close_wake(self):
+        wake, self._wake = self._wake, None
+        if wake is not None:
+            os.close(wake[0])
+            os.close(wake[1])
+    
+    def _take_over(self) -> Optional[Tuple[socket.socket, Dict[str, Any], List[socket.socket]]]:
+        """Receive the sockets and state of the Kiosk serving the handoff path, if there is one"""
+        if self.handoff is None:
+            return None
+        takeover = self.handoff.take_over()
+        if takeover is None:
+            return None
+        
+        channel, snapshot, fds = takeover
+        sockets = [socket.socket(fileno=fd) for fd in fds]
+        try:
+            if "error" in snapshot:
+                raise ConnectionError(f"the running Kiosk cannot hand off: {snapshot['error']}")
+            if len(sockets) != len(snapshot["connections"]) + 1 + bool(snapshot.get("metrics")):
+                raise ValueError(f"{len(sockets)} sockets for {len(snapshot['connections'])} connections")
+            if snapshot["port"] != self.port:
+                raise ValueError(f"the running Kiosk listens on port {snapshot['port']}, not {self.port}")
+            if snapshot["tls"] != (self.tls is not None):
+                raise ValueError("the running Kiosk " + ("uses" if snapshot["tls"] else "does not use") + " TLS")
+            missing = {entry["codec"] for entry in snapshot["connections"]} - set(CODECS)
+            if missing:
+                raise ValueError(f"codec {', '.join(sorted(missing))} is not available")
+        except Exception as e:
+            self._refuse_takeover(channel, sockets, e)
+            raise
+        
+        for entry in snapshot["transactions"]:
+            txn = Transaction.from_dict(entry)
+            if self.transactions.restore(txn) and txn.state == TransactionState.CANCELLING:
+                self._arm_cancel_timeout(txn.txn_id)
+        self.current_txn_id = snapshot["current_txn_id"]
+        self._last_txn_ms = max(self._last_txn_ms, snapshot["last_txn_ms"])
+        self._seen_terminals.update(snapshot["seen_terminals"])
+        if isinstance(SecurityHelper._nonce_cache, NonceReplayCache):
+            SecurityHelper._nonce_cache.load(snapshot["nonces"])
+        for host, seconds in snapshot["quarantined"].items():
+            self.admission.quarantine_host(host, seconds)
+        if snapshot.get("metrics"):
+            self.metrics_socket = sockets.pop()
+        return channel, snapshot, sockets
+    
+    @staticmethod
+    def _refuse_takeover(channel: socket.socket, sockets: List[socket.socket], error: Exception):
+        """Tell the running Kiosk to carry on, and close this process's copies of its sockets"""
+        try:
+            SocketHandoff.send_line(channel, {"ok": False, "error": str(error)})
+        except OSError:
+            pass
+        channel.close()
+        for sock in sockets:
+            sock.close()
+    
+    def _adopt(self, channel: socket.socket, snapshot: Dict[str, Any], sockets: List[socket.socket]):
+        """Serve the sockets taken over, once the previous process has been told to let go of them"""
+        connections = []
+        for entry, sock in zip(snapshot["connections"], sockets[1:]):
+            connection = self._new_connection(sock, entry["address"])
+            connection.connected_at = entry["connected_at"]
+            connection.answers_ping = entry["answers_ping"]
+            connection.rejected = entry["rejected"]
+            connection.codec = CODECS[entry["codec"]]
+            connection.framer = connection.codec.framer(self.max_frame_size)
+            connection.framer.feed(base64.b64decode(entry["partial"]))
+            if self.capture is not None:
+                connection.capture = self.capture
+                self.capture.opened(connection)
+            self.router.register(connection)
+            if entry["terminal_id"] != entry["address"]:
+                self.router.identify(connection, entry["terminal_id"])
+                if connection.capture is not None:
+                    connection.capture.identified(connection)
+            connections.append(connection)
+        
+        try:
+            SocketHandoff.send_line(channel, {"ok": True, "pid": os.getpid()})
+        except OSError as e:
+            # The previous process gave up waiting and carries on with the sockets
+            for connection in connections:
+                self.router.unregister(connection.client)
+            if self.metrics_socket is not None:
+                sockets.append(self.metrics_socket)
+                self.metrics_socket = None
+            self._refuse_takeover(channel, sockets, e)
+            raise ConnectionError(f"the running Kiosk did not wait for the takeover: {e}")
+        channel.close()
+        
+        self.server_socket = sockets[0]
+        for connection in connections:
+            if self.heartbeat_interval:
+                self.wheel.schedule(connection, connection.last_seen + self.heartbeat_interval)
+            self._start_writer(connection)
+            reader_thread = threading.Thread(target=self._handle_client, args=(connection,))
+            reader_thread.daemon = True
+            reader_thread.start()
+        for offer in snapshot["plan_offers"]:
+            self._handle_ipp_plans(offer["response"], time.monotonic() + offer["remaining"])
+        logger.info("🤝 Took over port %s, %s POS connection(s) and %s active transaction(s) from the previous process",
+                    self.port, len(connections), len(self.transactions.active()))
+    
+    def _hand_off(self, channel: socket.socket):
+        """Handoff socket thread: pass the listening socket and POS connections to a new process
+        
+        Accepting and reading pause, send queues are written out, and the
+        snapshot and descriptors go to the new process. Once it confirms,
+        this process drops its copies and sets handed_off; otherwise it
+        carries on serving them.
+        """
+        request = SocketHandoff.read_line(channel)
+        if request.get("op") != "handoff":
+            SocketHandoff.send_line(channel, {"ok": False, "error": f"unknown op {request.get('op')!r}"})
+            return
+        logger.info("🤝 Process %s is taking over; pausing", request.get("pid"))
+        started = time.perf_counter()
+        
+        connections = self._pause_for_handoff()
+        if connections is None:
+            metrics.inc("kiosk_handoffs_total", "failed")
+            logger.error("❌ Handoff failed: POS connections did not pause in time; carrying on")
+            SocketHandoff.send(channel, {"error": "POS connections did not pause in time"}, [])
+            self._resume_after_handoff()
+            return
+        
+        fds = [self.server_socket.fileno()] + [c.client.fileno() for c in connections]
+        metrics_listener = self.metrics_server.listener if self.metrics_server is not None else None
+        if metrics_listener is not None:
+            # The new process serves metrics on the same socket, so scrapes never find the port closed
+            fds.append(metrics_listener.fileno())
+        try:
+            SocketHandoff.send(channel, self._handoff_snapshot(connections, metrics_listener is not None), fds)
+            reply = SocketHandoff.read_line(channel)
+        except (OSError, ValueError) as e:
+            reply = {"ok": False, "error": str(e) or type(e).__name__}
+        if not reply.get("ok"):
+            metrics.inc("kiosk_handoffs_total", "failed")
+            logger.error("❌ Handoff failed: %s; carrying on", reply.get("error"))
+            self._resume_after_handoff()
+            return
+        
+        server_socket, self.server_socket = self.server_socket, None
+        for connection in connections:
+            connection.handed_off = True
+            self.router.unregister(connection.client)
+            if connection.capture is not None:
+                connection.capture.closed(connection, handed_off=True)
+        self._resume_after_handoff()
+        # No shutdown(): the socket is the new process's now, and close() only drops this descriptor
+        server_socket.close()
+        metrics.inc("kiosk_handoffs_total", "completed")
+        logger.info("🤝 Handed off %s POS connection(s) to process %s in %.1f ms",
+                    len(connections), reply.get("pid"), (time.perf_counter() - started) * 1000)
+        self.handed_off.set()
+    
+    def _pause_for_handoff(self) -> Optional[List[PosConnection]]:
+        """Stop accepting, reading and writing; returns the connections to hand off, or None on timeout"""
+        with self._handoff_cond:
+            self._pausing = True
+        self._reaper_stop.set()
+        if self._reaper_thread is not None:
+            self._reaper_thread.join(self.HANDOFF_TIMEOUT)
+        os.write(self._wake[1], b"\0")
+        
+        deadline = time.monotonic() + self.HANDOFF_TIMEOUT
+        connections = []
+        for connection in self.router.connections():
+            # No new payments go out while the handoff is under way
+            connection.responsive = False
+            if isinstance(connection.client, TlsStream):
+                # A TLS session cannot leave this process; its terminal reconnects to the new one
+                self._drain(connection, deadline)
+                self._drop_client(connection.client)
+            else:
+                connections.append(connection)
+        
+        def paused() -> bool:
+            return self in self._paused and all(connection in self._paused for connection in connections
+                                                if self.router.connection_for(connection.client) is connection)
+        
+        with self._handoff_cond:
+            if not self._handoff_cond.wait_for(paused, max(deadline - time.monotonic(), 0)):
+                return None
+        
+        handed = []
+        for connection in connections:
+            if self.router.connection_for(connection.client) is not connection:
+                continue
+            # A read that finished after the first pass marked it responsive again
+            connection.responsive = False
+            if self._drain(connection, deadline):
+                handed.append(connection)
+            else:
+                logger.warning("⏳ POS terminal %s is not reading; closing it instead of handing it off",
+                               connection.terminal_id)
+                self._drop_client(connection.client)
+        if self.journal is not None:
+            self.journal.wait(timeout=max(deadline - time.monotonic(), 0))
+        return handed
+    
+    def _drain(self, connection: PosConnection, deadline: float) -> bool:
+        """Write out a connection's send queue and stop its writer; False if it is still writing at deadline"""
+        while connection.outbound.pending_bytes and time.monotonic() < deadline:
+            time.sleep(0.005)
+        connection.outbound.close(ConnectionError("connection is being handed off"))
+        if connection.writer is not None:
+            connection.writer.join(max(deadline - time.monotonic(), 0))
+            return not connection.writer.is_alive()
+        return True
+    
+    def _handoff_snapshot(self, connections: List[PosConnection], metrics_listener: bool = False) -> Dict[str, Any]:
+        """State that goes with the sockets: everything a payment in progress needs"""
+        now = time.monotonic()
+        cache = SecurityHelper._nonce_cache
+        return {
+            "port": self.port,
+            "tls": self.tls is not None,
+            "connections": [{
+                "address": connection.address,
+                "terminal_id": connection.terminal_id,
+                "codec": connection.codec.name,
+                "connected_at": connection.connected_at,
+                "answers_ping": connection.answers_ping,
+                "rejected": connection.rejected,
+                "partial": base64.b64encode(connection.framer.partial()).decode('ascii'),
+            } for connection in connections],
+            "transactions": [txn.to_dict() for txn in self.transactions.finished() + self.transactions.active()],
+            "current_txn_id": self.current_txn_id,
+            "last_txn_ms": self._last_txn_ms,
+            "seen_terminals": sorted(self._seen_terminals),
+            "plan_offers": [{"response": offer.response, "remaining": max(offer.deadline - now, 0)}
+                            for offer in self.pending_plan_offers()],
+            "nonces": cache.entries() if isinstance(cache, NonceReplayCache) else [],
+            "quarantined": self.admission.quarantined(),
+            "metrics": metrics_listener,
+        }
+    
+    def _resume_after_handoff(self):
+        """Serve the connections still registered again: new send queues and writers, then reading"""
+        for connection in self.router.connections():
+            if connection.outbound.closed and not isinstance(connection.client, TlsStream):
+                connection.outbound = OutboundQueue(self.send_queue_bytes)
+                self._start_writer(connection)
+            connection.responsive = True
+        os.read(self._wake[0], 1)
+        with self._handoff_cond:
+            self._pausing = False
+            self._handoff_cond.notify_all()
+        if self.server_socket is not None:
+            self._start_reaper()
     
     def stop_server(self):
         """Stop the TCP server"""
-        self.is_listening = False
+        self._reaper_stop.set()
+        if self.handoff is not None:
+            self.handoff.stop()
+        
+        # Close the server socket first, so terminals that reconnect at once are refused.
+        # close() alone does not wake a thread blocked in accept(); shutdown() does
+        server_socket, self.server_socket = self.server_socket, None
+        if server_socket:
+            try:
+                server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            server_socket.close()
         
         # Close all client connections
-        for client in self.connected_clients[:]:
-            client.close()
-        self.connected_clients.clear()
+        for connection in self.router.connections():
+            self.router.unregister(connection.client)
+            connection.outbound.close()
+            self._close_client(connection.client)
+        
+        self._abandon_payments()
+        self._stop_shared()
+        self._close_capture()
+        self._close_journal()
+        self._close_wake()
+        logger.info("🔴 Server stopped")
+
+
+class AsyncTcpSender(TcpSender):
+    """asyncio-based TCP Sender: serves every POS connection on a single event loop
+    
+    Message handling and the send APIs are inherited from TcpSender; only the
+    transport differs. The event loop runs in a background thread so the send
+    APIs can still be called from the interactive menu or any other thread.
+    
+    Connections are accepted on the loop by the sender itself rather than by
+    asyncio.start_server, so a quarantined host is refused before its TLS
+    handshake begins; admitted sockets are handed to connect_accepted_socket.
+    
+    Prefork mode is not supported: SharedState answers every nonce check and
+    hello with a blocking SQLite call, which would stall every connection on
+    the loop, so passing `shared` raises ValueError.
+    """
+    
+    def __init__(self, host: str = "0.0.0.0", port: int = 8080,
+                 max_frame_size: int = DEFAULT_MAX_FRAME_SIZE,
+                 dispatch_policy: str = TerminalRouter.FIRST,
+                 heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL,
+                 idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+                 journal: Optional[TransactionJournal] = None,
+                 send_queue_bytes: int = DEFAULT_SEND_QUEUE_BYTES,
+                 shared: Optional[SharedState] = None,
+                 plan_policy: Optional[PlanPolicy] = None,
+                 plan_timeout: float = DEFAULT_PLAN_TIMEOUT,
+                 tls: Optional[ssl.SSLContext] = None, capture: Optional[TrafficCapture] = None,
+                 admission: Optional[AdmissionControl] = None, backlog: int = 1024):
+        if shared is not None:
+            raise ValueError("AsyncTcpSender cannot use SharedState; run prefork workers with TcpSender")
+        super().__init__(host, port, max_frame_size, dispatch_policy, heartbeat_interval, idle_timeout,
+                         journal, send_queue_bytes, shared, plan_policy, plan_timeout, tls, capture, admission)
+        self.backlog = backlog
+        self._draining: Set[PosConnection] = set()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._listener: Optional[socket.socket] = None
+        # The loop keeps only weak references to tasks
+        self._connection_tasks: Set[asyncio.Task] = set()
+        self._loop_thread: Optional[threading.Thread] = None
+        self._reaper_handle: Optional[asyncio.TimerHandle] = None
+    
+    def start_server(self) -> bool:
+        """Start the event loop thread and the asyncio TCP server"""
+        try:
+            self._open_journal()
+            self._open_capture()
+            self._start_shared()
+            self.loop = asyncio.new_event_loop()
+            self._loop_thread = threading.Thread(target=self._run_loop)
+            self._loop_thread.daemon = True
+            self._loop_thread.start()
+            
+            future = asyncio.run_coroutine_threadsafe(self._start(), self.loop)
+            future.result()
+            self._start_reaper()
+            
+            local_ip = self.get_local_ip()
+            logger.info("🚀 Server started on %s:%s (asyncio%s)", local_ip, self.port, ", TLS" if self.tls else "")
+            logger.info("📱 Connect your POS terminal to: %s:%s", local_ip, self.port)
+            
+            return True
+            
+        except Exception as e:
+            logger.error("❌ Failed to start server: %s", e)
+            self._stop_loop()
+            self._stop_shared()
+            self._close_capture()
+            self._close_journal()
+            return False
+    
+    def _run_loop(self):
+        """Run the event loop until stop_server is called"""
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+    
+    async def _start(self):
+        """Bind the listening socket and accept from it on the event loop"""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((self.host, self.port))
+            listener.listen(self.backlog)
+            listener.setblocking(False)
+        except OSError:
+            listener.close()
+            raise
+        self._listener = listener
+        self.loop.add_reader(listener.fileno(), self._accept_ready)
+    
+    def _accept_ready(self):
+        """Accept every waiting connection, refusing quarantined hosts before any TLS handshake"""
+        for _ in range(self.backlog):
+            try:
+                client_socket, addr = self._listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Out of file descriptors, say: pause rather than spin on a readable listener
+                logger.error("❌ Connection error: %s", e)
+                self.loop.remove_reader(self._listener.fileno())
+                self.loop.call_later(1.0, self._resume_accepting)
+                return
+            
+            if not self.admission.admit_host(addr[0]):
+                client_socket.close()
+                continue
+            client_socket.setblocking(False)
+            task = self.loop.create_task(self._open_connection(client_socket, addr))
+            self._connection_tasks.add(task)
+            task.add_done_callback(self._connection_tasks.discard)
+    
+    def _resume_accepting(self):
+        if self._listener is not None:
+            self.loop.add_reader(self._listener.fileno(), self._accept_ready)
+    
+    async def _open_connection(self, client_socket: socket.socket, addr):
+        """Complete any TLS handshake on an admitted socket, then serve it as a stream"""
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        started = time.perf_counter()
+        try:
+            transport, _ = await self.loop.connect_accepted_socket(
+                lambda: protocol, client_socket, ssl=self.tls,
+                ssl_handshake_timeout=self.TLS_HANDSHAKE_TIMEOUT if self.tls else None
+            )
+        except OSError as e:
+            if self.tls is not None:
+                metrics.inc("kiosk_tls_handshake_failures_total")
+                logger.warning("🔒 TLS handshake with %s:%s failed: %s", addr[0], addr[1], e)
+            else:
+                logger.error("❌ Connection error: %s", e)
+            client_socket.close()
+            return
+        
+        writer = asyncio.StreamWriter(transport, protocol, reader, self.loop)
+        await self._handle_connection(reader, writer, time.perf_counter() - started)
+    
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                 handshake_time: Optional[float] = None):
+        """Handle messages from one POS connection"""
+        if self.heartbeat_interval:
+            configure_keepalive(writer.get_extra_info("socket"), self.heartbeat_interval)
+        connection = self._register_client(writer, writer.get_extra_info("peername"))
+        if self.tls is not None:
+            self._tls_established(connection, writer.get_extra_info("ssl_object"), handshake_time)
         
-        # Close server socket
-        if self.server_socket:
-            self.server_socket.close()
-            self.server_socket = None
+        while self.router.connection_for(writer) is connection:
+            try:
+                data = await reader.read(self.RECV_SIZE)
+                if not data:
+                    break
+                
+                self._handle_data(connection, data)
+                
+            except Exception as e:
+                logger.error("❌ Client handling error: %s", e)
+                break
         
-        print("🔴 Server stopped")
+        # Clean up
+        self.router.unregister(writer)
+        self._connection_closed(connection)
+        writer.close()
+        logger.info("🔌 Client %s (%s) disconnected", connection.terminal_id, connection.address)
+    
+    def _start_reaper(self):
+        """Run heartbeat checks and plan offer timeouts every wheel tick on the event loop"""
+        self.loop.call_soon_threadsafe(self._schedule_reap)
+    
+    def _schedule_reap(self):
+        self._reaper_handle = self.loop.call_later(self.wheel.tick, self._run_reap)
+    
+    def _run_reap(self):
+        self._reap_tick()
+        self._schedule_reap()
+    
+    def _new_connection(self, client: asyncio.StreamWriter, address: str) -> PosConnection:
+        connection = super()._new_connection(client, address)
+        connection.outbound.on_ready = lambda: self.loop.call_soon_threadsafe(self._flush_outbound, connection)
+        return connection
+    
+    def _flush_outbound(self, connection: PosConnection):
+        """Write everything queued for a connection as one transport write (event loop only)"""
+        if connection in self._draining:
+            # The running drain flushes again once the transport has caught up
+            return
+        batch = connection.outbound.take()
+        if not batch:
+            return
+        
+        writer = connection.client
+        try:
+            if writer.is_closing():
+                raise ConnectionError("connection is closed")
+            writer.write(b"".join(frame for frame, _ in batch))
+        except Exception as e:
+            self._write_failed(connection, batch, e)
+            return
+        
+        if writer.transport.get_write_buffer_size() == 0:
+            self._written(batch)
+        else:
+            self._draining.add(connection)
+            self.loop.create_task(self._drain(connection, batch))
+    
+    async def _drain(self, connection: PosConnection, batch):
+        """Wait for a slow terminal to take a buffered write, then send what queued meanwhile"""
+        try:
+            await connection.client.drain()
+        except Exception as e:
+            self._write_failed(connection, batch, e)
+            return
+        finally:
+            self._draining.discard(connection)
+        self._written(batch)
+        self._flush_outbound(connection)
+    
+    def _close_client(self, client: asyncio.StreamWriter):
+        """Close a client connection from the event loop"""
+        self.loop.call_soon_threadsafe(client.close)
+    
+    async def _shutdown(self):
+        """Close the listener and every client connection"""
+        if self._reaper_handle:
+            self._reaper_handle.cancel()
+            self._reaper_handle = None
+        
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            self.loop.remove_reader(listener.fileno())
+            listener.close()
+        
+        for connection in self.router.connections():
+            self.router.unregister(connection.client)
+            connection.outbound.close()
+            if self.tls is not None:
+                # A TLS close waits for the terminal's close_notify; do not wait for it here
+                connection.client.transport.abort()
+            else:
+                connection.client.close()
+        # Let the connection handlers see their streams close
+        for _ in range(3):
+            await asyncio.sleep(0)
+    
+    def _stop_loop(self):
+        """Stop the event loop and wait for its thread to exit"""
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self._loop_thread:
+            self._loop_thread.join(timeout=5)
+            self._loop_thread = None
+    
+    def stop_server(self):
+        """Stop the asyncio TCP server"""
+        if self.loop and self.loop.is_running():
+            future = asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+            try:
+                future.result(timeout=5)
+            except Exception as e:
+                logger.error("❌ Error during shutdown: %s", e)
+        self._stop_loop()
+        
+        self._abandon_payments()
+        self._stop_shared()
+        self._close_capture()
+        self._close_journal()
+        logger.info("🔴 Server stopped")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="MobyPay Kiosk TCP Sender")
+    parser.add_argument("--port", type=int, help="TCP port to listen on (prompted if omitted)")
+    parser.add_argument(
+        "--dispatch",
+        choices=TerminalRouter.POLICIES,
+        default=TerminalRouter.FIRST,
+        help="terminal chosen for payments that do not name one"
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="INFO",
+        help="DEBUG shows every frame and each security check"
+    )
+    parser.add_argument("--log-json", metavar="PATH", help="also write logs to PATH as JSON lines")
+    parser.add_argument(
+        "--engine",
+        choices=["thread", "asyncio"],
+        default="thread",
+        help="connection engine: thread per POS connection, or one asyncio event loop"
+    )
+    parser.add_argument(
+        "--heartbeat",
+        type=float,
+        default=DEFAULT_HEARTBEAT_INTERVAL,
+        help="seconds of silence before an idle terminal is pinged (0 disables heartbeats)"
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=DEFAULT_IDLE_TIMEOUT,
+        help="seconds of silence before a terminal that answers pings is disconnected"
+    )
+    parser.add_argument("--journal", metavar="DIR", help="keep a crash-safe transaction journal in DIR")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this port at /metrics")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="address for the metrics endpoint")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="worker processes accepting on the same port with SO_REUSEPORT (thread engine only; worker 0 runs the menu)"
+    )
+    parser.add_argument(
+        "--state-dir",
+        metavar="DIR",
+        help="shared state of the workers (default: mobypay-kiosk-PORT in the temp directory)"
+    )
+    parser.add_argument("--tls-cert", metavar="PEM", help="accept POS connections over TLS with this certificate chain")
+    parser.add_argument("--tls-key", metavar="PEM", help="private key for --tls-cert, if not in the same file")
+    parser.add_argument(
+        "--tls-ca",
+        metavar="PEM",
+        help="require POS terminals to present a client certificate signed by this CA (mutual TLS)"
+    )
+    parser.add_argument(
+        "--capture",
+        metavar="DIR",
+        help="record every frame to and from the terminals in DIR, for replay_capture.py"
+    )
+    parser.add_argument(
+        "--handoff",
+        metavar="PATH",
+        help="Unix socket for restarts without dropping terminals: a Kiosk started later with the same PATH "
+             "takes over this one's port, POS connections and transactions, and this one exits"
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=DEFAULT_RATE_LIMIT,
+        help="frames per second a POS connection may send on average; more are dropped unread (0 disables)"
+    )
+    parser.add_argument(
+        "--rate-burst",
+        type=int,
+        default=DEFAULT_RATE_BURST,
+        help="frames a POS connection may send at once before --rate-limit applies"
+    )
+    parser.add_argument(
+        "--quarantine",
+        type=float,
+        default=DEFAULT_QUARANTINE_SECONDS,
+        help="seconds a host is refused after one of its connections is closed for repeated bad frames"
+    )
+    args = parser.parse_args(argv)
+    if (args.tls_key or args.tls_ca) and not args.tls_cert:
+        parser.error("--tls-key and --tls-ca need --tls-cert")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.rate_limit < 0 or args.rate_burst < 1 or args.quarantine < 0:
+        parser.error("--rate-limit and --quarantine cannot be negative, and --rate-burst must be at least 1")
+    if args.workers > 1 and args.engine != "thread":
+        parser.error("--workers needs --engine thread: workers share state through blocking SQLite calls")
+    if args.workers > 1 and not (hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")):
+        parser.error("--workers needs fork() and SO_REUSEPORT, which this platform does not have")
+    if args.handoff and (args.engine != "thread" or args.workers > 1):
+        parser.error("--handoff needs --engine thread and a single worker")
+    if args.handoff and not (hasattr(socket, "AF_UNIX") and hasattr(socket, "SCM_RIGHTS")):
+        parser.error("--handoff needs Unix sockets with SCM_RIGHTS, which this platform does not have")
+    return args
+
+
+def build_sender(args: argparse.Namespace, port: int, worker_id: int = 0,
+                 tls: Optional[ssl.SSLContext] = None) -> TcpSender:
+    """Sender for one worker, configured from the command line"""
+    sender_class = AsyncTcpSender if args.engine == "asyncio" else TcpSender
+    journal_dir = args.journal
+    capture_dir = args.capture
+    shared = None
+    if args.workers > 1:
+        # Each worker replays only its own journal, so one never recovers another's transactions
+        journal_dir = journal_dir and os.path.join(journal_dir, f"worker-{worker_id}")
+        capture_dir = capture_dir and os.path.join(capture_dir, f"worker-{worker_id}")
+        shared = SharedState(args.state_dir, worker_id, args.workers)
+    journal = TransactionJournal(journal_dir) if journal_dir else None
+    capture = TrafficCapture(capture_dir) if capture_dir else None
+    admission = AdmissionControl(args.rate_limit, args.rate_burst, quarantine_seconds=args.quarantine)
+    # Only the thread engine takes a handoff path; parse_args refuses it with asyncio
+    options = {"handoff": SocketHandoff(args.handoff)} if args.handoff else {}
+    return sender_class(port=port, dispatch_policy=args.dispatch, heartbeat_interval=args.heartbeat,
+                        idle_timeout=args.idle_timeout, journal=journal, shared=shared, tls=tls,
+                        capture=capture, admission=admission, **options)
+
+
+def start_metrics_server(sender: TcpSender, args: argparse.Namespace,
+                         worker_id: int = 0) -> Optional[MetricsServer]:
+    """Serve the sender's metrics if --metrics-port is set; worker N listens on that port + N
+    
+    After a handoff, the endpoint is served on the listening socket taken
+    over from the previous process, which still holds the port.
+    """
+    taken_over, sender.metrics_socket = sender.metrics_socket, None
+    port = args.metrics_port + worker_id if args.metrics_port else None
+    if taken_over is not None and taken_over.getsockname()[1] != port:
+        logger.warning("📈 The previous process served metrics on port %s; not taking it over",
+                       taken_over.getsockname()[1])
+        taken_over.close()
+        taken_over = None
+    if port is None:
+        return None
+    metrics_server = MetricsServer(sender.render_metrics, args.metrics_host, port)
+    try:
+        metrics_server.start(taken_over)
+    except OSError as e:
+        logger.error("❌ Failed to start metrics endpoint: %s", e)
+        return None
+    sender.metrics_server = metrics_server
+    return metrics_server
+
+
+def run_worker(args: argparse.Namespace, port: int, worker_id: int,
+               tls: Optional[ssl.SSLContext] = None) -> int:
+    """Serve terminals in a forked worker until the parent stops it; returns the exit status"""
+    # Ctrl+C reaches the whole process group; only the menu process decides to shut down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    sys.stdin = open(os.devnull)
+    parent = os.getppid()
+    
+    log_listener = configure_logging(getattr(logging, args.log_level), args.log_json, worker=worker_id)
+    sender = build_sender(args, port, worker_id, tls)
+    if not sender.start_server():
+        log_listener.stop()
+        return 1
+    
+    metrics_server = start_metrics_server(sender, args, worker_id)
+    try:
+        # A parent killed without the chance to stop its workers leaves them orphaned
+        while not stop.wait(1.0) and os.getppid() == parent:
+            pass
+    finally:
+        if metrics_server:
+            metrics_server.stop()
+        sender.stop_server()
+        log_listener.stop()
+    return 0
+
+
+def run_prefork(args: argparse.Namespace, port: int, tls: Optional[ssl.SSLContext] = None) -> List[int]:
+    """Fork workers 1..N-1; the calling process carries on as worker 0
+    
+    Must run before any thread is started or SQLite connection opened, as
+    neither survives fork(). Workers inherit the TLS context, and with it
+    the keys of its session tickets. Returns the workers' process IDs.
+    """
+    SharedState.initialize(args.state_dir)
+    # Anything still buffered would otherwise be printed again by every child
+    sys.stdout.flush()
+    sys.stderr.flush()
+    
+    children = []
+    for worker_id in range(1, args.workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                status = run_worker(args, port, worker_id, tls)
+            finally:
+                os._exit(status)
+        children.append(pid)
+    return children
+
+
+def stop_workers(children: List[int]):
+    """Ask every worker to stop and wait for it to exit"""
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in children:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+
+def exit_after_handoff(sender: TcpSender):
+    """Interrupt the menu once a new process has taken over the sender's sockets"""
+    sender.handed_off.wait()
+    print("\n🤝 A new Kiosk process has taken over")
+    os.kill(os.getpid(), signal.SIGINT)
+
+
+def prompt_terminal(sender: TcpSender) -> Optional[str]:
+    """Ask which terminal to use when more than one is connected"""
+    connected = len(sender.shared.terminals()) if sender.shared else len(sender.router)
+    if connected < 2:
+        return None
+    terminal_id = input(f"Terminal ID (Enter for {sender.router.policy} dispatch): ").strip()
+    return terminal_id or None
+
+
+def reconcile_menu(sender: TcpSender):
+    """Let the operator settle an active transaction after checking it on the POS"""
+    active = sender.transactions.active()
+    if not active:
+        print("✅ No active transactions")
+        return
+    
+    for i, txn in enumerate(active, 1):
+        started = datetime.fromtimestamp(txn.created_at).strftime("%Y-%m-%d %H:%M:%S")
+        print(f"{i}. {txn.txn_id}: {txn.payment_mode} RM{txn.amount:.2f} [{txn.state.value}] "
+              f"on {txn.terminal or 'unknown terminal'}, started {started}")
+    
+    choice = input(f"Transaction to reconcile (1-{len(active)}, Enter to go back): ").strip()
+    if not choice.isdigit() or not 1 <= int(choice) <= len(active):
+        return
+    txn = active[int(choice) - 1]
+    
+    outcome = input("Outcome on the POS - (c)ompleted, (f)ailed, or (x) cancel on the POS: ").strip().lower()
+    if outcome == "c":
+        sender.reconcile_transaction(txn.txn_id, TransactionState.COMPLETED)
+    elif outcome == "f":
+        sender.reconcile_transaction(txn.txn_id, TransactionState.FAILED)
+    elif outcome == "x":
+        sender.cancel_transaction(txn.txn_id)
+    else:
+        print("❌ Invalid option")
+
+
+def print_plan_offer(offer: PlanOffer):
+    """Show the plans of an offer, numbered for selection"""
+    print(f"💰 Amount: RM{offer.amount:.2f}")
+    print("📋 Available Installment Plans:")
+    print("-" * 50)
+    
+    for i, plan in enumerate(offer.plans, 1):
+        print(f"{i}. Plan ID: {plan.plan_id}")
+        if plan.frequency:
+            print(f"   Frequency: {plan.frequency}")
+        if plan.total_installments > 0:
+            print(f"   Total Installments: {plan.total_installments}")
+        
+        if plan.installments:
+            print("   Installment Details:")
+            for detail in plan.installments:
+                installment_num = detail.get("installmentNumber", "?")
+                date = detail.get("date", "N/A")
+                installment_amount = detail.get("amount", 0)
+                fee = detail.get("installmentFee", 0)
+                fee_pct = detail.get("installmentFeePercentage", 0)
+                
+                print(f"     #{installment_num}: RM{installment_amount:.2f} on {date}")
+                if fee > 0:
+                    print(f"       Fee: RM{fee:.2f} ({fee_pct:.1f}%)")
+        print()
+
+
+def announce_plan_offer(offer: PlanOffer):
+    """Plan listener for the menu: tell the operator a selection is waiting"""
+    if offer.selection.done():
+        return
+    remaining = max(offer.deadline - time.monotonic(), 0)
+    print(f"\n💳 IPP Plans received for {offer.txn_id}! Choose one with option 8 "
+          f"within {remaining:.0f}s, or the payment is cancelled")
+
+
+def plan_menu(sender: TcpSender):
+    """Let the operator pick the plan for a waiting IPP offer"""
+    offers = sender.pending_plan_offers()
+    if not offers:
+        print("✅ No IPP plans awaiting selection")
+        return
+    
+    offer = offers[0]
+    if len(offers) > 1:
+        for i, pending in enumerate(offers, 1):
+            print(f"{i}. {pending.txn_id}: RM{pending.amount:.2f}, {len(pending.plans)} plan(s)")
+        choice = input(f"Transaction (1-{len(offers)}, Enter to go back): ").strip()
+        if not choice.isdigit() or not 1 <= int(choice) <= len(offers):
+            return
+        offer = offers[int(choice) - 1]
+    
+    print_plan_offer(offer)
+    while True:
+        choice = input(f"Select plan (1-{len(offer.plans)}) or 'q' to cancel the payment: ").strip().lower()
+        if offer.selection.done():
+            print("❌ This offer is no longer waiting for a selection")
+            return
+        if choice == 'q':
+            print("❌ IPP payment cancelled")
+            sender.decline_plans(offer.txn_id)
+            return
+        if choice.isdigit() and 1 <= int(choice) <= len(offer.plans):
+            plan_id = offer.plans[int(choice) - 1].plan_id
+            print(f"✅ Selected Plan: {plan_id}")
+            sender.select_plan(offer.txn_id, plan_id)
+            return
+        print(f"❌ Please enter a number between 1 and {len(offer.plans)} or 'q' to cancel")
+
+
+def print_metrics_summary():
+    """Metrics section of the status screen"""
+    elapsed = max(time.time() - metrics.started_at, 1e-6)
+    print("📈 Metrics:")
+    
+    frames = metrics.counter_values("kiosk_frames_received_total")
+    for (terminal,), count in sorted(frames.items()):
+        print(f"   Frames from {terminal}: {count} ({count / elapsed:.2f}/s)")
+    
+    failures = metrics.counter_values("kiosk_validation_failures_total")
+    details = ", ".join(f"{reason}: {count}" for (reason,), count in sorted(failures.items()))
+    print(f"   Validation failures: {sum(failures.values())}" + (f" ({details})" if details else ""))
+    
+    for name, label in (("kiosk_ack_latency_seconds", "Request → ACK"),
+                        ("kiosk_result_latency_seconds", "Request → result"),
+                        ("kiosk_signature_verify_seconds", "Signature check")):
+        p50, p95 = metrics.quantile(name, 0.5), metrics.quantile(name, 0.95)
+        if p50 is None:
+            print(f"   {label}: no samples")
+        else:
+            print(f"   {label}: p50 ≈ {p50 * 1000:.3f} ms, p95 ≈ {p95 * 1000:.3f} ms")
+    
+    rejections = metrics.counter_values("kiosk_admission_rejections_total")
+    details = ", ".join(f"{reason}: {count}" for (reason,), count in sorted(rejections.items()))
+    quarantines = sum(metrics.counter_values("kiosk_quarantines_total").values())
+    refusals = sum(metrics.counter_values("kiosk_quarantine_refusals_total").values())
+    print(f"   Rejected frames: {sum(rejections.values())}" + (f" ({details})" if details else "")
+          + f", connections quarantined: {quarantines}, refused: {refusals}")
+    
+    duplicates = sum(metrics.counter_values("kiosk_duplicate_results_total").values())
+    conflicts = metrics.counter_values("kiosk_conflicting_results_total")
+    details = ", ".join(f"{reported} after {recorded}: {count}" for (recorded, reported), count in sorted(conflicts.items()))
+    print(f"   Duplicate results: {duplicates}, conflicting: {sum(conflicts.values())}"
+          + (f" ({details})" if details else ""))
+    
+    send_failures = sum(metrics.counter_values("kiosk_send_failures_total").values())
+    reconnects = sum(metrics.counter_values("kiosk_reconnects_total").values())
+    print(f"   Send failures: {send_failures}, reconnects: {reconnects}")
 
 
 def main():
     """Main function for interactive TCP sender"""
+    args = parse_args()
+    
     print("🏪 MobyPay Kiosk TCP Sender")
     print("=" * 40)
     
     # Get server configuration
-    port = input("Enter port (default 8080): ").strip()
-    port = int(port) if port else 8080
+    port = args.port
+    if port is None:
+        port = input("Enter port (default 8080): ").strip()
+        port = int(port) if port else 8080
+    
+    tls = None
+    if args.tls_cert:
+        try:
+            tls = create_tls_context(args.tls_cert, args.tls_key, args.tls_ca, require_client_cert=bool(args.tls_ca))
+        except (OSError, ssl.SSLError, ValueError) as e:
+            print(f"❌ Failed to load TLS certificate: {e}")
+            return
+    
+    # Workers are forked before the logging thread starts
+    children = []
+    if args.workers > 1:
+        args.state_dir = args.state_dir or os.path.join(tempfile.gettempdir(), f"mobypay-kiosk-{port}")
+        children = run_prefork(args, port, tls)
+    log_listener = configure_logging(getattr(logging, args.log_level), args.log_json,
+                                     worker=0 if children else None)
     
     # Create and start server
-    sender = TcpSender(port=port)
+    sender = build_sender(args, port, tls=tls)
     
     if not sender.start_server():
         print("❌ Failed to start server")
+        stop_workers(children)
+        log_listener.stop()
         return
     
+    metrics_server = start_metrics_server(sender, args)
+    sender.add_plan_listener(announce_plan_offer)
+    if args.handoff:
+        threading.Thread(target=exit_after_handoff, args=(sender,), daemon=True).start()
+    
     try:
         while True:
             print("\n📋 Available Commands:")
@@ -515,25 +2357,27 @@ def main():
             print("4. 🏦 Internet Banking (IPP)")
             print("5. 🚫 Cancel Transaction")
             print("6. ℹ️  Show Status")
-            print("7. 🔴 Exit")
+            print("7. 🧾 Reconcile Transaction")
+            print("8. 📑 Select IPP Plan")
+            print("9. 🔴 Exit")
             
-            choice = input("\nSelect option (1-7): ").strip()
+            choice = input("\nSelect option (1-9): ").strip()
             
             if choice == "1":
                 amount = float(input("Enter amount (RM): "))
-                sender.send_payment_request("card", amount)
+                sender.send_payment_request("card", amount, prompt_terminal(sender))
                 
             elif choice == "2":
                 amount = float(input("Enter amount (RM): "))
-                sender.send_payment_request("bnpl", amount)
+                sender.send_payment_request("bnpl", amount, prompt_terminal(sender))
                 
             elif choice == "3":
                 amount = float(input("Enter amount (RM): "))
-                sender.send_payment_request("duitnow_qr", amount)
+                sender.send_payment_request("duitnow_qr", amount, prompt_terminal(sender))
                 
             elif choice == "4":
                 amount = float(input("Enter amount (RM): "))
-                sender.send_payment_request("ipp", amount)
+                sender.send_payment_request("ipp", amount, prompt_terminal(sender))
                 
             elif choice == "5":
                 sender.cancel_transaction()
@@ -541,11 +2385,47 @@ def main():
             elif choice == "6":
                 print(f"\n📊 Status:")
                 print(f"🔗 Connected POS terminals: {len(sender.connected_clients)}")
+                now = time.monotonic()
+                for connection in sender.router.connections():
+                    outstanding = sender.transactions.outstanding(connection.terminal_id)
+                    health = "" if connection.responsive else ", not responding"
+                    if connection.codec is not JSON_CODEC:
+                        health += f", {connection.codec.name}"
+                    if connection.outbound.pending_bytes:
+                        health += f", {connection.outbound.pending_bytes} bytes queued"
+                    if connection.rejected:
+                        health += f", {connection.rejected} frame(s) rejected"
+                    print(f"   {connection.terminal_id} ({connection.address}): {outstanding} active, "
+                          f"idle {now - connection.last_seen:.0f}s{health}")
                 print(f"🆔 Current transaction: {sender.current_txn_id or 'None'}")
                 print(f"👂 Listening for responses: {sender.is_listening}")
+                active = sender.transactions.active()
+                print(f"🧾 Active transactions: {len(active)}")
+                for txn in active:
+                    print(f"   {txn.txn_id}: {txn.payment_mode} RM{txn.amount:.2f} "
+                          f"[{txn.state.value}] on {txn.terminal or 'unknown terminal'}")
+                offers = sender.pending_plan_offers()
+                if offers:
+                    print(f"📑 Awaiting IPP plan selection: {', '.join(offer.txn_id for offer in offers)}")
+                quarantined = sender.admission.quarantined()
+                if quarantined:
+                    print("🚧 Quarantined: " + ", ".join(f"{host} ({left:.0f}s left)"
+                                                        for host, left in sorted(quarantined.items())))
+                if sender.shared:
+                    print(f"🏬 Worker {sender.shared.worker_id} of {sender.shared.workers}")
+                    for terminal_id, worker_id in sender.shared.terminals():
+                        if worker_id != sender.shared.worker_id:
+                            print(f"   {terminal_id} on worker {worker_id}")
                 print(f"🏪 Kiosk ID: {sender.kiosk_id}")
+                print_metrics_summary()
                 
             elif choice == "7":
+                reconcile_menu(sender)
+                
+            elif choice == "8":
+                plan_menu(sender)
+                
+            elif choice == "9":
                 break
                 
             else:
@@ -556,8 +2436,12 @@ def main():
     except Exception as e:
         print(f"❌ Error: {e}")
     finally:
+        if metrics_server:
+            metrics_server.stop()
         sender.stop_server()
+        stop_workers(children)
+        log_listener.stop()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,254 @@
+"""
+Wire codecs of the MobyPay Kiosk protocol
+Splits a TCP byte stream into frames (newline-delimited JSON or
+length-prefixed msgpack) and encodes and decodes the messages in them
+"""
+
+import json
+import struct
+from typing import Dict, Any, List
+
+try:
+    import orjson
+except ImportError:  # optional: faster JSON encoding and decoding
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional: enables the msgpack wire codec
+    msgpack = None
+
+# Largest accepted frame; big enough for IPP plan lists with many installments
+DEFAULT_MAX_FRAME_SIZE = 1024 * 1024
+
+
+class MessageFramer:
+    """Incremental decoder for newline-delimited frames on one connection
+    
+    Bytes from each read are appended to a reusable buffer and every complete
+    frame in it is sliced out in a single pass; the consumed prefix is dropped
+    once per feed. A frame longer than max_frame_size is discarded up to its
+    delimiter and counted in dropped_frames instead of being buffered.
+    """
+    
+    DELIMITER = b'\n'
+    
+    def __init__(self, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.dropped_frames = 0
+        self._buffer = bytearray()
+        self._scanned = 0
+        self._discarding = False
+    
+    @property
+    def pending(self) -> int:
+        """Number of buffered bytes that do not form a complete frame yet"""
+        return len(self._buffer)
+    
+    def feed(self, data: bytes) -> List[bytes]:
+        """Add received bytes and return the complete frames they finish"""
+        buffer = self._buffer
+        buffer += data
+        frames = []
+        start = 0
+        search = self._scanned
+        
+        with memoryview(buffer) as view:
+            while True:
+                end = buffer.find(self.DELIMITER, search)
+                if end < 0:
+                    break
+                
+                if self._discarding:
+                    # Tail of a frame that already overflowed
+                    self._discarding = False
+                elif end - start > self.max_frame_size:
+                    self.dropped_frames += 1
+                else:
+                    stop = end - 1 if end > start and buffer[end - 1] == 0x0D else end
+                    if stop > start:
+                        frames.append(bytes(view[start:stop]))
+                
+                start = search = end + 1
+        
+        if self._discarding or len(buffer) - start > self.max_frame_size:
+            if not self._discarding:
+                self.dropped_frames += 1
+                self._discarding = True
+            buffer.clear()
+        else:
+            del buffer[:start]
+        self._scanned = len(buffer)
+        
+        return frames
+    
+    def reset(self):
+        """Discard any partially received frame"""
+        self._buffer.clear()
+        self._scanned = 0
+        self._discarding = False
+    
+    def partial(self) -> bytes:
+        """The buffered start of the next frame, for another framer to carry on from"""
+        return b"" if self._discarding else bytes(self._buffer)
+
+
+class LengthPrefixedFramer:
+    """Incremental decoder for frames sent as a 4-byte big-endian length and a body
+    
+    Same interface as MessageFramer. A frame longer than max_frame_size is
+    skipped by its declared length and counted in dropped_frames, so the
+    stream stays in sync without buffering it.
+    """
+    
+    HEADER = struct.Struct(">I")
+    
+    def __init__(self, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.dropped_frames = 0
+        self._buffer = bytearray()
+        self._skip = 0
+    
+    @property
+    def pending(self) -> int:
+        """Number of buffered bytes that do not form a complete frame yet"""
+        return len(self._buffer)
+    
+    def feed(self, data: bytes) -> List[bytes]:
+        """Add received bytes and return the complete frames they finish"""
+        if self._skip:
+            skipped = min(self._skip, len(data))
+            self._skip -= skipped
+            data = data[skipped:]
+        buffer = self._buffer
+        buffer += data
+        frames = []
+        start = 0
+        header = self.HEADER
+        
+        while len(buffer) - start >= header.size:
+            (length,) = header.unpack_from(buffer, start)
+            body = start + header.size
+            if length > self.max_frame_size:
+                self.dropped_frames += 1
+                skipped = min(length, len(buffer) - body)
+                self._skip = length - skipped
+                start = body + skipped
+                continue
+            if len(buffer) - body < length:
+                break
+            frames.append(bytes(buffer[body:body + length]))
+            start = body + length
+        
+        del buffer[:start]
+        return frames
+    
+    def reset(self):
+        """Discard any partially received frame"""
+        self._buffer.clear()
+        self._skip = 0
+    
+    def partial(self) -> bytes:
+        """The buffered start of the next frame, for another framer to carry on from"""
+        return b"" if self._skip else bytes(self._buffer)
+
+
+class WireCodec:
+    """Serialisation and framing of messages on one connection
+    
+    Signatures do not depend on the codec: they are always computed over the
+    payload's canonical JSON (MessageSigner.canonicalize). A message is
+    signed once, can be sent in any codec, and is verified after decoding.
+    """
+    
+    name = ""
+    
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        """Serialise a message as one complete frame, delimiter or length prefix included"""
+        raise NotImplementedError
+    
+    def decode(self, frame: bytes) -> Any:
+        """Deserialise one frame returned by this codec's framer; raises ValueError if it is malformed"""
+        raise NotImplementedError
+    
+    def framer(self, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE):
+        """A new incremental decoder for this codec's framing"""
+        raise NotImplementedError
+    
+    def plausible(self, frame: bytes) -> bool:
+        """Cheap check, without parsing, that a frame could be a signed message"""
+        return True
+
+
+class JsonCodec(WireCodec):
+    """Newline-delimited JSON, the original wire format
+    
+    Uses orjson when it is installed and the standard library otherwise.
+    The two differ in how they write floats and non-ASCII text, which is
+    harmless: neither output is what gets signed.
+    """
+    
+    name = "json"
+    
+    def __init__(self):
+        self.backend = "orjson" if orjson is not None else "json"
+    
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(message) + b"\n"
+        return (json.dumps(message) + "\n").encode('utf-8')
+    
+    def decode(self, frame: bytes) -> Any:
+        if orjson is not None:
+            return orjson.loads(frame)
+        return json.loads(frame.decode('utf-8'))
+    
+    def framer(self, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE) -> MessageFramer:
+        return MessageFramer(max_frame_size)
+    
+    def plausible(self, frame: bytes) -> bool:
+        return frame.lstrip()[:1] == b"{" and b'"signature"' in frame and b'"payload"' in frame
+
+
+class MsgpackCodec(WireCodec):
+    """MessagePack bodies behind a 4-byte big-endian length prefix (needs msgpack)
+    
+    Floats must travel as 64-bit values in both directions: a 32-bit float
+    decodes to a different number than the one that was signed. Binary and
+    extension types are invalid in messages because canonical JSON cannot
+    represent them.
+    """
+    
+    name = "msgpack"
+    
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        body = msgpack.packb(message)
+        return LengthPrefixedFramer.HEADER.pack(len(body)) + body
+    
+    def decode(self, frame: bytes) -> Any:
+        return msgpack.unpackb(frame)
+    
+    def framer(self, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE) -> LengthPrefixedFramer:
+        return LengthPrefixedFramer(max_frame_size)
+    
+    def plausible(self, frame: bytes) -> bool:
+        # A map (fixmap, map 16 or map 32) holding both envelope keys
+        return (bool(frame) and (0x80 <= frame[0] <= 0x8f or frame[0] in (0xde, 0xdf))
+                and b"signature" in frame and b"payload" in frame)
+
+
+JSON_CODEC = JsonCodec()
+
+# Codecs this Kiosk can speak; a terminal picks one in its hello frame
+CODECS: Dict[str, WireCodec] = {"json": JSON_CODEC}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+
+
+def negotiate_codec(offered: Any) -> WireCodec:
+    """The first codec in a terminal's preference list that this Kiosk supports, else JSON"""
+    if isinstance(offered, list):
+        for name in offered:
+            if isinstance(name, str) and name in CODECS:
+                return CODECS[name]
+    return JSON_CODEC
@@ -0,0 +1,553 @@
+"""
+Durable records of the MobyPay Kiosk
+The transaction journal replayed after a crash, and the traffic capture
+replayed by replay_capture.py
+"""
+
+import logging
+import json
+import os
+import struct
+import time
+import threading
+import zlib
+from typing import TYPE_CHECKING, Dict, Any, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from kiosk_metrics import metrics
+from kiosk_codec import CODECS, JSON_CODEC, WireCodec
+from kiosk_transactions import Transaction, TransactionState
+
+if TYPE_CHECKING:
+    from kiosk_transport import PosConnection
+
+logger = logging.getLogger("mobypay.kiosk")
+
+
+class TransactionJournal:
+    """Crash-safe, append-only binary journal of transaction state
+    
+    Each create, state change and discard is appended as one record holding
+    the transaction's full state: a little-endian header (payload length,
+    CRC-32, kind) followed by compact JSON. Callers never wait for the disk.
+    Records are queued and a writer thread commits everything queued so far
+    with one write and one fsync (group commit), so a burst of payments
+    costs one flush. wait() blocks until a record is durable for callers
+    that need that guarantee.
+    
+    A segment rotates once `segment_bytes` of records follow its opening
+    checkpoint. Every segment starts with a checkpoint of all unfinished
+    transactions, so recovery replays from the newest complete checkpoint
+    only; segments older than the newest `keep_segments` are deleted.
+    """
+    
+    MAGIC = b"MPJ1"
+    _HEADER = struct.Struct("<IIB")
+    MAX_RECORD = 16 * 1024 * 1024
+    
+    STATE_KINDS = {
+        TransactionState.REQUESTED: 1,
+        TransactionState.ACKED: 2,
+        TransactionState.IPP_PLANS: 3,
+        TransactionState.PLAN_SELECTED: 4,
+        TransactionState.COMPLETED: 5,
+        TransactionState.FAILED: 6,
+        TransactionState.CANCELLED: 7,
+        TransactionState.CANCELLING: 8,
+    }
+    KIND_STATES = {kind: state for state, kind in STATE_KINDS.items()}
+    DISCARD = 100
+    CHECKPOINT_BEGIN = 101
+    CHECKPOINT_END = 102
+    
+    def __init__(self, directory: str, segment_bytes: int = 16 * 1024 * 1024, keep_segments: int = 3):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.keep_segments = max(1, keep_segments)
+        self._cond = threading.Condition()
+        self._pending: List[bytes] = []
+        self._seq = 0
+        self._durable_seq = 0
+        # Latest record of every unfinished transaction, for checkpoints
+        self._unfinished: Dict[str, bytes] = {}
+        self._closing = False
+        self._error: Optional[OSError] = None
+        self._file = None
+        self._segment = 0
+        self._since_checkpoint = 0
+        self._writer: Optional[threading.Thread] = None
+    
+    def open(self) -> List[Transaction]:
+        """Recover unfinished transactions, start a new segment and the writer thread"""
+        os.makedirs(self.directory, exist_ok=True)
+        recovered = self._recover()
+        
+        for txn in recovered:
+            self._unfinished[txn.txn_id] = self._encode(self.STATE_KINDS[txn.state], self._txn_payload(txn))
+        self._open_segment(self._segment + 1)
+        self._trim()
+        
+        self._writer = threading.Thread(target=self._run, name="kiosk-journal")
+        self._writer.daemon = True
+        self._writer.start()
+        return recovered
+    
+    def record(self, txn: Transaction) -> int:
+        """Registry recorder: queue the transaction's current state; returns its sequence number"""
+        kind = self.DISCARD if txn.discarded else self.STATE_KINDS[txn.state]
+        data = self._encode(kind, self._txn_payload(txn))
+        
+        with self._cond:
+            if txn.discarded or txn.state.is_final:
+                self._unfinished.pop(txn.txn_id, None)
+            else:
+                self._unfinished[txn.txn_id] = data
+            self._pending.append(data)
+            self._seq += 1
+            self._cond.notify()
+            return self._seq
+    
+    def wait(self, seq: Optional[int] = None, timeout: Optional[float] = None) -> bool:
+        """Block until record `seq` (default: everything queued so far) is committed
+        
+        Returns False on timeout, or if a journal write has failed.
+        """
+        with self._cond:
+            target = self._seq if seq is None else seq
+            return self._cond.wait_for(lambda: self._durable_seq >= target, timeout) and self._error is None
+    
+    def close(self):
+        """Commit every queued record and stop the writer thread"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        if self._writer:
+            self._writer.join()
+            self._writer = None
+        if self._file:
+            self._file.close()
+            self._file = None
+    
+    @staticmethod
+    def _txn_payload(txn: Transaction) -> bytes:
+        return json.dumps(txn.to_dict(), separators=(',', ':')).encode('utf-8')
+    
+    def _encode(self, kind: int, payload: bytes) -> bytes:
+        crc = zlib.crc32(payload, zlib.crc32(bytes((kind,))))
+        return self._HEADER.pack(len(payload), crc, kind) + payload
+    
+    def _run(self):
+        """Writer thread: commit queued records in groups"""
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closing)
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, []
+                last_seq = self._seq
+            
+            try:
+                self._commit(b"".join(batch), len(batch))
+            except OSError as e:
+                # Payments keep running from memory; wait() reports the failure
+                self._error = e
+                logger.error("❌ Journal write failed: %s", e)
+            
+            with self._cond:
+                self._durable_seq = last_seq
+                self._cond.notify_all()
+    
+    def _commit(self, data: bytes, records: int):
+        if self._since_checkpoint and self._since_checkpoint + len(data) > self.segment_bytes:
+            self._rotate()
+        
+        started = time.perf_counter()
+        self._file.write(data)
+        self._file.flush()
+        self._sync()
+        self._since_checkpoint += len(data)
+        metrics.observe("kiosk_journal_commit_seconds", time.perf_counter() - started)
+        metrics.inc("kiosk_journal_records_total", value=records)
+    
+    def _sync(self):
+        getattr(os, "fdatasync", os.fsync)(self._file.fileno())
+    
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"journal-{number:08d}.mpj")
+    
+    def _segments(self) -> List[int]:
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith("journal-") and name.endswith(".mpj"):
+                try:
+                    numbers.append(int(name[8:-4]))
+                except ValueError:
+                    pass
+        return sorted(numbers)
+    
+    def _open_segment(self, number: int):
+        """Start a segment with a checkpoint of every unfinished transaction"""
+        with self._cond:
+            snapshot = list(self._unfinished.values())
+        
+        self._file = open(self._segment_path(number), "ab")
+        self._segment = number
+        data = b"".join([
+            self.MAGIC,
+            self._encode(self.CHECKPOINT_BEGIN, b"{}"),
+            *snapshot,
+            self._encode(self.CHECKPOINT_END, json.dumps({"transactions": len(snapshot)}).encode('utf-8')),
+        ])
+        self._file.write(data)
+        self._file.flush()
+        self._sync()
+        self._since_checkpoint = 0
+    
+    def _rotate(self):
+        """Close the current segment, start the next and drop old ones"""
+        self._file.close()
+        self._open_segment(self._segment + 1)
+        self._trim()
+        logger.debug("📒 Journal rotated to segment %s", self._segment)
+    
+    def _trim(self):
+        """Delete segments beyond keep_segments; the newest always holds a full checkpoint"""
+        for number in self._segments()[:-self.keep_segments]:
+            try:
+                os.remove(self._segment_path(number))
+            except OSError as e:
+                logger.warning("❌ Could not remove journal segment %s: %s", number, e)
+    
+    def _read_segment(self, number: int) -> Tuple[List[Tuple[int, bytes]], bool]:
+        """Valid records of a segment, and whether its checkpoint is complete
+        
+        Reading stops at the first torn or corrupt record.
+        """
+        with open(self._segment_path(number), "rb") as f:
+            data = f.read()
+        
+        records = []
+        checkpointed = False
+        if not data.startswith(self.MAGIC):
+            return records, checkpointed
+        
+        offset = len(self.MAGIC)
+        header = self._HEADER
+        while offset + header.size <= len(data):
+            length, crc, kind = header.unpack_from(data, offset)
+            start = offset + header.size
+            payload = data[start:start + length]
+            if length > self.MAX_RECORD or len(payload) < length \
+                    or zlib.crc32(payload, zlib.crc32(bytes((kind,)))) != crc:
+                logger.warning("❌ Journal segment %s: corrupt record at byte %s; ignoring the rest", number, offset)
+                break
+            if kind == self.CHECKPOINT_END:
+                checkpointed = True
+            records.append((kind, payload))
+            offset = start + length
+        return records, checkpointed
+    
+    def _recover(self) -> List[Transaction]:
+        """Rebuild unfinished transactions from the newest complete checkpoint onwards"""
+        segments = self._segments()
+        if not segments:
+            return []
+        self._segment = segments[-1]
+        
+        started = time.perf_counter()
+        reads = []
+        for number in reversed(segments):
+            records, checkpointed = self._read_segment(number)
+            reads.append(records)
+            if checkpointed:
+                break
+        
+        latest: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+        replayed = 0
+        for records in reversed(reads):
+            for kind, payload in records:
+                if kind not in self.KIND_STATES and kind != self.DISCARD:
+                    continue
+                entry = json.loads(payload)
+                previous = latest.get(entry["txn_id"])
+                # Listeners may run out of order on different threads; the newest state wins
+                if previous is None or entry["updated_at"] >= previous[1]["updated_at"]:
+                    latest[entry["txn_id"]] = (kind, entry)
+                replayed += 1
+        
+        recovered = []
+        for kind, entry in latest.values():
+            state = self.KIND_STATES.get(kind)
+            if state is None or state.is_final:
+                continue
+            # The record kind is the state; records written before it was in the payload lack it
+            recovered.append(Transaction.from_dict(entry, state))
+        
+        recovered.sort(key=lambda txn: txn.created_at)
+        logger.info("📒 Journal recovery: %s records from %s segment(s) in %.1f ms, %s unfinished transaction(s)",
+                    replayed, len(reads), (time.perf_counter() - started) * 1000, len(recovered))
+        return recovered
+
+
+class CaptureRecord(NamedTuple):
+    """One record of a traffic capture"""
+    time: float
+    connection: int
+    kind: int
+    codec: str
+    data: bytes
+
+
+class TrafficCapture:
+    """Rotating binary capture of every frame a Kiosk exchanges with its terminals
+    
+    Each record is a little-endian header (wall-clock time, connection
+    number, data length, kind, codec) followed by the data: a frame body as
+    the framer returned it for inbound frames, the whole encoded frame for
+    outbound ones, and compact JSON for connection events. The network
+    threads only queue records; a writer thread appends them in batches
+    without fsync, since a capture is a diagnostic, not a ledger. Records
+    queued beyond `max_pending_bytes` are dropped and counted rather than
+    slowing the Kiosk down.
+    
+    A segment rotates once it holds `segment_bytes`; every segment starts by
+    repeating the open and identify records of the connections still open,
+    so each one can be replayed on its own. Segments older than the newest
+    `keep_segments` are deleted. Captures hold payment data and the
+    terminals' frames in the clear: store them like the journal.
+    
+    A connection number holds the first segment number of the process that
+    wrote it (modulo 4096) in its top 12 bits and a count in the other 20,
+    so a process capturing to a directory after another, or alongside it
+    after a handoff, never reuses a number the other one wrote. A
+    connection handed to a new process gets a close record here and a new
+    number there.
+    """
+    
+    MAGIC = b"MPC1"
+    _HEADER = struct.Struct("<dIIBB")
+    MAX_RECORD = 16 * 1024 * 1024
+    
+    OPEN = 1
+    IDENTIFY = 2
+    CLOSE = 3
+    INBOUND = 4
+    OUTBOUND = 5
+    
+    CONNECTION_BITS = 20
+    RUN_BITS = 12
+    
+    CODEC_IDS = {"json": 0, "msgpack": 1}
+    CODEC_NAMES = {number: name for name, number in CODEC_IDS.items()}
+    
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024, keep_segments: int = 8,
+                 max_pending_bytes: int = 8 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.keep_segments = max(1, keep_segments)
+        self.max_pending_bytes = max_pending_bytes
+        self._cond = threading.Condition()
+        self._pending: List[bytes] = []
+        self._pending_bytes = 0
+        self._connections = 0
+        self._run_number = 0
+        # Open and identify records of every open connection, repeated at the start of each segment
+        self._live: Dict[int, List[bytes]] = {}
+        self._closing = False
+        self._file = None
+        self._segment = 0
+        self._written = 0
+        self._writer: Optional[threading.Thread] = None
+    
+    def open(self):
+        """Start a new segment after any left by an earlier run, and the writer thread"""
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self._segments()
+        self._closing = False
+        self._open_segment(segments[-1] + 1 if segments else 1)
+        self._run_number = self._segment % (1 << self.RUN_BITS)
+        self._trim()
+    
+        self._writer = threading.Thread(target=self._run, name="kiosk-capture")
+        self._writer.daemon = True
+        self._writer.start()
+        logger.info("🎥 Capturing traffic to %s", self.directory)
+    
+    def close(self):
+        """Write every queued record and stop the writer thread"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        if self._writer:
+            self._writer.join()
+            self._writer = None
+        if self._file:
+            self._file.close()
+            self._file = None
+    
+    def opened(self, connection: "PosConnection"):
+        """A terminal connected; numbers the connection for the records that follow"""
+        with self._cond:
+            self._connections += 1
+            connection.capture_id = (self._run_number << self.CONNECTION_BITS
+                                     | self._connections % (1 << self.CONNECTION_BITS))
+            record = self._encode(connection.capture_id, self.OPEN, JSON_CODEC,
+                                  json.dumps({"address": connection.address}).encode('utf-8'))
+            self._live[connection.capture_id] = [record]
+        self._queue(record)
+    
+    def identified(self, connection: "PosConnection"):
+        """A connection announced its terminal id and settled on a codec"""
+        details = {"terminal_id": connection.terminal_id, "codec": connection.codec.name}
+        record = self._encode(connection.capture_id, self.IDENTIFY, JSON_CODEC,
+                              json.dumps(details).encode('utf-8'))
+        with self._cond:
+            opening = self._live.get(connection.capture_id)
+            if opening is not None:
+                self._live[connection.capture_id] = opening[:1] + [record]
+        self._queue(record)
+    
+    def closed(self, connection: "PosConnection", handed_off: bool = False):
+        """A connection closed, or went to a new process that captures it under a number of its own"""
+        with self._cond:
+            self._live.pop(connection.capture_id, None)
+        details = b'{"handed_off":true}' if handed_off else b"{}"
+        self._queue(self._encode(connection.capture_id, self.CLOSE, JSON_CODEC, details))
+    
+    def inbound(self, connection: "PosConnection", frames: List[bytes], codec: WireCodec):
+        """Frame bodies received from a terminal, as its framer returned them"""
+        now = time.time()
+        self._queue(b"".join(self._encode(connection.capture_id, self.INBOUND, codec, frame, now)
+                             for frame in frames), records=len(frames))
+    
+    def outbound(self, connection: "PosConnection", frame: bytes, codec: WireCodec):
+        """An encoded frame queued for a terminal"""
+        self._queue(self._encode(connection.capture_id, self.OUTBOUND, codec, frame))
+    
+    @classmethod
+    def read(cls, path: str) -> Iterator[CaptureRecord]:
+        """Records of a capture directory, or of one segment file, in the order they were written
+    
+        The connection records repeated at the start of each segment are
+        returned only once. Reading a segment stops at a torn record.
+        """
+        if os.path.isdir(path):
+            capture = cls(path)
+            paths = [capture._segment_path(number) for number in capture._segments()]
+        else:
+            paths = [path]
+    
+        seen: Dict[int, Set[int]] = {}
+        header = cls._HEADER
+        for segment in paths:
+            with open(segment, "rb") as f:
+                data = f.read()
+            if not data.startswith(cls.MAGIC):
+                logger.warning("❌ %s is not a traffic capture", segment)
+                continue
+    
+            offset = len(cls.MAGIC)
+            while offset + header.size <= len(data):
+                when, connection, length, kind, codec = header.unpack_from(data, offset)
+                start = offset + header.size
+                if length > cls.MAX_RECORD or start + length > len(data):
+                    logger.warning("❌ %s: torn record at byte %s; ignoring the rest", segment, offset)
+                    break
+                offset = start + length
+                if kind in (cls.OPEN, cls.IDENTIFY):
+                    if kind in seen.setdefault(connection, set()):
+                        continue
+                    seen[connection].add(kind)
+                elif kind == cls.CLOSE:
+                    seen.pop(connection, None)
+                yield CaptureRecord(when, connection, kind, cls.CODEC_NAMES.get(codec, "json"),
+                                    data[start:offset])
+    
+    @staticmethod
+    def decode(record: CaptureRecord) -> Any:
+        """The message a frame record holds, or the details of a connection record
+    
+        Raises KeyError if the frame's codec is not available here.
+        """
+        if record.kind not in (TrafficCapture.INBOUND, TrafficCapture.OUTBOUND):
+            return JSON_CODEC.decode(record.data)
+        codec = CODECS[record.codec]
+        body = record.data
+        if record.kind == TrafficCapture.OUTBOUND:
+            body = codec.framer(TrafficCapture.MAX_RECORD).feed(body)[0]
+        return codec.decode(body)
+    
+    def _encode(self, connection: int, kind: int, codec: WireCodec, data: bytes,
+                now: Optional[float] = None) -> bytes:
+        return self._HEADER.pack(now or time.time(), connection, len(data), kind,
+                                 self.CODEC_IDS.get(codec.name, 0)) + data
+    
+    def _queue(self, data: bytes, records: int = 1):
+        with self._cond:
+            if self._pending_bytes + len(data) > self.max_pending_bytes:
+                metrics.inc("kiosk_capture_dropped_total", value=records)
+                return
+            self._pending.append(data)
+            self._pending_bytes += len(data)
+            self._cond.notify()
+    
+    def _run(self):
+        """Writer thread: append queued records in batches"""
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closing)
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, []
+                self._pending_bytes = 0
+    
+            data = b"".join(batch)
+            try:
+                if self._written and self._written + len(data) > self.segment_bytes:
+                    self._rotate()
+                self._file.write(data)
+                self._file.flush()
+                self._written += len(data)
+            except OSError as e:
+                # The Kiosk carries on; the capture is incomplete from here
+                logger.error("❌ Capture write failed: %s", e)
+                continue
+            metrics.inc("kiosk_capture_records_total", value=len(batch))
+    
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"capture-{number:08d}.mpc")
+    
+    def _segments(self) -> List[int]:
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith("capture-") and name.endswith(".mpc"):
+                try:
+                    numbers.append(int(name[8:-4]))
+                except ValueError:
+                    pass
+        return sorted(numbers)
+    
+    def _open_segment(self, number: int):
+        """Start a segment with the opening records of every open connection"""
+        with self._cond:
+            live = [record for records in self._live.values() for record in records]
+    
+        self._file = open(self._segment_path(number), "ab")
+        self._segment = number
+        self._file.write(b"".join([self.MAGIC, *live]))
+        self._file.flush()
+        self._written = 0
+    
+    def _rotate(self):
+        """Close the current segment, start the next and drop old ones"""
+        self._file.close()
+        # After a handoff the new process writes here too; never append to its segment
+        self._open_segment(max(self._segments()[-1:] + [self._segment]) + 1)
+        self._trim()
+        logger.debug("🎥 Capture rotated to segment %s", self._segment)
+    
+    def _trim(self):
+        for number in self._segments()[:-self.keep_segments]:
+            try:
+                os.remove(self._segment_path(number))
+            except OSError as e:
+                logger.warning("❌ Could not remove capture segment %s: %s", number, e)
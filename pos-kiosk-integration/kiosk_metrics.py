@@ -0,0 +1,385 @@
+"""
+Logging and metrics for the MobyPay Kiosk
+Log formatters, the metric registry every Kiosk module records into, and the
+HTTP endpoint that serves it in the Prometheus text format
+"""
+
+import bisect
+import http.server
+import logging
+import logging.handlers
+import queue
+import socket
+import sys
+import json
+import time
+import threading
+from typing import Dict, Callable, List, NamedTuple, Optional, Sequence, Tuple
+
+logger = logging.getLogger("mobypay.kiosk")
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Human-readable console output: the emoji messages exactly as logged
+    
+    At DEBUG level each line is prefixed with the time and thread name, which
+    is what matters when several terminals are talking at once.
+    """
+    
+    def __init__(self, verbose: bool = False, worker: Optional[int] = None):
+        fmt = "%(asctime)s [%(threadName)s] %(message)s" if verbose else "%(message)s"
+        if worker is not None:
+            fmt = f"[worker {worker}] {fmt}"
+        super().__init__(fmt)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per log record, for log shippers"""
+    
+    def __init__(self, worker: Optional[int] = None):
+        super().__init__()
+        self.worker = worker
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if self.worker is not None:
+            entry["worker"] = self.worker
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def configure_logging(level: int = logging.INFO, json_path: Optional[str] = None,
+                      stream=None, worker: Optional[int] = None) -> logging.handlers.QueueListener:
+    """Route kiosk logging through a queue so socket threads never wait on I/O
+    
+    Records below `level` are discarded before their message is formatted.
+    Everything else is put on an unbounded queue and written to the console
+    (and optionally to a JSON-lines file) by a single listener thread. Call
+    stop() on the returned listener at shutdown to flush pending records.
+    In prefork mode, `worker` labels every line with the worker's number.
+    """
+    handlers: List[logging.Handler] = []
+    
+    console = logging.StreamHandler(stream or sys.stdout)
+    console.setFormatter(ConsoleFormatter(verbose=level <= logging.DEBUG, worker=worker))
+    handlers.append(console)
+    
+    if json_path:
+        sink = logging.FileHandler(json_path, encoding="utf-8")
+        sink.setFormatter(JsonLinesFormatter(worker))
+        handlers.append(sink)
+    
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    
+    for handler in logger.handlers[:]:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+    
+    listener.start()
+    return listener
+
+
+class MetricSpec(NamedTuple):
+    """Type, help text, label names and histogram buckets of one metric"""
+    
+    kind: str
+    help: str
+    labels: Tuple[str, ...] = ()
+    buckets: Tuple[float, ...] = ()
+
+
+# Payments wait on a customer at the terminal, so latency spans ms to minutes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+DISK_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+VERIFY_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+
+
+class KioskMetrics:
+    """Counters and histograms for the Kiosk server, rendered in Prometheus format
+    
+    Every thread records into its own shard, so recording never takes a lock
+    or contends with the socket threads. A scrape sums the shards; shards of
+    threads that have exited are folded into a retired total so a
+    thread-per-connection server does not accumulate them.
+    """
+    
+    SPECS = {
+        "kiosk_frames_received_total": MetricSpec(
+            "counter", "Frames received from POS terminals", ("terminal",)),
+        "kiosk_frames_dropped_total": MetricSpec(
+            "counter", "Frames discarded for exceeding the maximum frame size", ("terminal",)),
+        "kiosk_validation_failures_total": MetricSpec(
+            "counter", "Messages rejected by security validation", ("reason",)),
+        "kiosk_send_failures_total": MetricSpec(
+            "counter", "Frames that could not be sent to a POS terminal", ("terminal",)),
+        "kiosk_connections_total": MetricSpec(
+            "counter", "POS connections accepted"),
+        "kiosk_reconnects_total": MetricSpec(
+            "counter", "Hello frames from a terminal id that had connected before", ("terminal",)),
+        "kiosk_reaped_connections_total": MetricSpec(
+            "counter", "Connections closed for missing heartbeats", ("terminal",)),
+        "kiosk_journal_records_total": MetricSpec(
+            "counter", "Records committed to the transaction journal"),
+        "kiosk_forwarded_requests_total": MetricSpec(
+            "counter", "Requests handed to another worker process in prefork mode", ("op",)),
+        "kiosk_duplicate_results_total": MetricSpec(
+            "counter", "Results ignored because their transaction had already moved past them", ("status",)),
+        "kiosk_conflicting_results_total": MetricSpec(
+            "counter", "Results that contradict the final state already recorded for their transaction",
+            ("recorded", "reported")),
+        "kiosk_idempotent_retries_total": MetricSpec(
+            "counter", "Payments answered from the idempotency cache instead of sent again"),
+        "kiosk_tls_handshakes_total": MetricSpec(
+            "counter", "Completed TLS handshakes, by whether a session was resumed", ("resumed",)),
+        "kiosk_tls_handshake_failures_total": MetricSpec(
+            "counter", "TLS handshakes that failed or timed out"),
+        "kiosk_capture_records_total": MetricSpec(
+            "counter", "Records written to the traffic capture"),
+        "kiosk_capture_dropped_total": MetricSpec(
+            "counter", "Capture records dropped because the capture writer fell behind"),
+        "kiosk_admission_rejections_total": MetricSpec(
+            "counter", "Inbound frames rejected by admission control or validation", ("reason",)),
+        "kiosk_quarantines_total": MetricSpec(
+            "counter", "Connections closed for too many rejected frames"),
+        "kiosk_quarantine_refusals_total": MetricSpec(
+            "counter", "Connections refused because their host was quarantined"),
+        "kiosk_handoffs_total": MetricSpec(
+            "counter", "Attempts to hand the listening socket and POS connections to a new process", ("result",)),
+        "kiosk_signature_verify_seconds": MetricSpec(
+            "histogram", "HMAC signature verification time", (), VERIFY_BUCKETS),
+        "kiosk_ack_latency_seconds": MetricSpec(
+            "histogram", "Time from payment request to ACK", (), LATENCY_BUCKETS),
+        "kiosk_result_latency_seconds": MetricSpec(
+            "histogram", "Time from payment request to its final state", ("outcome",), LATENCY_BUCKETS),
+        "kiosk_journal_commit_seconds": MetricSpec(
+            "histogram", "Write and fsync time of one journal group commit", (), DISK_BUCKETS),
+        "kiosk_tls_handshake_seconds": MetricSpec(
+            "histogram", "Server-side TLS handshake time", ("resumed",), LATENCY_BUCKETS),
+        "kiosk_connected_terminals": MetricSpec(
+            "gauge", "Connected POS terminals"),
+        "kiosk_active_transactions": MetricSpec(
+            "gauge", "Transactions waiting for a final result"),
+        "kiosk_outstanding_transactions": MetricSpec(
+            "gauge", "Active transactions per connected terminal", ("terminal",)),
+        "kiosk_nonce_cache_entries": MetricSpec(
+            "gauge", "Nonces held for replay protection"),
+        "kiosk_send_queue_bytes": MetricSpec(
+            "gauge", "Bytes waiting in send queues per connected terminal", ("terminal",)),
+        "kiosk_quarantined_hosts": MetricSpec(
+            "gauge", "Hosts whose connections are refused while quarantined"),
+    }
+    
+    class _Shard:
+        def __init__(self, thread: Optional[threading.Thread]):
+            self.thread = thread
+            self.counters: Dict[Tuple[str, Tuple[str, ...]], int] = {}
+            # Per-bucket counts (not cumulative), then the +Inf count, then the sum
+            self.histograms: Dict[Tuple[str, Tuple[str, ...]], List[float]] = {}
+    
+    def __init__(self):
+        self.started_at = time.time()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards: List["KioskMetrics._Shard"] = []
+        self._retired = self._Shard(None)
+    
+    def _shard(self) -> "KioskMetrics._Shard":
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = self._Shard(threading.current_thread())
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+    
+    def inc(self, name: str, *labels: str, value: int = 1):
+        """Add to a counter"""
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+    
+    def observe(self, name: str, value: float, *labels: str):
+        """Record one histogram observation"""
+        histograms = self._shard().histograms
+        key = (name, labels)
+        buckets = self.SPECS[name].buckets
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+        histogram[bisect.bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+    
+    def _snapshot(self) -> "KioskMetrics._Shard":
+        """Sum of all shards"""
+        total = self._Shard(None)
+        with self._lock:
+            live = []
+            for shard in self._shards:
+                if shard.thread.is_alive():
+                    live.append(shard)
+                else:
+                    # The thread is gone, so nothing writes to its shard any more
+                    self._merge(self._retired, shard.counters, shard.histograms)
+            self._shards = live
+            self._merge(total, self._retired.counters, self._retired.histograms)
+        
+        for shard in live:
+            # Copying a dict is atomic under the GIL; the owner may keep writing
+            self._merge(total, dict(shard.counters), {key: list(values) for key, values in list(shard.histograms.items())})
+        return total
+    
+    @staticmethod
+    def _merge(into: "KioskMetrics._Shard", counters: Dict, histograms: Dict):
+        for key, value in counters.items():
+            into.counters[key] = into.counters.get(key, 0) + value
+        for key, values in histograms.items():
+            target = into.histograms.get(key)
+            if target is None:
+                into.histograms[key] = list(values)
+            else:
+                for i, value in enumerate(values):
+                    target[i] += value
+    
+    def counter_values(self, name: str) -> Dict[Tuple[str, ...], int]:
+        """Current value of a counter for each label set"""
+        return {labels: value for (metric, labels), value in self._snapshot().counters.items() if metric == name}
+    
+    def quantile(self, name: str, q: float) -> Optional[float]:
+        """Estimate a quantile of a histogram across all its label sets
+        
+        Interpolates linearly inside the bucket, like Prometheus'
+        histogram_quantile(). Returns None if nothing was observed.
+        """
+        buckets = self.SPECS[name].buckets
+        counts = [0] * (len(buckets) + 1)
+        for (metric, _), values in self._snapshot().histograms.items():
+            if metric == name:
+                for i in range(len(counts)):
+                    counts[i] += values[i]
+        
+        total = sum(counts)
+        if not total:
+            return None
+        
+        rank = q * total
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                if i == len(buckets):
+                    return buckets[-1]
+                lower = buckets[i - 1] if i else 0.0
+                return lower + (buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return buckets[-1]
+    
+    def render(self, gauges: Optional[Dict[str, Dict[Tuple[str, ...], float]]] = None) -> str:
+        """Prometheus text exposition of every metric, plus the given gauge values"""
+        snapshot = self._snapshot()
+        gauges = gauges or {}
+        lines = []
+        
+        for name, spec in self.SPECS.items():
+            lines.append(f"# HELP {name} {spec.help}")
+            lines.append(f"# TYPE {name} {spec.kind}")
+            
+            if spec.kind == "histogram":
+                for (metric, labels), values in sorted(snapshot.histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(spec.buckets + (float("inf"),), values):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{self._labels(spec.labels + ('le',), labels + (le,))} {cumulative}")
+                    label_text = self._labels(spec.labels, labels)
+                    lines.append(f"{name}_sum{label_text} {values[-1]!r}")
+                    lines.append(f"{name}_count{label_text} {cumulative}")
+                continue
+            
+            if spec.kind == "gauge":
+                samples = gauges.get(name, {})
+            else:
+                samples = {labels: value for (metric, labels), value in snapshot.counters.items() if metric == name}
+            for labels, value in sorted(samples.items()):
+                lines.append(f"{name}{self._labels(spec.labels, labels)} {value}")
+        
+        lines.append("# HELP kiosk_uptime_seconds Seconds since the metrics were initialised")
+        lines.append("# TYPE kiosk_uptime_seconds gauge")
+        lines.append(f"kiosk_uptime_seconds {time.time() - self.started_at:.3f}")
+        return "\n".join(lines) + "\n"
+    
+    @staticmethod
+    def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+        if not names:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for v in values)
+        return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+# Shared by SecurityHelper and every TcpSender in the process
+metrics = KioskMetrics()
+
+
+class MetricsServer:
+    """Local HTTP endpoint serving GET /metrics from a background thread"""
+    
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+    
+    class _Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = self.server.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", MetricsServer.CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            logger.debug("📈 Metrics %s - " + format, self.address_string(), *args)
+    
+    def __init__(self, render: Callable[[], str], host: str = "127.0.0.1", port: int = 9108):
+        self.render = render
+        self.host = host
+        self.port = port
+        self._httpd: Optional[http.server.ThreadingHTTPServer] = None
+    
+    @property
+    def listener(self) -> Optional[socket.socket]:
+        """The listening socket while serving, e.g. to hand it to a new process"""
+        return self._httpd.socket if self._httpd else None
+    
+    def start(self, sock: Optional[socket.socket] = None):
+        """Serve the endpoint in a daemon thread, on sock if given (a listening socket taken over) or a new one"""
+        self._httpd = http.server.ThreadingHTTPServer((self.host, self.port), self._Handler,
+                                                      bind_and_activate=sock is None)
+        if sock is not None:
+            self._httpd.socket.close()
+            self._httpd.socket = sock
+            self._httpd.server_address = sock.getsockname()
+        self._httpd.daemon_threads = True
+        self._httpd.render = self.render
+        thread = threading.Thread(target=self._httpd.serve_forever, name="metrics-http")
+        thread.daemon = True
+        thread.start()
+        logger.info("📈 Metrics available at http://%s:%s/metrics", self.host, self.port)
+    
+    def stop(self):
+        """Stop serving and close the listening socket"""
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
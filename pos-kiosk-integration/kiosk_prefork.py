@@ -0,0 +1,382 @@
+"""
+Prefork workers and zero-downtime restarts of the MobyPay Kiosk
+State the workers share through SQLite, the control socket that forwards
+cancels between them, and the handoff of the listening socket and POS
+connections to a new Kiosk process
+"""
+
+import array
+import logging
+import socket
+import socketserver
+import sqlite3
+import json
+import os
+import struct
+import time
+import threading
+from typing import Dict, Any, Callable, List, Optional, Sequence, Tuple
+
+from kiosk_security import TIMESTAMP_WINDOW_MS
+from kiosk_transactions import Transaction
+
+logger = logging.getLogger("mobypay.kiosk")
+
+
+class SharedState:
+    """State shared by the worker processes of one Kiosk host (prefork mode)
+    
+    A SQLite database in WAL mode under `directory` records the nonces seen
+    by any worker, which worker each terminal is connected to, and which
+    worker owns each active transaction. Each thread keeps its own
+    connection, and WAL lets readers run alongside the single writer.
+    Workers also listen on Unix sockets in the same directory (see
+    ControlServer), so it is created private to the Kiosk's user.
+    """
+    
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS nonces (nonce TEXT PRIMARY KEY, expires_ms INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS nonces_expiry ON nonces (expires_ms)",
+        "CREATE TABLE IF NOT EXISTS terminals (terminal_id TEXT PRIMARY KEY, worker INTEGER NOT NULL, "
+        "address TEXT NOT NULL, connected_at REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS transactions (txn_id TEXT PRIMARY KEY, worker INTEGER NOT NULL, "
+        "terminal TEXT, state TEXT NOT NULL)",
+    )
+    # Expired nonces are deleted after this many inserts by one process
+    PURGE_EVERY = 1000
+    
+    def __init__(self, directory: str, worker_id: int = 0, workers: int = 1,
+                 window_ms: int = TIMESTAMP_WINDOW_MS):
+        self.directory = directory
+        self.path = os.path.join(directory, "state.db")
+        self.worker_id = worker_id
+        self.workers = workers
+        self.window_ms = window_ms
+        self._local = threading.local()
+        self._inserts = 0
+        self._inserts_lock = threading.Lock()
+    
+    @classmethod
+    def initialize(cls, directory: str):
+        """Create the database and forget the previous run's terminals
+        
+        Call once before starting workers. The connection is closed again, as
+        SQLite connections must not be inherited across fork().
+        """
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        db = sqlite3.connect(os.path.join(directory, "state.db"), isolation_level=None)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            for statement in cls.SCHEMA:
+                db.execute(statement)
+            db.execute("DELETE FROM terminals")
+            db.execute("DELETE FROM transactions")
+        finally:
+            db.close()
+    
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            # WAL commits need no fsync at NORMAL; the transaction journal is what must survive a crash
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+    
+    def control_path(self, worker_id: int) -> str:
+        """Unix socket on which a worker accepts forwarded requests"""
+        return os.path.join(self.directory, f"worker-{worker_id}.sock")
+    
+    def add_nonce(self, nonce: str, now_ms: Optional[int] = None) -> bool:
+        """Record a nonce; return False if any worker has already seen it"""
+        if now_ms is None:
+            now_ms = int(time.time() * 1000)
+        db = self._db()
+        added = db.execute("INSERT OR IGNORE INTO nonces VALUES (?, ?)",
+                           (nonce, now_ms + 2 * self.window_ms)).rowcount == 1
+        
+        with self._inserts_lock:
+            self._inserts += 1
+            purge = self._inserts % self.PURGE_EVERY == 0
+        if purge:
+            db.execute("DELETE FROM nonces WHERE expires_ms < ?", (now_ms,))
+        return added
+    
+    def nonce_count(self) -> int:
+        return self._db().execute("SELECT COUNT(*) FROM nonces").fetchone()[0]
+    
+    def clear_nonces(self):
+        self._db().execute("DELETE FROM nonces")
+    
+    def claim_terminal(self, terminal_id: str, address: str) -> Optional[int]:
+        """Record this worker as the terminal's owner; returns the previous owner if it was another worker"""
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT worker FROM terminals WHERE terminal_id = ?", (terminal_id,)).fetchone()
+            db.execute("INSERT OR REPLACE INTO terminals VALUES (?, ?, ?, ?)",
+                       (terminal_id, self.worker_id, address, time.time()))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return row[0] if row is not None and row[0] != self.worker_id else None
+    
+    def release_terminal(self, terminal_id: str, address: str):
+        """Forget a terminal's connection unless the terminal has reconnected since"""
+        self._db().execute("DELETE FROM terminals WHERE terminal_id = ? AND worker = ? AND address = ?",
+                           (terminal_id, self.worker_id, address))
+    
+    def terminal_owner(self, terminal_id: str) -> Optional[int]:
+        row = self._db().execute("SELECT worker FROM terminals WHERE terminal_id = ?", (terminal_id,)).fetchone()
+        return row[0] if row is not None else None
+    
+    def terminals(self) -> List[Tuple[str, int]]:
+        """(terminal_id, worker) of every connected terminal, oldest connection first"""
+        return self._db().execute("SELECT terminal_id, worker FROM terminals ORDER BY connected_at").fetchall()
+    
+    def least_loaded_terminal(self) -> Optional[Tuple[str, int]]:
+        """(terminal_id, worker) of the other workers' terminal with the fewest active transactions"""
+        return self._db().execute(
+            "SELECT t.terminal_id, t.worker FROM terminals t "
+            "LEFT JOIN transactions x ON x.terminal = t.terminal_id "
+            "WHERE t.worker != ? GROUP BY t.terminal_id ORDER BY COUNT(x.txn_id), t.connected_at LIMIT 1",
+            (self.worker_id,)).fetchone()
+    
+    def record_transaction(self, txn: Transaction):
+        """Registry listener: keep the owner of every active transaction"""
+        try:
+            db = self._db()
+            if txn.discarded or txn.state.is_final:
+                db.execute("DELETE FROM transactions WHERE txn_id = ?", (txn.txn_id,))
+            else:
+                db.execute("INSERT OR REPLACE INTO transactions VALUES (?, ?, ?, ?)",
+                           (txn.txn_id, self.worker_id, txn.terminal, txn.state.value))
+        except sqlite3.Error as e:
+            logger.error("❌ Shared state: could not record %s: %s", txn.txn_id, e)
+    
+    def transaction_owner(self, txn_id: str) -> Optional[int]:
+        row = self._db().execute("SELECT worker FROM transactions WHERE txn_id = ?", (txn_id,)).fetchone()
+        return row[0] if row is not None else None
+    
+    def forget_worker(self):
+        """Drop this worker's terminals and transactions, e.g. when it starts or stops"""
+        db = self._db()
+        db.execute("DELETE FROM terminals WHERE worker = ?", (self.worker_id,))
+        db.execute("DELETE FROM transactions WHERE worker = ?", (self.worker_id,))
+    
+    def call(self, worker_id: int, request: Dict[str, Any], timeout: float = 10.0) -> Dict[str, Any]:
+        """Send one request to another worker's control socket and return its reply"""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(self.control_path(worker_id))
+            sock.sendall((json.dumps(request) + "\n").encode('utf-8'))
+            with sock.makefile("rb") as reply:
+                line = reply.readline()
+        if not line:
+            raise ConnectionError(f"worker {worker_id} closed the control connection")
+        return json.loads(line)
+
+
+class SharedNonceCache:
+    """NonceReplayCache interface over SharedState, so a nonce seen by any worker is rejected by all"""
+    
+    def __init__(self, state: SharedState):
+        self.state = state
+    
+    def add(self, nonce: str, now_ms: Optional[int] = None) -> bool:
+        return self.state.add_nonce(nonce, now_ms)
+    
+    def clear(self):
+        self.state.clear_nonces()
+    
+    def __len__(self) -> int:
+        return self.state.nonce_count()
+
+
+class ControlServer:
+    """Unix-socket endpoint through which other workers hand requests to this one
+    
+    Requests and replies are single JSON lines. Access is limited by the
+    socket's file mode, so only the Kiosk's own user can connect.
+    """
+    
+    class _Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    reply = self.server.handle_request_message(json.loads(line))
+                except Exception as e:
+                    reply = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                self.wfile.write((json.dumps(reply) + "\n").encode('utf-8'))
+    
+    def __init__(self, path: str, handler: Callable[[Dict[str, Any]], Dict[str, Any]]):
+        self.path = path
+        self.handler = handler
+        self._server: Optional[socketserver.ThreadingUnixStreamServer] = None
+    
+    def start(self):
+        """Bind the socket and serve it in a daemon thread"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = socketserver.ThreadingUnixStreamServer(self.path, self._Handler)
+        self._server.daemon_threads = True
+        self._server.handle_request_message = self.handler
+        os.chmod(self.path, 0o600)
+        thread = threading.Thread(target=self._server.serve_forever, name="kiosk-control")
+        thread.daemon = True
+        thread.start()
+    
+    def stop(self):
+        """Stop serving and remove the socket"""
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class SocketHandoff:
+    """Unix-socket rendezvous through which a restarting Kiosk takes over the running one's sockets
+    
+    The running Kiosk serves `path`. A new process given the same path
+    connects, and the running one passes it the listening socket and its
+    POS connections as file descriptors (SCM_RIGHTS), followed by a JSON
+    snapshot of the state that goes with them. The new process adopts them
+    and replies; until that reply, the running Kiosk can carry on as if
+    nothing happened. Requests and replies are single JSON lines. Access is
+    limited by the socket's file mode, as for ControlServer.
+    """
+    
+    # Linux passes at most 253 descriptors in one message
+    FDS_PER_MESSAGE = 250
+    _LENGTH = struct.Struct("<I")
+    
+    def __init__(self, path: str, timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self._sock: Optional[socket.socket] = None
+        self._inode = 0
+    
+    def serve(self, hand_off: Callable[[socket.socket], None]):
+        """Bind the socket, replacing one left by an earlier process, and pass each caller to hand_off"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        sock.listen(1)
+        self._inode = os.stat(self.path).st_ino
+        self._sock = sock
+        thread = threading.Thread(target=self._accept, args=(sock, hand_off), name="kiosk-handoff")
+        thread.daemon = True
+        thread.start()
+    
+    def _accept(self, sock: socket.socket, hand_off: Callable[[socket.socket], None]):
+        while True:
+            try:
+                channel, _ = sock.accept()
+            except OSError:
+                return
+            with channel:
+                channel.settimeout(self.timeout)
+                try:
+                    hand_off(channel)
+                except Exception as e:
+                    logger.error("❌ Handoff failed: %s", e)
+    
+    def stop(self):
+        """Stop serving; the socket file stays if a newer process has bound the path since"""
+        sock, self._sock = self._sock, None
+        if sock is None:
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+        try:
+            if os.stat(self.path).st_ino == self._inode:
+                os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def take_over(self) -> Optional[Tuple[socket.socket, Dict[str, Any], List[int]]]:
+        """Ask the Kiosk serving path for its sockets
+        
+        Returns the channel to reply on, the snapshot and the descriptors,
+        the listening socket's first; None if no Kiosk is serving path.
+        """
+        channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        channel.settimeout(self.timeout)
+        try:
+            channel.connect(self.path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            channel.close()
+            return None
+        try:
+            self.send_line(channel, {"op": "handoff", "pid": os.getpid()})
+            snapshot, fds = self.receive(channel)
+        except Exception:
+            channel.close()
+            raise
+        return channel, snapshot, fds
+    
+    @staticmethod
+    def send_line(channel: socket.socket, message: Dict[str, Any]):
+        channel.sendall((json.dumps(message) + "\n").encode('utf-8'))
+    
+    @staticmethod
+    def read_line(channel: socket.socket) -> Dict[str, Any]:
+        # Each side sends nothing more until it is answered, so the reader cannot over-read
+        with channel.makefile("rb") as reader:
+            line = reader.readline()
+        if not line:
+            raise ConnectionError("handoff channel closed")
+        return json.loads(line)
+    
+    @classmethod
+    def send(cls, channel: socket.socket, snapshot: Dict[str, Any], fds: Sequence[int]):
+        """Send the descriptors, a batch per one-byte message, then the length-prefixed snapshot"""
+        for start in range(0, len(fds), cls.FDS_PER_MESSAGE):
+            batch = array.array("i", fds[start:start + cls.FDS_PER_MESSAGE])
+            channel.sendmsg([b"F"], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, batch)])
+        body = json.dumps(snapshot, separators=(',', ':')).encode('utf-8')
+        channel.sendall(b"S" + cls._LENGTH.pack(len(body)) + body)
+    
+    @classmethod
+    def receive(cls, channel: socket.socket) -> Tuple[Dict[str, Any], List[int]]:
+        """Receive what send() sent; once it returns, the caller must close the descriptors it does not keep"""
+        fds: List[int] = []
+        space = socket.CMSG_SPACE(cls.FDS_PER_MESSAGE * array.array("i").itemsize)
+        try:
+            while True:
+                marker, ancillary, flags, _ = channel.recvmsg(1, space)
+                for level, kind, data in ancillary:
+                    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                        batch = array.array("i")
+                        batch.frombytes(data[:len(data) - len(data) % batch.itemsize])
+                        fds.extend(batch)
+                if flags & socket.MSG_CTRUNC:
+                    raise OSError("descriptors were truncated; is the open file limit too low?")
+                if marker == b"S":
+                    break
+                if marker != b"F":
+                    raise ConnectionError("handoff channel closed")
+            
+            with channel.makefile("rb") as reader:
+                header = reader.read(cls._LENGTH.size)
+                if len(header) < cls._LENGTH.size:
+                    raise ConnectionError("handoff channel closed")
+                (length,) = cls._LENGTH.unpack(header)
+                body = reader.read(length)
+            if len(body) < length:
+                raise ConnectionError("handoff channel closed")
+            return json.loads(body), fds
+        except Exception:
+            for fd in fds:
+                os.close(fd)
+            raise
@@ -0,0 +1,294 @@
+"""
+Message signing and replay protection for the MobyPay Kiosk protocol
+HMAC-SHA256 signatures over the canonical JSON payload, the timestamp
+window and the nonce cache
+"""
+
+import logging
+import json
+import time
+import threading
+import hmac
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Dict, Any, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from kiosk_metrics import metrics
+
+logger = logging.getLogger("mobypay.kiosk")
+
+# Accepted clock difference between a message timestamp and the Kiosk
+TIMESTAMP_WINDOW_MS = 60000
+
+
+class NonceReplayCache:
+    """Replay cache that remembers each nonce while its message could still be accepted
+    
+    A message timestamp may be up to window_ms away from the current time in
+    either direction, so a nonce is kept for 2 * window_ms after it is seen.
+    Nonces are grouped into bucket_ms wide time buckets and whole buckets are
+    evicted once they fall out of that span, so memory follows the message
+    rate per window and eviction costs O(1) per nonce. Nonces are spread over
+    independently locked shards so concurrent connections rarely contend.
+    """
+    
+    class _Shard:
+        __slots__ = ("lock", "nonces", "buckets")
+        
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.nonces: Set[str] = set()
+            self.buckets = deque()  # (bucket number, [nonces]) oldest first
+    
+    def __init__(self, window_ms: int = TIMESTAMP_WINDOW_MS, bucket_ms: int = 5000, shards: int = 16):
+        self.window_ms = window_ms
+        self.bucket_ms = bucket_ms
+        self._retained_buckets = -(-2 * window_ms // bucket_ms) + 1
+        self._shards = [self._Shard() for _ in range(shards)]
+    
+    def add(self, nonce: str, now_ms: Optional[int] = None) -> bool:
+        """Record a nonce; return False if it was already seen inside the window"""
+        if now_ms is None:
+            now_ms = int(time.time() * 1000)
+        bucket = now_ms // self.bucket_ms
+        shard = self._shards[hash(nonce) % len(self._shards)]
+        
+        with shard.lock:
+            self._expire(shard, bucket)
+            
+            if nonce in shard.nonces:
+                return False
+            shard.nonces.add(nonce)
+            
+            buckets = shard.buckets
+            # A clock stepping backwards files nonces under the newest bucket
+            if not buckets or buckets[-1][0] < bucket:
+                buckets.append((bucket, [nonce]))
+            else:
+                buckets[-1][1].append(nonce)
+        
+        return True
+    
+    def _expire(self, shard: "NonceReplayCache._Shard", bucket: int):
+        """Drop every bucket of a shard that is older than the retention span"""
+        oldest = bucket - self._retained_buckets
+        buckets = shard.buckets
+        while buckets and buckets[0][0] <= oldest:
+            _, nonces = buckets.popleft()
+            shard.nonces.difference_update(nonces)
+    
+    def clear(self):
+        """Forget every nonce"""
+        for shard in self._shards:
+            with shard.lock:
+                shard.nonces.clear()
+                shard.buckets.clear()
+    
+    def entries(self) -> List[Tuple[str, int]]:
+        """(nonce, milliseconds) for every nonce held, oldest first, to seed another cache"""
+        entries = []
+        for shard in self._shards:
+            with shard.lock:
+                for bucket, nonces in shard.buckets:
+                    entries.extend((nonce, bucket * self.bucket_ms) for nonce in nonces)
+        entries.sort(key=lambda entry: entry[1])
+        return entries
+    
+    def load(self, entries: Sequence[Tuple[str, int]]):
+        """Remember nonces from entries(), each in the bucket it was seen in"""
+        for nonce, now_ms in entries:
+            self.add(nonce, now_ms)
+    
+    def __len__(self) -> int:
+        return sum(len(shard.nonces) for shard in self._shards)
+
+
+class SignatureCheck(NamedTuple):
+    """Outcome of verifying one payload signature"""
+    
+    valid: bool
+    expected: str
+    canonical: bytes
+
+
+class MessageSigner:
+    """HMAC-SHA256 signer with a prebuilt key context
+    
+    The keyed HMAC state is built once and copied per message, and payloads
+    are canonicalised (sorted keys, compact separators, UTF-8) by one reused
+    encoder. Signatures are byte-identical to hashing
+    json.dumps(payload, sort_keys=True, separators=(',', ':')) with the secret.
+    """
+    
+    def __init__(self, secret: str):
+        self.secret = secret
+        self._mac = hmac.new(secret.encode('utf-8'), digestmod='sha256')
+        self._encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'), check_circular=False)
+    
+    def canonicalize(self, payload: Dict[str, Any]) -> bytes:
+        """Serialise a payload exactly as it is signed"""
+        return self._encoder.encode(payload).encode('utf-8')
+    
+    def sign_canonical(self, canonical: bytes) -> str:
+        """Sign an already canonicalised payload"""
+        mac = self._mac.copy()
+        mac.update(canonical)
+        return mac.hexdigest()
+    
+    def sign(self, payload: Dict[str, Any]) -> str:
+        return self.sign_canonical(self.canonicalize(payload))
+    
+    def verify(self, payload: Dict[str, Any], signature: str) -> SignatureCheck:
+        """Verify a signature, keeping the canonical form and expected value for diagnostics"""
+        canonical = self.canonicalize(payload)
+        expected = self.sign_canonical(canonical)
+        return SignatureCheck(hmac.compare_digest(expected, signature), expected, canonical)
+
+
+class SecurityHelper:
+    """Security helper for message signing and validation"""
+    
+    SHARED_SECRET = "POS-KIOSK-SECRET-KEY-2024"
+    _nonce_cache = NonceReplayCache()
+    _signer: Optional[MessageSigner] = None
+    
+    @staticmethod
+    def signer() -> MessageSigner:
+        """Signer for the current SHARED_SECRET, rebuilt if the secret was changed"""
+        signer = SecurityHelper._signer
+        if signer is None or signer.secret != SecurityHelper.SHARED_SECRET:
+            signer = SecurityHelper._signer = MessageSigner(SecurityHelper.SHARED_SECRET)
+        return signer
+    
+    @staticmethod
+    def generate_signature(payload: Dict[str, Any]) -> str:
+        """Generate HMAC-SHA256 signature for payload"""
+        return SecurityHelper.signer().sign(payload)
+    
+    @staticmethod
+    def verify_signature(payload: Dict[str, Any], signature: str) -> bool:
+        """Verify HMAC-SHA256 signature"""
+        return SecurityHelper.signer().verify(payload, signature).valid
+    
+    @staticmethod
+    def validate_nonce(nonce: str, now_ms: Optional[int] = None) -> bool:
+        """Validate nonce to prevent replay attacks"""
+        return SecurityHelper._nonce_cache.add(nonce, now_ms)
+    
+    @staticmethod
+    def validate_timestamp(timestamp: str, current_time: Optional[int] = None) -> bool:
+        """Validate timestamp (within 60 seconds)"""
+        try:
+            request_time = int(timestamp)
+            if current_time is None:
+                current_time = int(datetime.now().timestamp() * 1000)
+            difference = abs(current_time - request_time)
+            logger.debug("🕐 Timestamp validation - Request: %s, Current: %s, Diff: %sms", request_time, current_time, difference)
+            
+            if difference >= TIMESTAMP_WINDOW_MS:
+                logger.info("❌ Timestamp failed: Request too old/new (diff: %sms > %sms)", difference, TIMESTAMP_WINDOW_MS)
+                return False
+            
+            logger.debug("✅ Timestamp valid: Within 60 second window")
+            return True
+        except (ValueError, TypeError) as e:
+            logger.info("❌ Timestamp failed: Invalid format '%s' - %s: %s", timestamp, type(e).__name__, e)
+            return False
+    
+    @staticmethod
+    def generate_nonce() -> str:
+        """Generate unique nonce"""
+        return str(uuid.uuid4())
+    
+    @staticmethod
+    def get_current_timestamp() -> str:
+        """Get current timestamp in milliseconds"""
+        return str(int(datetime.now().timestamp() * 1000))
+    
+    @staticmethod
+    def create_secure_message(data: Dict[str, Any]) -> Dict[str, Any]:
+        """Create secure message with payload and signature"""
+        timestamp = SecurityHelper.get_current_timestamp()
+        nonce = SecurityHelper.generate_nonce()
+        
+        payload = {
+            **data,
+            "timestamp": timestamp,
+            "nonce": nonce
+        }
+        
+        signature = SecurityHelper.signer().sign(payload)
+        
+        return {
+            "payload": payload,
+            "signature": signature
+        }
+    
+    @staticmethod
+    def validate_secure_message(message: Dict[str, Any]) -> Dict[str, Any]:
+        """Validate secure message and return result"""
+        return SecurityHelper._validate(message, SecurityHelper.signer(), None)
+    
+    @staticmethod
+    def validate_secure_messages(messages: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Validate several messages decoded from one read; results are in input order"""
+        signer = SecurityHelper.signer()
+        now_ms = int(datetime.now().timestamp() * 1000)
+        return [SecurityHelper._validate(message, signer, now_ms) for message in messages]
+    
+    @staticmethod
+    def _validate(message: Dict[str, Any], signer: MessageSigner, now_ms: Optional[int]) -> Dict[str, Any]:
+        """Validate one secure message with a given signer and clock reading"""
+        try:
+            if "payload" not in message or "signature" not in message:
+                return {"is_valid": False, "error": "Missing payload or signature"}
+            
+            payload = message["payload"]
+            signature = message["signature"]
+            
+            # Verify signature
+            started = time.perf_counter()
+            check = signer.verify(payload, signature)
+            metrics.observe("kiosk_signature_verify_seconds", time.perf_counter() - started)
+            if not check.valid:
+                if logger.isEnabledFor(logging.DEBUG):
+                    # The expected signature was computed by verify; reuse it for debugging
+                    expected_signature = check.expected
+                    logger.debug(
+                        "🔐 Signature verification FAILED:\n"
+                        "   📨 Received signature: %s\n"
+                        "   🔑 Expected signature: %s\n"
+                        "   📋 Payload: %s\n"
+                        "   ❌ Signatures match: %s\n"
+                        "   🔍 Length comparison - Received: %s, Expected: %s",
+                        signature, expected_signature, check.canonical.decode('utf-8'),
+                        signature == expected_signature, len(signature), len(expected_signature)
+                    )
+                return {"is_valid": False, "error": "Invalid signature"}
+            elif logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "🔐 Signature verification PASSED:\n"
+                    "   ✅ Signature matches expected value\n"
+                    "   📨 Signature: %s...%s",
+                    signature[:16], signature[-16:]
+                )
+            
+            # Validate nonce
+            if "nonce" not in payload:
+                return {"is_valid": False, "error": "Missing nonce"}
+            
+            if not SecurityHelper.validate_nonce(payload["nonce"], now_ms):
+                return {"is_valid": False, "error": "Invalid or duplicate nonce"}
+            
+            # Validate timestamp
+            if "timestamp" not in payload:
+                return {"is_valid": False, "error": "Missing timestamp"}
+            
+            if not SecurityHelper.validate_timestamp(payload["timestamp"], now_ms):
+                return {"is_valid": False, "error": "Request expired or invalid timestamp"}
+            
+            return {"is_valid": True, "payload": payload}
+            
+        except Exception as e:
+            return {"is_valid": False, "error": f"Message validation error: {str(e)}"}
@@ -0,0 +1,521 @@
+"""
+Transactions of the MobyPay Kiosk
+Transaction states and the registry that moves them, IPP plan offers,
+payment handles and the idempotency cache
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import TYPE_CHECKING, Dict, Any, Callable, List, NamedTuple, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from kiosk import TcpSender
+
+logger = logging.getLogger("mobypay.kiosk")
+
+# Payments remembered by idempotency key, and for how many seconds
+DEFAULT_IDEMPOTENCY_CAPACITY = 10000
+DEFAULT_IDEMPOTENCY_TTL = 3600.0
+
+
+class TransactionState(Enum):
+    """Lifecycle states of a payment transaction"""
+    
+    REQUESTED = "requested"
+    ACKED = "acked"
+    IPP_PLANS = "ipp_plans"
+    PLAN_SELECTED = "plan_selected"
+    # Cancel sent; the terminal's confirmation or its result decides the outcome
+    CANCELLING = "cancelling"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    
+    @property
+    def is_final(self) -> bool:
+        return self in _FINAL_STATES
+
+
+_FINAL_STATES = {TransactionState.COMPLETED, TransactionState.FAILED, TransactionState.CANCELLED}
+
+
+@dataclass
+class Transaction:
+    """State of one payment transaction and the terminal that owns it"""
+    
+    txn_id: str
+    terminal: Optional[str]
+    payment_mode: str
+    amount: float
+    state: TransactionState = TransactionState.REQUESTED
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = 0.0
+    state_times: Dict[str, float] = field(default_factory=dict)
+    result: Optional[Dict[str, Any]] = None
+    # Set when the request could not be sent and the transaction was dropped
+    discarded: bool = False
+    # Results that arrived after the final state and contradict it, kept for reconciliation
+    conflicts: List[Dict[str, Any]] = field(default_factory=list)
+    
+    def __post_init__(self):
+        self.updated_at = self.created_at
+        self.state_times[self.state.value] = self.created_at
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """JSON-ready form, as journalled and as handed to a new process"""
+        return {
+            "txn_id": self.txn_id,
+            "terminal": self.terminal,
+            "payment_mode": self.payment_mode,
+            "amount": self.amount,
+            "state": self.state.value,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "state_times": self.state_times,
+            "result": self.result,
+            "conflicts": self.conflicts,
+        }
+    
+    @classmethod
+    def from_dict(cls, entry: Dict[str, Any], state: Optional[TransactionState] = None) -> "Transaction":
+        """Rebuild a transaction from to_dict(); state overrides the one recorded"""
+        txn = cls(entry["txn_id"], entry["terminal"], entry["payment_mode"], entry["amount"],
+                  state or TransactionState(entry["state"]), entry["created_at"], result=entry.get("result"))
+        txn.updated_at = entry["updated_at"]
+        txn.state_times = entry.get("state_times") or {}
+        txn.conflicts = entry.get("conflicts") or []
+        return txn
+
+
+class PendingCancel(NamedTuple):
+    """Timer wheel entry: a cancel the terminal has not confirmed yet"""
+    
+    txn_id: str
+    deadline: float
+
+
+class TransactionRegistry:
+    """Thread-safe table of transactions keyed by txn_id
+    
+    Active transactions are looked up in O(1) by txn_id. Finished ones are
+    kept for `retention` seconds so late or duplicate responses can still be
+    recognised, then evicted oldest first.
+    
+    Listeners are called with the transaction after it is created, after
+    every state change and after a discard, outside the registry lock, on
+    the thread that made the change. They must be quick and must not raise.
+    Two quick changes can reach listeners in either order. Recorders, such
+    as the journal, are called under the lock instead, so they see every
+    change in the order it was made, and also get conflicting results; they
+    must not call back into the registry.
+    """
+    
+    def __init__(self, retention: float = 300.0):
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._active: Dict[str, Transaction] = {}
+        self._finished: "OrderedDict[str, Transaction]" = OrderedDict()
+        self._outstanding: Dict[Optional[str], int] = {}
+        self._listeners: List[Callable[[Transaction], None]] = []
+        self._recorders: List[Callable[[Transaction], None]] = []
+    
+    def add_listener(self, listener: Callable[[Transaction], None]):
+        """Subscribe to transaction creation and state changes"""
+        self._listeners.append(listener)
+    
+    def add_recorder(self, recorder: Callable[[Transaction], None]):
+        """Subscribe to every change, in order, under the registry lock"""
+        self._recorders.append(recorder)
+    
+    def _record(self, txn: Transaction):
+        # Called with the lock held
+        for recorder in self._recorders:
+            try:
+                recorder(txn)
+            except Exception as e:
+                logger.error("❌ Transaction recorder failed: %s", e)
+    
+    def _notify(self, txn: Transaction):
+        for listener in self._listeners:
+            try:
+                listener(txn)
+            except Exception as e:
+                logger.error("❌ Transaction listener failed: %s", e)
+    
+    def create(self, txn_id: str, terminal: Optional[str], payment_mode: str, amount: float) -> Transaction:
+        """Register a new transaction in the requested state"""
+        txn = Transaction(txn_id, terminal, payment_mode, amount)
+        with self._lock:
+            self._evict(txn.created_at)
+            self._active[txn_id] = txn
+            self._outstanding[terminal] = self._outstanding.get(terminal, 0) + 1
+            self._record(txn)
+        self._notify(txn)
+        return txn
+    
+    def get(self, txn_id: Optional[str]) -> Optional[Transaction]:
+        """Look up a transaction, active or recently finished"""
+        with self._lock:
+            txn = self._active.get(txn_id)
+            return txn if txn is not None else self._finished.get(txn_id)
+    
+    def transition(self, txn_id: Optional[str], state: TransactionState,
+                   result: Optional[Dict[str, Any]] = None,
+                   expect: Optional[Sequence[TransactionState]] = None) -> Optional[Transaction]:
+        """Move an active transaction to a new state
+        
+        With `expect`, the move only happens from one of those states.
+        Returns the transaction, or None if it is unknown, already finished
+        or not in an expected state.
+        """
+        now = time.time()
+        with self._lock:
+            txn = self._active.get(txn_id)
+            if txn is None or (expect is not None and txn.state not in expect):
+                return None
+            
+            txn.state = state
+            txn.updated_at = now
+            txn.state_times[state.value] = now
+            if result is not None:
+                txn.result = result
+            
+            if state.is_final:
+                del self._active[txn_id]
+                self._finished[txn_id] = txn
+                self._release(txn.terminal)
+            
+            self._record(txn)
+            self._evict(now)
+        
+        self._notify(txn)
+        return txn
+    
+    def record_conflict(self, txn_id: Optional[str], response: Dict[str, Any]) -> Optional[Transaction]:
+        """Keep a result that contradicts a finished transaction's state; only recorders are called"""
+        with self._lock:
+            txn = self._finished.get(txn_id)
+            if txn is not None:
+                txn.conflicts.append(response)
+                self._record(txn)
+            return txn
+    
+    def reassign(self, old_terminal: str, new_terminal: str):
+        """Move active transactions to a terminal's new id"""
+        with self._lock:
+            for txn in self._active.values():
+                if txn.terminal == old_terminal:
+                    txn.terminal = new_terminal
+                    self._release(old_terminal)
+                    self._outstanding[new_terminal] = self._outstanding.get(new_terminal, 0) + 1
+    
+    def discard(self, txn_id: str):
+        """Forget an active transaction that never reached a terminal"""
+        with self._lock:
+            txn = self._active.pop(txn_id, None)
+            if txn is None:
+                return
+            txn.discarded = True
+            txn.updated_at = time.time()
+            self._release(txn.terminal)
+            self._record(txn)
+        self._notify(txn)
+    
+    def restore(self, txn: Transaction) -> bool:
+        """Reinstate a transaction, e.g. one recovered from the journal or handed over by a previous process
+        
+        Finished transactions are kept for the rest of their retention
+        period; restore them oldest first.
+        """
+        with self._lock:
+            if txn.txn_id in self._active or txn.txn_id in self._finished:
+                return False
+            if txn.state.is_final:
+                self._finished[txn.txn_id] = txn
+                return True
+            self._active[txn.txn_id] = txn
+            self._outstanding[txn.terminal] = self._outstanding.get(txn.terminal, 0) + 1
+            return True
+    
+    def active(self, terminal: Optional[str] = None) -> List[Transaction]:
+        """Return active transactions, optionally only those owned by one terminal"""
+        with self._lock:
+            return [txn for txn in self._active.values()
+                    if terminal is None or txn.terminal == terminal]
+    
+    def finished(self) -> List[Transaction]:
+        """Finished transactions still retained, oldest first"""
+        with self._lock:
+            return list(self._finished.values())
+    
+    def outstanding(self, terminal: Optional[str]) -> int:
+        """Number of active transactions owned by a terminal"""
+        return self._outstanding.get(terminal, 0)
+    
+    def has_active(self) -> bool:
+        return bool(self._active)
+    
+    def _release(self, terminal: Optional[str]):
+        count = self._outstanding.get(terminal, 0) - 1
+        if count > 0:
+            self._outstanding[terminal] = count
+        else:
+            self._outstanding.pop(terminal, None)
+    
+    def _evict(self, now: float):
+        """Drop finished transactions older than the retention period"""
+        finished = self._finished
+        while finished:
+            txn_id, txn = next(iter(finished.items()))
+            if now - txn.updated_at < self.retention:
+                break
+            finished.popitem(last=False)
+    
+    def __len__(self) -> int:
+        return len(self._active)
+
+
+@dataclass
+class IppPlan:
+    """One installment plan offered by a terminal"""
+    
+    plan_id: str
+    frequency: str
+    total_installments: int
+    installments: List[Dict[str, Any]]
+    
+    @classmethod
+    def from_dict(cls, plan: Dict[str, Any]) -> "IppPlan":
+        return cls(
+            plan_id=str(plan.get("planId") or ""),
+            frequency=str(plan.get("frequency") or ""),
+            total_installments=int(plan.get("totalInstallments") or 0),
+            installments=list(plan.get("installmentDetails") or []),
+        )
+    
+    @property
+    def total_fee(self) -> float:
+        """Sum of the installment fees, in RM"""
+        return sum(float(detail.get("installmentFee") or 0) for detail in self.installments)
+
+
+@dataclass
+class PlanOffer:
+    """IPP plans a terminal offered for one transaction, awaiting a selection
+    
+    `selection` resolves with the planId sent to the terminal, or with None
+    once the offer is declined, times out or its transaction finishes.
+    """
+    
+    txn_id: str
+    amount: float
+    plans: List[IppPlan]
+    # The transaction_result frame as received, forwarded as-is in prefork mode
+    response: Dict[str, Any]
+    deadline: float
+    offered_at: float = field(default_factory=time.time)
+    selection: concurrent.futures.Future = field(default_factory=concurrent.futures.Future)
+    
+    @classmethod
+    def from_response(cls, response: Dict[str, Any], deadline: float) -> "PlanOffer":
+        plans = [IppPlan.from_dict(plan) for plan in response.get("plans") or [] if isinstance(plan, dict)]
+        return cls(str(response.get("txn_id") or ""), float(response.get("amount") or 0),
+                   [plan for plan in plans if plan.plan_id], response, deadline)
+    
+    def plan(self, plan_id: str) -> Optional[IppPlan]:
+        for plan in self.plans:
+            if plan.plan_id == plan_id:
+                return plan
+        return None
+
+
+# Picks the planId to send for an offer, or None to leave the choice to the operator
+PlanPolicy = Callable[[PlanOffer], Optional[str]]
+
+
+def lowest_fee_plan(offer: PlanOffer) -> Optional[str]:
+    """Plan policy: the plan with the smallest total fee, the first offered on a tie"""
+    if not offer.plans:
+        return None
+    return min(offer.plans, key=lambda plan: plan.total_fee).plan_id
+
+
+def plan_by_id(plan_id: str) -> PlanPolicy:
+    """Plan policy: always `plan_id` when the terminal offers it"""
+    def choose(offer: PlanOffer) -> Optional[str]:
+        return plan_id if offer.plan(plan_id) is not None else None
+    return choose
+
+
+@dataclass
+class PaymentResult:
+    """Outcome of a payment made with TcpSender.pay()"""
+    
+    txn_id: str
+    state: TransactionState
+    # The terminal's status, or "timeout" / "cancelled" when the Kiosk ended the payment
+    status: str
+    authorization_code: Optional[str] = None
+    card_last4: Optional[str] = None
+    # Plans the terminal offered, for IPP payments
+    plans: List[IppPlan] = field(default_factory=list)
+    plan_id: Optional[str] = None
+    message: Optional[str] = None
+    response: Optional[Dict[str, Any]] = None
+    elapsed: float = 0.0
+    
+    @property
+    def succeeded(self) -> bool:
+        return self.state == TransactionState.COMPLETED
+
+
+class PaymentHandle:
+    """A payment in progress: futures for its ACK and its PaymentResult
+    
+    `acked` resolves once the terminal acknowledges the request, `future`
+    with the PaymentResult once the transaction finishes. Wait with
+    result(), or `await` the handle from a coroutine. A stage that outlasts
+    its timeout cancels the payment on the terminal, and the result then
+    has status "timeout" once the terminal confirms the cancel. A result
+    the terminal sends before confirming still decides the payment.
+    """
+    
+    def __init__(self, sender: "TcpSender", txn_id: str, sent: concurrent.futures.Future,
+                 ack_timeout: Optional[float] = None, result_timeout: Optional[float] = None,
+                 payment_mode: str = "", amount: float = 0.0):
+        self.sender = sender
+        self.txn_id = txn_id
+        self.sent = sent
+        self.payment_mode = payment_mode
+        self.amount = amount
+        self.ack_timeout = ack_timeout
+        self.result_timeout = result_timeout
+        self.acked: concurrent.futures.Future = concurrent.futures.Future()
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+        self.plans: List[IppPlan] = []
+        self.timed_out: Optional[str] = None
+        self._lock = threading.Lock()
+        self._state: Optional[TransactionState] = None
+        # Monotonic deadline of the current stage, and of the wheel entry that will check it
+        self.deadline: Optional[float] = None
+        self._due: Optional[float] = None
+    
+    def result(self, timeout: Optional[float] = None) -> PaymentResult:
+        """Block until the payment finishes"""
+        return self.future.result(timeout)
+    
+    def cancel(self) -> Optional[concurrent.futures.Future]:
+        """Cancel the payment on the terminal; the handle resolves as cancelled once the terminal confirms"""
+        return self.sender.cancel_transaction(self.txn_id)
+    
+    def done(self) -> bool:
+        return self.future.done()
+    
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+    
+    def _stage_timeout(self, state: TransactionState) -> Optional[float]:
+        if state == TransactionState.REQUESTED:
+            return self.ack_timeout
+        if state in (TransactionState.ACKED, TransactionState.PLAN_SELECTED):
+            return self.result_timeout
+        # Plan offers have their own timeout (plan_timeout), and cancels CANCEL_TIMEOUT
+        return None
+    
+    def _update(self, txn: Transaction) -> Optional[float]:
+        """Follow a transaction change; returns a new stage deadline to schedule, if any"""
+        with self._lock:
+            if self.future.done() or txn.state == self._state:
+                return None
+            self._state = txn.state
+            
+            if txn.state == TransactionState.IPP_PLANS and txn.result:
+                self.plans = PlanOffer.from_response(txn.result, 0).plans
+            finished = txn.discarded or txn.state.is_final
+            if not self.acked.done():
+                if not finished and txn.state not in (TransactionState.REQUESTED, TransactionState.CANCELLING):
+                    self.acked.set_result(True)
+                elif finished and (txn.result or {}).get("type") == "transaction_result":
+                    # A result without an ACK still shows the terminal took the request
+                    self.acked.set_result(True)
+                elif finished:
+                    self.acked.set_exception(ConnectionError(f"{self.txn_id} finished without an ACK"))
+            
+            if finished:
+                self.future.set_result(self._result(txn))
+                return None
+            
+            timeout = self._stage_timeout(txn.state)
+            self.deadline = time.monotonic() + timeout if timeout is not None else None
+            if self.deadline is not None and (self._due is None or self.deadline < self._due):
+                self._due = self.deadline
+                return self.deadline
+            return None
+    
+    def _result(self, txn: Transaction) -> PaymentResult:
+        response = txn.result or {}
+        state = TransactionState.FAILED if txn.discarded else txn.state
+        message = response.get("message")
+        if state == TransactionState.CANCELLED:
+            status = "timeout" if self.timed_out else "cancelled"
+            if self.timed_out:
+                message = f"no {self.timed_out} in time"
+        else:
+            status = str(response.get("status") or response.get("type") or state.value)
+        return PaymentResult(
+            txn_id=self.txn_id,
+            state=state,
+            status=status,
+            authorization_code=response.get("authorization_code"),
+            card_last4=response.get("card_last4"),
+            plans=self.plans,
+            plan_id=response.get("plan_id"),
+            message=message,
+            response=txn.result,
+            elapsed=txn.updated_at - txn.created_at,
+        )
+
+
+class IdempotencyCache:
+    """Payments by idempotency key: a bounded LRU map whose entries expire
+    
+    get() and put() are O(1). An entry lives `ttl` seconds from when it is
+    added; once `capacity` keys are held, the least recently used is
+    dropped. Not thread-safe; TcpSender serialises access.
+    """
+    
+    def __init__(self, capacity: int = DEFAULT_IDEMPOTENCY_CAPACITY, ttl: float = DEFAULT_IDEMPOTENCY_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[PaymentHandle, float]]" = OrderedDict()
+    
+    def get(self, key: str, now: Optional[float] = None) -> Optional[PaymentHandle]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if (now if now is not None else time.monotonic()) >= entry[1]:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+    
+    def put(self, key: str, handle: PaymentHandle, now: Optional[float] = None):
+        if now is None:
+            now = time.monotonic()
+        self._entries[key] = (handle, now + self.ttl)
+        self._entries.move_to_end(key)
+        # Expired entries at the cold end go first, then whatever exceeds the capacity
+        while self._entries:
+            oldest = next(iter(self._entries.values()))
+            if oldest[1] > now and len(self._entries) <= self.capacity:
+                break
+            self._entries.popitem(last=False)
+    
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,616 @@
+"""
+Connections of the MobyPay Kiosk
+TCP keepalive and TLS, the timer wheel, send queues, admission control
+and the routing of payments to POS connections
+"""
+
+import concurrent.futures
+import logging
+import socket
+import ssl
+import time
+import threading
+from collections import deque
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+from kiosk_metrics import metrics
+from kiosk_codec import DEFAULT_MAX_FRAME_SIZE, JSON_CODEC, MessageFramer, WireCodec
+from kiosk_transactions import TransactionRegistry
+from kiosk_journal import TrafficCapture
+
+logger = logging.getLogger("mobypay.kiosk")
+
+# Idle connections are pinged after HEARTBEAT_INTERVAL seconds; terminals that
+# answer pings are closed after IDLE_TIMEOUT seconds without any frame
+DEFAULT_HEARTBEAT_INTERVAL = 30.0
+DEFAULT_IDLE_TIMEOUT = 90.0
+
+# Bytes that may wait in one terminal's send queue before new frames are refused
+DEFAULT_SEND_QUEUE_BYTES = 1024 * 1024
+
+# Frames a POS connection may send per second on average, and in one burst
+DEFAULT_RATE_LIMIT = 50.0
+DEFAULT_RATE_BURST = 100
+
+# Rejected frames that get a connection closed, and how long its host is then refused
+DEFAULT_QUARANTINE_AFTER = 50
+DEFAULT_QUARANTINE_SECONDS = 60.0
+
+
+def configure_keepalive(sock, idle: float, interval: float = 10.0, count: int = 3):
+    """Enable TCP keepalive so the kernel detects peers that vanished without a FIN
+    
+    Probing starts after `idle` seconds of silence and the connection fails
+    after `count` unanswered probes. Where TCP_USER_TIMEOUT exists, unacked
+    writes to a dead peer fail after the same time instead of blocking for
+    the kernel default of ~15 minutes. Options the platform lacks are skipped.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    options = [
+        # macOS calls TCP_KEEPIDLE TCP_KEEPALIVE
+        (getattr(socket, "TCP_KEEPIDLE", getattr(socket, "TCP_KEEPALIVE", None)), max(1, int(idle))),
+        (getattr(socket, "TCP_KEEPINTVL", None), max(1, int(interval))),
+        (getattr(socket, "TCP_KEEPCNT", None), count),
+        (getattr(socket, "TCP_USER_TIMEOUT", None), int((idle + interval * count) * 1000)),
+    ]
+    for option, value in options:
+        if option is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+            except OSError as e:
+                logger.debug("TCP option %s not set: %s", option, e)
+
+
+def create_tls_context(certfile: str, keyfile: Optional[str] = None, cafile: Optional[str] = None,
+                       require_client_cert: bool = False) -> ssl.SSLContext:
+    """Server-side TLS context for POS connections
+    
+    With `cafile`, terminals may present a client certificate signed by
+    that CA; `require_client_cert` makes it mandatory (mutual TLS). Use
+    one context for every connection: resumed sessions and session tickets
+    only work within the context that issued them. Created before the
+    prefork workers start, the ticket keys are shared by all of them.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.options |= getattr(ssl, "OP_NO_RENEGOTIATION", 0)
+    context.load_cert_chain(certfile, keyfile)
+    if cafile:
+        context.load_verify_locations(cafile)
+        context.verify_mode = ssl.CERT_REQUIRED if require_client_cert else ssl.CERT_OPTIONAL
+    elif require_client_cert:
+        raise ValueError("require_client_cert needs a CA file to verify terminals against")
+    return context
+
+
+def certificate_name(certificate: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Common name of a peer certificate as returned by getpeercert(), if any"""
+    for rdn in (certificate or {}).get("subject", ()):
+        for key, value in rdn:
+            if key == "commonName":
+                return value
+    return None
+
+
+class TlsStream:
+    """A TLS connection that one thread reads while others write
+    
+    The thread engine reads a connection on one thread and writes it on
+    another, and so does the POS client (pos_client.py). An ssl.SSLSocket
+    must not be used that way: an SSL object may only be used by one
+    thread at a time. TlsStream runs TLS over memory BIOs instead. The SSL
+    object is only touched under a lock and never blocks; socket reads and
+    writes happen outside it. Encrypted output is sent in the order it was
+    produced, because the send lock is taken before the SSL lock is
+    released.
+    
+    It offers the socket methods the engine and the client use, so it
+    stands in for the socket. It is the server side unless server_hostname
+    is given; a client can offer a saved session to resume.
+    """
+    
+    RECV_SIZE = 65536
+    
+    def __init__(self, sock: socket.socket, context: ssl.SSLContext, server_hostname: Optional[str] = None,
+                 session: Optional[ssl.SSLSession] = None):
+        self.sock = sock
+        self._incoming = ssl.MemoryBIO()
+        self._outgoing = ssl.MemoryBIO()
+        self.ssl = context.wrap_bio(self._incoming, self._outgoing, server_side=server_hostname is None,
+                                    server_hostname=server_hostname, session=session)
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+    
+    def handshake(self, timeout: float):
+        """Complete the TLS handshake before the connection is used, within `timeout` seconds"""
+        self.sock.settimeout(timeout)
+        try:
+            while True:
+                with self._lock:
+                    try:
+                        self.ssl.do_handshake()
+                        done = True
+                    except ssl.SSLWantReadError:
+                        done = False
+                self._flush()
+                if done:
+                    return
+                data = self.sock.recv(self.RECV_SIZE)
+                if not data:
+                    raise ConnectionError("connection closed during the TLS handshake")
+                self._incoming.write(data)
+        finally:
+            self.sock.settimeout(None)
+    
+    def _flush(self):
+        """Send whatever the SSL object has produced; call without the SSL lock"""
+        self._lock.acquire()
+        try:
+            data = self._outgoing.read()
+            if not data:
+                return
+            self._send_lock.acquire()
+        finally:
+            self._lock.release()
+        try:
+            self.sock.sendall(data)
+        finally:
+            self._send_lock.release()
+    
+    def recv(self, bufsize: int) -> bytes:
+        """Decrypted bytes, or b"" once the peer has closed the connection"""
+        while True:
+            with self._lock:
+                try:
+                    data = self.ssl.read(bufsize)
+                except ssl.SSLWantReadError:
+                    data = None
+                except ssl.SSLZeroReturnError:
+                    data = b""
+            # Reading can produce output, e.g. a reply to a TLS 1.3 key update
+            self._flush()
+            if data is not None:
+                return data
+            
+            raw = self.sock.recv(self.RECV_SIZE)
+            if not raw:
+                return b""
+            with self._lock:
+                self._incoming.write(raw)
+    
+    def sendall(self, data: bytes):
+        with self._lock:
+            self.ssl.write(data)
+        self._flush()
+    
+    def settimeout(self, timeout: Optional[float]):
+        self.sock.settimeout(timeout)
+    
+    def shutdown(self, how: int):
+        self.sock.shutdown(how)
+    
+    def close(self):
+        self.sock.close()
+    
+    def fileno(self) -> int:
+        return self.sock.fileno()
+    
+    def getpeercert(self) -> Optional[Dict[str, Any]]:
+        return self.ssl.getpeercert()
+    
+    @property
+    def session(self) -> Optional[ssl.SSLSession]:
+        return self.ssl.session
+    
+    @property
+    def session_reused(self) -> bool:
+        return self.ssl.session_reused
+
+
+class TimerWheel:
+    """Hashed timer wheel for per-connection deadlines
+    
+    schedule() is O(1) and each tick only visits the slot that is due, so
+    checking thousands of idle connections costs nothing between their
+    deadlines. Entries are not moved when a connection shows activity: the
+    owner re-checks the real deadline when the entry comes due and schedules
+    it again (lazy rescheduling). Deadlines beyond the wheel's span land in
+    its furthest slot and are re-checked there. Items come due up to one
+    tick after their deadline, never before.
+    """
+    
+    def __init__(self, tick: float = 1.0, slots: int = 128):
+        self.tick = tick
+        self._slots: List[List[Any]] = [[] for _ in range(slots)]
+        self._lock = threading.Lock()
+        self._next_tick = int(time.monotonic() / tick)
+    
+    def schedule(self, item: Any, when: float):
+        """Queue item to be returned by the first advance() at or after `when`"""
+        with self._lock:
+            target = -int(-when // self.tick)
+            target = min(max(target, self._next_tick), self._next_tick + len(self._slots) - 1)
+            self._slots[target % len(self._slots)].append(item)
+    
+    def advance(self, now: float) -> List[Any]:
+        """Remove and return every item whose slot is due at `now`"""
+        due = []
+        with self._lock:
+            last = int(now / self.tick)
+            # After a long stall, one pass over the wheel covers every slot
+            first = max(self._next_tick, last - len(self._slots) + 1)
+            for tick in range(first, last + 1):
+                slot = self._slots[tick % len(self._slots)]
+                due.extend(slot)
+                slot.clear()
+            self._next_tick = max(self._next_tick, last + 1)
+        return due
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(slot) for slot in self._slots)
+
+
+class OutboundQueue:
+    """Frames waiting to be written to one POS connection
+    
+    put() never blocks: it appends the frame and returns a Future that
+    resolves once the whole frame has been handed to the socket, or fails
+    with the write error. The I/O layer takes everything queued at once and
+    writes it with a single call, so a burst of frames costs one system
+    call. Once max_bytes are waiting, put() raises BufferError rather than
+    let a stalled terminal grow the queue without bound. A frame whose
+    Future is cancelled before it is taken is never written.
+    
+    on_ready, if set, is called when a frame arrives in an empty queue.
+    """
+    
+    def __init__(self, max_bytes: int = DEFAULT_SEND_QUEUE_BYTES,
+                 on_ready: Optional[Callable[[], None]] = None):
+        self.max_bytes = max_bytes
+        self.on_ready = on_ready
+        self._cond = threading.Condition()
+        self._frames: deque = deque()
+        self._bytes = 0
+        self._error: Optional[Exception] = None
+    
+    @property
+    def pending_bytes(self) -> int:
+        return self._bytes
+    
+    @property
+    def closed(self) -> bool:
+        return self._error is not None
+    
+    def put(self, frame: bytes) -> concurrent.futures.Future:
+        """Queue a frame; raises ConnectionError once closed and BufferError when full"""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        with self._cond:
+            if self._error is not None:
+                raise ConnectionError("connection is closed")
+            # A frame larger than max_bytes still goes out on its own
+            if self._frames and self._bytes + len(frame) > self.max_bytes:
+                raise BufferError(f"send queue full ({self._bytes} bytes waiting)")
+            was_empty = not self._frames
+            self._frames.append((frame, future))
+            self._bytes += len(frame)
+            self._cond.notify()
+        
+        if was_empty and self.on_ready is not None:
+            self.on_ready()
+        return future
+    
+    def take(self, timeout: Optional[float] = 0) -> List[Tuple[bytes, concurrent.futures.Future]]:
+        """Remove and return every queued frame that has not been cancelled
+        
+        Waits up to timeout seconds (None: until a frame arrives or the
+        queue is closed); an empty list means nothing came. Cancelled
+        frames do not count, so a wait goes on past a batch of them.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                if timeout != 0:
+                    remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                    self._cond.wait_for(lambda: self._frames or self._error is not None, remaining)
+                batch = list(self._frames)
+                self._frames.clear()
+                self._bytes = 0
+                closed = self._error is not None
+
+            live = [(frame, future) for frame, future in batch if future.set_running_or_notify_cancel()]
+            if live or closed or timeout == 0 or (deadline is not None and time.monotonic() >= deadline):
+                return live
+    
+    def close(self, error: Optional[Exception] = None):
+        """Refuse further frames and fail the queued ones with error"""
+        with self._cond:
+            if self._error is None:
+                self._error = error or ConnectionError("connection closed")
+            batch = list(self._frames)
+            self._frames.clear()
+            self._bytes = 0
+            self._cond.notify_all()
+        
+        for _, future in batch:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(self._error)
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average and up to `burst` at once"""
+    
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+    
+    def take(self, count: int = 1, now: Optional[float] = None) -> int:
+        """Take up to count tokens; returns how many there were"""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        taken = min(count, int(self.tokens))
+        self.tokens -= taken
+        return taken
+
+
+class AdmissionControl:
+    """Admission stage for inbound frames, ahead of decoding and signature checks
+    
+    Each connection gets a token bucket of `rate` frames per second with
+    bursts of `burst`; frames beyond it are dropped unread. Frames that
+    cannot be a signed message are dropped after a byte scan
+    (WireCodec.plausible), without being parsed. Every rejected frame is a
+    strike against its connection, as are oversized frames, decode errors
+    and failed validation. Strikes drain at `quarantine_after` per
+    `strike_window` seconds, so a connection only collects
+    `quarantine_after` of them by misbehaving steadily. It is then closed,
+    and its host refused for `quarantine_seconds`.
+    
+    A rate of 0 turns rate limiting off; quarantine_after of 0 turns
+    quarantine off. Quarantine is per process: in prefork mode each
+    worker keeps its own.
+    """
+    
+    RATE = "rate"
+    OVERSIZE = "oversize"
+    MALFORMED = "malformed"
+    INVALID = "invalid"
+    
+    def __init__(self, rate: float = DEFAULT_RATE_LIMIT, burst: int = DEFAULT_RATE_BURST,
+                 quarantine_after: int = DEFAULT_QUARANTINE_AFTER, strike_window: float = 10.0,
+                 quarantine_seconds: float = DEFAULT_QUARANTINE_SECONDS):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.quarantine_after = quarantine_after
+        self.strike_window = strike_window
+        self.quarantine_seconds = quarantine_seconds
+        self._lock = threading.Lock()
+        # Host -> monotonic time its quarantine ends
+        self._quarantine: Dict[str, float] = {}
+    
+    def bucket(self) -> Optional[TokenBucket]:
+        """Rate limit for a new connection, or None when rate limiting is off"""
+        return TokenBucket(self.rate, self.burst) if self.rate > 0 else None
+    
+    def admit_host(self, host: str) -> bool:
+        """False, and counted, if a new connection comes from a quarantined host"""
+        with self._lock:
+            until = self._quarantine.get(host)
+            if until is None:
+                return True
+            if until <= time.monotonic():
+                del self._quarantine[host]
+                return True
+        metrics.inc("kiosk_quarantine_refusals_total")
+        logger.debug("🚧 Connection from quarantined host %s refused", host)
+        return False
+    
+    def admit(self, connection: "PosConnection", frames: List[bytes], codec: WireCodec) -> List[bytes]:
+        """The frames within the connection's rate limit that look like signed messages"""
+        if connection.bucket is not None:
+            allowed = connection.bucket.take(len(frames))
+            if allowed < len(frames):
+                self.reject(connection, self.RATE, len(frames) - allowed)
+                frames = frames[:allowed]
+        admitted = [frame for frame in frames if codec.plausible(frame)]
+        if len(admitted) < len(frames):
+            self.reject(connection, self.MALFORMED, len(frames) - len(admitted))
+        return admitted
+    
+    def reject(self, connection: "PosConnection", reason: str, count: int = 1):
+        """Count rejected frames against a connection, quarantining it once it has too many strikes"""
+        metrics.inc("kiosk_admission_rejections_total", reason, value=count)
+        connection.rejected += count
+        if not self.quarantine_after or connection.quarantined:
+            return
+        
+        now = time.monotonic()
+        # Whole strikes drain, so a quick run of quarantine_after of them is not a hair short
+        drained = int((now - connection.struck_at) * self.quarantine_after / self.strike_window)
+        if drained or not connection.strikes:
+            connection.strikes = max(0, connection.strikes - drained)
+            connection.struck_at = now
+        connection.strikes += count
+        if connection.strikes < self.quarantine_after:
+            return
+        
+        connection.quarantined = True
+        metrics.inc("kiosk_quarantines_total")
+        logger.warning("🚧 Closing %s (%s) after %s rejected frame(s); host quarantined for %.0fs",
+                       connection.terminal_id, connection.address, connection.rejected, self.quarantine_seconds)
+        if self.quarantine_seconds > 0:
+            self.quarantine_host(connection.host, self.quarantine_seconds)
+    
+    def quarantine_host(self, host: str, seconds: float):
+        """Refuse connections from host for the next `seconds`"""
+        with self._lock:
+            self._quarantine[host] = time.monotonic() + seconds
+    
+    def quarantined(self) -> Dict[str, float]:
+        """Quarantined hosts and the seconds each has left"""
+        now = time.monotonic()
+        with self._lock:
+            for host in [host for host, until in self._quarantine.items() if until <= now]:
+                del self._quarantine[host]
+            return {host: until - now for host, until in self._quarantine.items()}
+
+
+class PosConnection:
+    """One connected POS terminal
+    
+    terminal_id is the peer address until the terminal announces its own id
+    in a hello frame. last_seen is refreshed by every read; a terminal that
+    has answered a ping is expected to keep answering, and is marked not
+    responsive while a ping is overdue. Frames for the terminal go through
+    its outbound queue, which the connection engine drains. Every
+    connection starts with newline JSON until a hello negotiates a codec.
+    Over mutual TLS, peer_name is the common name of the terminal's
+    certificate. With a traffic capture, every frame encoded for the
+    terminal is also recorded there. bucket, rejected and strikes are the
+    connection's standing with AdmissionControl. In the thread engine,
+    writer is the thread draining the outbound queue; handed_off is set
+    once a new process has taken the connection over.
+    """
+    
+    def __init__(self, client, address: str, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE,
+                 outbound: Optional[OutboundQueue] = None):
+        self.client = client
+        self.outbound = outbound if outbound is not None else OutboundQueue()
+        self.codec: WireCodec = JSON_CODEC
+        self._send_lock = threading.Lock()
+        self.address = address
+        self.terminal_id = address
+        self.connected_at = time.time()
+        self.framer = MessageFramer(max_frame_size)
+        self.last_seen = time.monotonic()
+        self.last_ping = 0.0
+        self.answers_ping = False
+        self.responsive = True
+        self.peer_name: Optional[str] = None
+        self.capture: Optional[TrafficCapture] = None
+        self.capture_id = 0
+        self.bucket: Optional[TokenBucket] = None
+        self.rejected = 0
+        self.strikes = 0
+        self.struck_at = 0.0
+        self.quarantined = False
+        self.writer: Optional[threading.Thread] = None
+        self.handed_off = False
+    
+    @property
+    def host(self) -> str:
+        return self.address.rsplit(":", 1)[0]
+    
+    @property
+    def metrics_label(self) -> str:
+        """Terminal label for metrics; peer addresses would add a series per connection"""
+        return "unidentified" if self.terminal_id == self.address else self.terminal_id
+    
+    def send(self, message: Dict[str, Any], codec: Optional[WireCodec] = None) -> concurrent.futures.Future:
+        """Encode a message with the connection's codec and queue it
+        
+        With codec, every later frame in both directions uses that codec.
+        The switch happens under the lock that orders encoding, so no frame
+        queued after this one is encoded the old way. Only the thread that
+        reads the connection may pass codec, as it owns the framer.
+        """
+        with self._send_lock:
+            frame = self.codec.encode(message)
+            if self.capture is not None:
+                self.capture.outbound(self, frame, self.codec)
+            sent = self.outbound.put(frame)
+            if codec is not None and codec is not self.codec:
+                if self.framer.pending:
+                    logger.warning("❌ %s sent %s bytes before the codec switch; discarded",
+                                   self.terminal_id, self.framer.pending)
+                self.framer = codec.framer(self.framer.max_frame_size)
+                self.codec = codec
+            return sent
+
+
+class TerminalRouter:
+    """Maps connections to terminal ids and picks the terminal for each request
+    
+    Dispatch policies for requests that do not name a terminal:
+    - "first": the earliest connected terminal (the original behaviour)
+    - "least_outstanding": the terminal with the fewest active transactions
+    """
+    
+    FIRST = "first"
+    LEAST_OUTSTANDING = "least_outstanding"
+    POLICIES = (FIRST, LEAST_OUTSTANDING)
+    
+    def __init__(self, transactions: TransactionRegistry, policy: str = FIRST):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown dispatch policy: {policy}")
+        self.transactions = transactions
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._by_client: Dict[Any, PosConnection] = {}
+        self._by_terminal: Dict[str, PosConnection] = {}
+    
+    def register(self, connection: PosConnection):
+        """Add a newly accepted connection"""
+        with self._lock:
+            self._by_client[connection.client] = connection
+            self._by_terminal[connection.terminal_id] = connection
+    
+    def unregister(self, client) -> Optional[PosConnection]:
+        """Remove a connection; returns it, or None if it was already gone"""
+        with self._lock:
+            connection = self._by_client.pop(client, None)
+            if connection is not None and self._by_terminal.get(connection.terminal_id) is connection:
+                del self._by_terminal[connection.terminal_id]
+            return connection
+    
+    def identify(self, connection: PosConnection, terminal_id: str) -> Optional[PosConnection]:
+        """Bind a connection to the terminal id it announced
+        
+        Returns the previous connection of that terminal if it was still
+        registered; the caller should close it, as the terminal reconnected.
+        """
+        with self._lock:
+            if self._by_client.get(connection.client) is not connection:
+                return None
+            previous = self._by_terminal.get(terminal_id)
+            if self._by_terminal.get(connection.terminal_id) is connection:
+                del self._by_terminal[connection.terminal_id]
+            old_id = connection.terminal_id
+            connection.terminal_id = terminal_id
+            self._by_terminal[terminal_id] = connection
+            if previous is connection:
+                previous = None
+            elif previous is not None:
+                self._by_client.pop(previous.client, None)
+        
+        self.transactions.reassign(old_id, terminal_id)
+        return previous
+    
+    def connection_for(self, client) -> Optional[PosConnection]:
+        return self._by_client.get(client)
+    
+    def get(self, terminal_id: Optional[str]) -> Optional[PosConnection]:
+        return self._by_terminal.get(terminal_id)
+    
+    def connections(self) -> List[PosConnection]:
+        """All connections, oldest first"""
+        with self._lock:
+            return list(self._by_client.values())
+    
+    def candidates(self, terminal_id: Optional[str] = None) -> List[PosConnection]:
+        """Responsive connections to try for a new request, in the order to try them"""
+        if terminal_id is not None:
+            connection = self.get(terminal_id)
+            return [connection] if connection is not None and connection.responsive else []
+        
+        connections = [connection for connection in self.connections() if connection.responsive]
+        if self.policy == self.LEAST_OUTSTANDING:
+            # sorted() is stable, so ties keep connection order
+            connections.sort(key=lambda c: self.transactions.outstanding(c.terminal_id))
+        return connections
+    
+    def __len__(self) -> int:
+        return len(self._by_client)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Test certificates for the MobyPay Kiosk TLS listener
+Writes a throwaway CA, a Kiosk server certificate and a POS client
+certificate using the openssl command line tool
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from typing import List
+
+# Never use these outside a test bench: the keys are unencrypted
+DAYS = 825
+
+
+def openssl(*args: str):
+    subprocess.run(["openssl", *args], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def issue(out_dir: str, name: str, subject: str, extensions: List[str]):
+    """Key and certificate for name, signed by the test CA"""
+    key = os.path.join(out_dir, f"{name}.key")
+    csr = os.path.join(out_dir, f"{name}.csr")
+    cert = os.path.join(out_dir, f"{name}.crt")
+    openssl("req", "-new", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes",
+            "-keyout", key, "-subj", subject, "-out", csr)
+
+    with tempfile.NamedTemporaryFile("w", suffix=".ext", delete=False) as f:
+        f.write("\n".join(extensions) + "\n")
+    try:
+        openssl("x509", "-req", "-in", csr, "-CA", os.path.join(out_dir, "ca.crt"),
+                "-CAkey", os.path.join(out_dir, "ca.key"), "-CAcreateserial",
+                "-days", str(DAYS), "-sha256", "-extfile", f.name, "-out", cert)
+    finally:
+        os.unlink(f.name)
+        os.unlink(csr)
+
+
+def generate(out_dir: str, hosts: List[str], terminals: List[str]):
+    """CA, Kiosk server certificate for hosts, and a client certificate per terminal"""
+    os.makedirs(out_dir, exist_ok=True)
+    openssl("req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes",
+            "-keyout", os.path.join(out_dir, "ca.key"), "-out", os.path.join(out_dir, "ca.crt"),
+            "-subj", "/O=MobyPay Test/CN=MobyPay Test CA", "-days", str(DAYS))
+
+    san = ",".join(f"IP:{h}" if h.replace(".", "").isdigit() or ":" in h else f"DNS:{h}" for h in hosts)
+    issue(out_dir, "kiosk", f"/O=MobyPay Test/CN={hosts[0]}", [
+        f"subjectAltName={san}",
+        "extendedKeyUsage=serverAuth",
+    ])
+    for terminal_id in terminals:
+        # The Kiosk refuses a hello whose terminal_id differs from this commonName
+        issue(out_dir, terminal_id, f"/O=MobyPay Test/CN={terminal_id}", [
+            "extendedKeyUsage=clientAuth",
+        ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a test CA, Kiosk server and POS client certificates")
+    parser.add_argument("--out", default="test-certs", help="output directory (default: ./test-certs)")
+    parser.add_argument("--host", action="append", default=None,
+                        help="host name or IP the Kiosk is reached on (repeatable; default: localhost, 127.0.0.1)")
+    parser.add_argument("--terminal", action="append", default=None,
+                        help="POS terminal ID to issue a client certificate for (repeatable; default: POS-COUNTER-01)")
+    args = parser.parse_args()
+
+    hosts = args.host or ["localhost", "127.0.0.1"]
+    terminals = args.terminal or ["POS-COUNTER-01"]
+    try:
+        generate(args.out, hosts, terminals)
+    except FileNotFoundError:
+        print("❌ openssl not found on PATH")
+        sys.exit(1)
+    except subprocess.CalledProcessError as e:
+        print(f"❌ openssl failed: {e.stderr.decode(errors='replace').strip()}")
+        sys.exit(1)
+
+    print(f"✅ Certificates written to {args.out}/")
+    print("   CA:     ca.crt")
+    print(f"   Kiosk:  kiosk.crt, kiosk.key ({', '.join(hosts)})")
+    for terminal_id in terminals:
+        print(f"   POS:    {terminal_id}.crt, {terminal_id}.key")
+    print()
+    print(f"   python kiosk.py --tls-cert {args.out}/kiosk.crt --tls-key {args.out}/kiosk.key --tls-ca {args.out}/ca.crt")
+
+
+if __name__ == "__main__":
+    main()
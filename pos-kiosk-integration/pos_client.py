@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+"""
+MobyPay POS Client
+Reference POS-terminal side of the Kiosk protocol: a persistent connection
+with backoff reconnect, framing, signing and request handlers
+"""
+
+import argparse
+import logging
+import random
+import socket
+import ssl
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from kiosk_codec import CODECS, DEFAULT_MAX_FRAME_SIZE, JSON_CODEC, MessageFramer, WireCodec
+from kiosk_metrics import configure_logging
+from kiosk_security import SecurityHelper
+from kiosk_transport import DEFAULT_HEARTBEAT_INTERVAL, DEFAULT_IDLE_TIMEOUT, TlsStream, configure_keepalive
+
+logger = logging.getLogger("mobypay.kiosk.pos")
+
+# Reconnect delays, as recommended in INTEGRATION.md
+DEFAULT_BACKOFF_INITIAL = 1.0
+DEFAULT_BACKOFF_MAX = 30.0
+# A connection must last this long before the backoff starts again from its first step
+DEFAULT_STABLE_AFTER = 10.0
+
+
+class Backoff:
+    """Exponential reconnect delay with full jitter
+    
+    After the n-th consecutive failure the client waits a random time
+    between 0 and min(maximum, initial * multiplier ** (n - 1)). Without the
+    randomness every terminal that lost a restarting Kiosk would retry at
+    the same moments and hit it in waves; with it, retries are spread over
+    the whole interval.
+    """
+    
+    def __init__(self, initial: float = DEFAULT_BACKOFF_INITIAL, maximum: float = DEFAULT_BACKOFF_MAX,
+                 multiplier: float = 2.0, rng: Optional[random.Random] = None):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.attempts = 0
+        self._rng = rng or random.Random()
+    
+    def ceiling(self) -> float:
+        """Longest delay the next failure can wait"""
+        return min(self.maximum, self.initial * self.multiplier ** self.attempts)
+    
+    def next_delay(self) -> float:
+        """Record a failure and return how long to wait before retrying"""
+        delay = self._rng.uniform(0, self.ceiling())
+        self.attempts += 1
+        return delay
+    
+    def reset(self):
+        self.attempts = 0
+
+
+class PaymentHandler:
+    """What a POS terminal does with the Kiosk's requests
+    
+    Override the methods for a real terminal. They run on the client's
+    reader thread, so a handler that waits for a card should acknowledge
+    the request, hand the work to another thread and reply through the
+    client from there. The defaults only acknowledge.
+    """
+    
+    def on_connected(self, client: "PosClient"):
+        """The connection is up and the hello was sent"""
+    
+    def on_disconnected(self, client: "PosClient"):
+        """The connection was lost; the client is about to reconnect"""
+    
+    def on_transaction_request(self, client: "PosClient", request: Dict[str, Any]):
+        client.ack(request["txn_id"])
+    
+    def on_cancel(self, client: "PosClient", request: Dict[str, Any]):
+        client.ack(request["txn_id"], status="received")
+    
+    def on_plan_selection(self, client: "PosClient", request: Dict[str, Any]):
+        client.ack(request["txn_id"])
+
+
+class SimulatedHandler(PaymentHandler):
+    """Answers every request at once, like the example client in TESTING.md
+    
+    Card and wallet payments end with `outcome` ("success", "failed" or
+    "error"). IPP payments get a three-month plan and succeed with whichever
+    plan the Kiosk selects.
+    """
+    
+    def __init__(self, outcome: str = "success"):
+        self.outcome = outcome
+    
+    def on_transaction_request(self, client: "PosClient", request: Dict[str, Any]):
+        txn_id = request["txn_id"]
+        amount = request.get("amount", 0)
+        logger.info("💳 Payment request %s: RM%.2f by %s", txn_id, amount, request.get("payment_mode"))
+        client.ack(txn_id)
+        
+        if request.get("payment_mode") == "ipp":
+            installment = round(amount / 3, 2)
+            client.send_plans(txn_id, amount, [{
+                "planId": "IPP_3M",
+                "frequency": "Monthly",
+                "totalInstallments": 3,
+                "installmentDetails": [
+                    {"installmentNumber": n, "amount": installment, "installmentFee": 1.50,
+                     "installmentFeePercentage": 1.5}
+                    for n in (1, 2, 3)
+                ]
+            }])
+        elif self.outcome == "error":
+            client.send_error(txn_id, "Simulated reader fault")
+        elif self.outcome == "failed":
+            client.send_result(txn_id, "failed")
+        else:
+            client.send_result(txn_id, "success", authorization_code="AUTH123", card_last4="4242")
+    
+    def on_cancel(self, client: "PosClient", request: Dict[str, Any]):
+        logger.info("🚫 Cancel request for %s", request["txn_id"])
+        client.ack(request["txn_id"], status="received")
+    
+    def on_plan_selection(self, client: "PosClient", request: Dict[str, Any]):
+        txn_id = request["txn_id"]
+        logger.info("📑 Plan %s selected for %s", request.get("plan_id"), txn_id)
+        client.ack(txn_id)
+        client.send_result(txn_id, "success", authorization_code="AUTH456", plan_id=request.get("plan_id"))
+
+
+class PosClient:
+    """A POS terminal's connection to the Kiosk, kept open until stop()
+    
+    One thread connects, says hello, reads and answers the Kiosk's frames,
+    and reconnects with Backoff whenever the connection fails. Every frame
+    is signed and verified through SecurityHelper. Replies can be sent from
+    any thread, also over TLS: the connection is then a TlsStream, which
+    lets one thread write while the reader waits for data. Results and errors sent while disconnected are kept and
+    delivered, freshly signed, after the next hello, so a payment finished
+    during an outage still reaches the Kiosk; a copy it already has is
+    ignored there as a duplicate.
+    """
+    
+    HELLO_TIMEOUT = 10.0
+    RECV_SIZE = 65536
+    # Longest the reader blocks, so pings and stop() are noticed promptly
+    POLL_INTERVAL = 1.0
+    
+    def __init__(self, host: str, port: int, terminal_id: str,
+                 handler: Optional[PaymentHandler] = None,
+                 codec: str = "json",
+                 tls: Optional[ssl.SSLContext] = None,
+                 server_hostname: Optional[str] = None,
+                 heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL,
+                 idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+                 backoff: Optional[Backoff] = None,
+                 stable_after: float = DEFAULT_STABLE_AFTER,
+                 connect_timeout: float = 10.0,
+                 max_frame_size: int = DEFAULT_MAX_FRAME_SIZE):
+        if codec not in CODECS:
+            raise ValueError(f"codec '{codec}' is not available (have {', '.join(CODECS)})")
+        self.host = host
+        self.port = port
+        self.terminal_id = terminal_id
+        self.handler = handler or PaymentHandler()
+        self.offer = codec
+        self.tls = tls
+        self.server_hostname = server_hostname or host
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.backoff = backoff or Backoff()
+        self.stable_after = stable_after
+        self.connect_timeout = connect_timeout
+        self.max_frame_size = max_frame_size
+        
+        self.connected = threading.Event()
+        self.connections = 0
+        self.codec: WireCodec = JSON_CODEC
+        self._sock: Optional[socket.socket] = None
+        self._session: Optional[ssl.SSLSession] = None
+        self._send_lock = threading.Lock()
+        self._outbox: List[Dict[str, Any]] = []
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    def start(self):
+        """Connect in a background thread and stay connected until stop()"""
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name=f"pos-{self.terminal_id}", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """Close the connection and stop reconnecting"""
+        self._stopping.set()
+        self._close()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self._thread = None
+    
+    def wait_connected(self, timeout: Optional[float] = None) -> bool:
+        return self.connected.wait(timeout)
+    
+    # Replies
+    
+    def send(self, data: Dict[str, Any]) -> bool:
+        """Sign and send a message; False if there is no connection to send it on"""
+        with self._send_lock:
+            return self._write(data)
+    
+    def ack(self, txn_id: str, status: str = "processing") -> bool:
+        return self.send({"type": "ack", "txn_id": txn_id, "status": status})
+    
+    def send_result(self, txn_id: str, status: str, **fields) -> bool:
+        """Send a transaction_result, or keep it for the next connection"""
+        return self._deliver({"type": "transaction_result", "txn_id": txn_id, "status": status, **fields})
+    
+    def send_plans(self, txn_id: str, amount: float, plans: List[Dict[str, Any]]) -> bool:
+        return self.send({"type": "transaction_result", "txn_id": txn_id, "status": "ipp_plans",
+                          "amount": amount, "plans": plans})
+    
+    def send_error(self, txn_id: str, message: str) -> bool:
+        """Send an error result, or keep it for the next connection"""
+        return self._deliver({"type": "error", "txn_id": txn_id, "message": message})
+    
+    def _deliver(self, data: Dict[str, Any]) -> bool:
+        with self._send_lock:
+            if self._write(data):
+                return True
+            self._outbox.append(data)
+            logger.info("📮 %s for %s kept until the Kiosk is reachable again", data["type"], data["txn_id"])
+            return False
+    
+    def _write(self, data: Dict[str, Any]) -> bool:
+        """Encode and write one message; call with the send lock held"""
+        sock = self._sock
+        if sock is None or not self.connected.is_set():
+            return False
+        frame = self.codec.encode(SecurityHelper.create_secure_message(data))
+        try:
+            sock.sendall(frame)
+        except OSError as e:
+            logger.warning("❌ Send to Kiosk failed: %s", e)
+            self._close()
+            return False
+        return True
+    
+    # Connection
+    
+    def _run(self):
+        while not self._stopping.is_set():
+            started = time.monotonic()
+            try:
+                sock, framer, frames = self._connect()
+            except (OSError, ssl.SSLError, ValueError) as e:
+                logger.warning("❌ Cannot reach Kiosk at %s:%s: %s", self.host, self.port, e)
+            else:
+                self._serve(sock, framer, frames)
+            if self._stopping.is_set():
+                break
+            
+            if time.monotonic() - started >= self.stable_after:
+                self.backoff.reset()
+            delay = self.backoff.next_delay()
+            logger.info("⏳ Reconnecting in %.1fs (attempt %s)", delay, self.backoff.attempts)
+            self._stopping.wait(delay)
+    
+    def _connect(self) -> Tuple[socket.socket, Any, List[bytes]]:
+        """Open the connection, say hello and agree on a codec
+        
+        Returns the socket, a framer for the agreed codec, and any frames
+        that arrived together with the hello_ack.
+        """
+        sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.heartbeat_interval:
+                configure_keepalive(sock, self.heartbeat_interval)
+            if self.tls is not None:
+                # Offering the last session lets the Kiosk skip the certificate exchange
+                sock = TlsStream(sock, self.tls, self.server_hostname, self._session)
+                sock.handshake(self.connect_timeout)
+            
+            self.codec = JSON_CODEC
+            hello = {"type": "hello", "terminal_id": self.terminal_id}
+            if self.offer != "json":
+                hello["codecs"] = [self.offer, "json"]
+            sock.sendall(JSON_CODEC.encode(SecurityHelper.create_secure_message(hello)))
+            
+            leftover = b""
+            if self.offer != "json":
+                leftover = self._await_hello_ack(sock)
+        except BaseException:
+            sock.close()
+            raise
+        
+        framer = self.codec.framer(self.max_frame_size)
+        return sock, framer, framer.feed(leftover) if leftover else []
+    
+    def _await_hello_ack(self, sock: socket.socket) -> bytes:
+        """Read newline JSON until hello_ack; return the bytes after it, which use the agreed codec"""
+        sock.settimeout(self.HELLO_TIMEOUT)
+        buffer = bytearray()
+        while True:
+            end = buffer.find(MessageFramer.DELIMITER)
+            if end < 0:
+                if len(buffer) > self.max_frame_size:
+                    raise ValueError("hello_ack larger than the maximum frame size")
+                data = sock.recv(self.RECV_SIZE)
+                if not data:
+                    raise ConnectionError("Kiosk closed the connection before hello_ack")
+                buffer += data
+                continue
+            
+            frame, buffer = bytes(buffer[:end]).strip(), buffer[end + 1:]
+            validation = SecurityHelper.validate_secure_message(JSON_CODEC.decode(frame)) if frame else None
+            if validation is None:
+                continue
+            if not validation["is_valid"]:
+                raise ValueError(f"invalid frame before hello_ack: {validation['error']}")
+            payload = validation["payload"]
+            if payload.get("type") == "hello_ack":
+                self.codec = CODECS.get(payload.get("codec"), JSON_CODEC)
+                logger.info("🧬 Kiosk %s agreed on the %s codec", payload.get("kiosk_id"), self.codec.name)
+                return bytes(buffer)
+            if payload.get("type") == "ping":
+                sock.sendall(JSON_CODEC.encode(SecurityHelper.create_secure_message({"type": "pong"})))
+    
+    def _serve(self, sock: socket.socket, framer, frames: List[bytes]):
+        """Handle one connection until it fails, goes quiet or stop() is called"""
+        sock.settimeout(min(self.POLL_INTERVAL, self.heartbeat_interval or self.POLL_INTERVAL))
+        with self._send_lock:
+            self._sock = sock
+            self.connected.set()
+            self.connections += 1
+            session = getattr(sock, "session", None)
+        logger.info("🔗 Connected to Kiosk at %s:%s as %s%s", self.host, self.port, self.terminal_id,
+                    ", TLS session resumed" if getattr(sock, "session_reused", False) else "")
+        self._flush_outbox()
+        self._call(self.handler.on_connected)
+        
+        last_seen = last_ping = time.monotonic()
+        try:
+            while not self._stopping.is_set():
+                if frames:
+                    self._handle_frames(frames)
+                    last_seen = time.monotonic()
+                
+                try:
+                    data = sock.recv(self.RECV_SIZE)
+                except socket.timeout:
+                    data = None
+                except (OSError, ssl.SSLError) as e:
+                    if not self._stopping.is_set():
+                        logger.warning("❌ Connection to Kiosk failed: %s", e)
+                    break
+                
+                if data == b"":
+                    if not self._stopping.is_set():
+                        logger.warning("🔌 Kiosk closed the connection")
+                    break
+                frames = framer.feed(data) if data else []
+                
+                now = time.monotonic()
+                if self.heartbeat_interval and not frames:
+                    if now - last_seen >= self.idle_timeout:
+                        logger.warning("💀 No frame from the Kiosk for %.0fs; reconnecting", now - last_seen)
+                        break
+                    if now - last_seen >= self.heartbeat_interval and now - last_ping >= self.heartbeat_interval:
+                        last_ping = now
+                        self.send({"type": "ping"})
+        finally:
+            if self.tls is not None:
+                # TLS 1.3 tickets arrive after the handshake, so the session is read last
+                session = getattr(sock, "session", None) or session
+                self._session = session
+            self._close()
+            self._call(self.handler.on_disconnected)
+    
+    def _handle_frames(self, frames: List[bytes]):
+        """Verify and dispatch frames decoded from one read"""
+        messages = []
+        for frame in frames:
+            try:
+                messages.append(self.codec.decode(frame))
+            except (ValueError, TypeError) as e:
+                logger.warning("❌ %s decode error from Kiosk: %s", self.codec.name, e or type(e).__name__)
+        
+        for validation in SecurityHelper.validate_secure_messages(messages):
+            if not validation["is_valid"]:
+                logger.warning("🔒 Security validation failed: %s", validation["error"])
+                continue
+            self._dispatch(validation["payload"])
+    
+    def _dispatch(self, payload: Dict[str, Any]):
+        message_type = payload.get("type")
+        if message_type == "ping":
+            self.send({"type": "pong"})
+        elif message_type == "pong":
+            pass
+        elif message_type == "transaction_request":
+            self._call(self.handler.on_transaction_request, payload)
+        elif message_type == "cancel_transaction":
+            self._call(self.handler.on_cancel, payload)
+        elif message_type == "ipp_plan_selection":
+            self._call(self.handler.on_plan_selection, payload)
+        else:
+            logger.warning("❓ Unknown message type from Kiosk: %s", message_type)
+    
+    def _call(self, method, *args):
+        """Run a handler method; its failures are logged, never fatal to the connection"""
+        try:
+            method(self, *args)
+        except Exception as e:
+            logger.error("❌ %s failed: %s", method.__name__, e)
+    
+    def _flush_outbox(self):
+        """Deliver results kept while disconnected"""
+        with self._send_lock:
+            kept, self._outbox = self._outbox, []
+            for index, data in enumerate(kept):
+                if not self._write(data):
+                    self._outbox = kept[index:] + self._outbox
+                    return
+                logger.info("📬 Delivered kept %s for %s", data["type"], data["txn_id"])
+    
+    def _close(self):
+        self.connected.clear()
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated POS terminal for the MobyPay Kiosk")
+    parser.add_argument("--host", default="127.0.0.1", help="Kiosk address")
+    parser.add_argument("--port", type=int, default=8080, help="Kiosk port")
+    parser.add_argument("--terminal-id", default="POS-COUNTER-01", help="terminal ID sent in the hello frame")
+    parser.add_argument("--outcome", choices=["success", "failed", "error"], default="success",
+                        help="result of every card and wallet payment")
+    parser.add_argument("--codec", choices=sorted(CODECS), default="json", help="wire codec to ask the Kiosk for")
+    parser.add_argument("--heartbeat", type=float, default=DEFAULT_HEARTBEAT_INTERVAL,
+                        help="seconds of silence before the Kiosk is pinged (0 disables heartbeats)")
+    parser.add_argument("--tls-ca", metavar="PEM", help="connect over TLS, trusting this CA")
+    parser.add_argument("--tls-cert", metavar="PEM", help="client certificate for mutual TLS")
+    parser.add_argument("--tls-key", metavar="PEM", help="private key for --tls-cert, if not in the same file")
+    parser.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="INFO",
+        help="DEBUG shows each security check"
+    )
+    args = parser.parse_args()
+    if args.tls_cert and not args.tls_ca:
+        parser.error("--tls-cert needs --tls-ca")
+    
+    tls = None
+    if args.tls_ca:
+        tls = ssl.create_default_context(cafile=args.tls_ca)
+        if args.tls_cert:
+            tls.load_cert_chain(args.tls_cert, args.tls_key)
+    
+    log_listener = configure_logging(getattr(logging, args.log_level))
+    client = PosClient(args.host, args.port, args.terminal_id, SimulatedHandler(args.outcome), codec=args.codec,
+                       tls=tls, heartbeat_interval=args.heartbeat)
+    client.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.stop()
+        log_listener.stop()
+
+
+if __name__ == "__main__":
+    main()
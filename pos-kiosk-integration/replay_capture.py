@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Replay a MobyPay Kiosk traffic capture
+Feeds the frames a Kiosk recorded with --capture into a local TcpSender on
+127.0.0.1: each captured terminal becomes a socket that sends what the
+terminal sent, and the Kiosk side is driven through the sender API. Every
+frame is signed again with a fresh timestamp and nonce, and transaction
+ids are mapped to the ones the local Kiosk assigns.
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import kiosk
+from kiosk import (CODECS, JSON_CODEC, AsyncTcpSender, CaptureRecord, PaymentHandle, SecurityHelper, TcpSender,
+                   TrafficCapture)
+
+ENGINES = {"thread": TcpSender, "asyncio": AsyncTcpSender}
+
+# Payload fields create_secure_message adds; every replayed frame gets new ones
+SIGNED_FIELDS = ("timestamp", "nonce")
+
+
+def parse_speed(text: str) -> float:
+    """'1', '10x' or 'max' (0: no pacing)"""
+    if text == "max":
+        return 0.0
+    try:
+        speed = float(text[:-1] if text.endswith("x") else text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid speed '{text}' (expected a number, Nx or max)")
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be more than zero")
+    return speed
+
+
+def payload_of(message: Any) -> Optional[Dict[str, Any]]:
+    """The signed payload of a decoded frame, without its timestamp and nonce"""
+    payload = message.get("payload") if isinstance(message, dict) else None
+    if not isinstance(payload, dict):
+        return None
+    return {name: value for name, value in payload.items() if name not in SIGNED_FIELDS}
+
+
+def capture_sources(paths: List[str]) -> List[str]:
+    """Capture directories and segment files; a prefork capture expands to its worker-N directories"""
+    sources = []
+    for path in paths:
+        workers = []
+        if os.path.isdir(path):
+            workers = sorted(name for name in os.listdir(path) if name.startswith("worker-"))
+        if workers:
+            sources.extend(os.path.join(path, name) for name in workers)
+        else:
+            sources.append(path)
+    return sources
+
+
+def merged_records(sources: List[str]) -> Iterator[Tuple[Tuple[int, int], CaptureRecord]]:
+    """Records of every source in time order, keyed by (source, connection)"""
+    def keyed(number: int, source: str):
+        for record in TrafficCapture.read(source):
+            yield (number, record.connection), record
+
+    return heapq.merge(*(keyed(n, source) for n, source in enumerate(sources)), key=lambda item: item[1].time)
+
+
+class ReplayTerminal:
+    """A socket standing in for one captured terminal
+
+    A reader thread takes whatever the Kiosk sends, switching codec when a
+    hello_ack names one.
+    """
+
+    def __init__(self, port: int, timeout: float):
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(None)
+        self.address = "%s:%s" % self.sock.getsockname()[:2]
+        self.terminal_id: Optional[str] = None
+        self.codec = JSON_CODEC
+        self.acked = threading.Event()
+        self.received = 0
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _read(self):
+        framer = self.codec.framer()
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            for frame in framer.feed(data):
+                self.received += 1
+                if self.acked.is_set():
+                    continue
+                try:
+                    message = payload_of(self.codec.decode(frame))
+                except ValueError:
+                    continue
+                if message is not None and message.get("type") == "hello_ack":
+                    # Nothing else is sent to this terminal until the driver sees the ack
+                    self.codec = CODECS.get(message.get("codec"), JSON_CODEC)
+                    framer = self.codec.framer()
+                    self.acked.set()
+
+    def send(self, payload: Dict[str, Any]):
+        self.sock.sendall(self.codec.encode(SecurityHelper.create_secure_message(payload)))
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Replayer:
+    """Plays captured records against a running sender, one at a time and in order"""
+
+    def __init__(self, sender: TcpSender, speed: float, timeout: float):
+        self.sender = sender
+        self.speed = speed
+        self.timeout = timeout
+        self.terminals: Dict[Tuple[int, int], ReplayTerminal] = {}
+        # Captured transaction id -> the id the local Kiosk gave the same payment
+        self.txn_ids: Dict[str, str] = {}
+        self.handles: Dict[str, PaymentHandle] = {}
+        self.captured_status: Dict[str, str] = {}
+        # Captured transactions the Kiosk sent a cancel for
+        self.cancelled: Set[str] = set()
+        self.counts = {"connections": 0, "inbound": 0, "outbound": 0, "payments": 0, "skipped": 0, "orphans": 0}
+
+    def run(self, records: Iterator[Tuple[Tuple[int, int], CaptureRecord]]) -> float:
+        """Replay every record; returns the elapsed seconds"""
+        handlers = {
+            TrafficCapture.OPEN: self._open,
+            TrafficCapture.IDENTIFY: self._identify,
+            TrafficCapture.CLOSE: self._close,
+            TrafficCapture.INBOUND: self._inbound,
+            TrafficCapture.OUTBOUND: self._outbound,
+        }
+        first = None
+        started = time.perf_counter()
+        for key, record in records:
+            if first is None:
+                first = record.time
+            if self.speed:
+                delay = (record.time - first) / self.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            handler = handlers.get(record.kind)
+            if handler is not None:
+                handler(key, record)
+        return time.perf_counter() - started
+
+    def _open(self, key: Tuple[int, int], record: CaptureRecord):
+        self.terminals[key] = ReplayTerminal(self.sender.port, self.timeout)
+        self.counts["connections"] += 1
+
+    def _identify(self, key: Tuple[int, int], record: CaptureRecord):
+        """Say hello for a connection whose own hello came before the capture started"""
+        terminal = self.terminals.get(key)
+        if terminal is None or terminal.terminal_id is not None:
+            return
+        details = TrafficCapture.decode(record)
+        hello = {"type": "hello", "terminal_id": details["terminal_id"]}
+        if details.get("codec", "json") != "json":
+            hello["codecs"] = [details["codec"]]
+        terminal.send(hello)
+        terminal.terminal_id = hello["terminal_id"]
+        self._await_registration(terminal, "codecs" in hello)
+
+    def _close(self, key: Tuple[int, int], record: CaptureRecord):
+        terminal = self.terminals.pop(key, None)
+        if terminal is not None:
+            terminal.close()
+
+    def _inbound(self, key: Tuple[int, int], record: CaptureRecord):
+        """Send what the terminal sent, re-signed and with the local transaction id"""
+        terminal = self.terminals.get(key)
+        payload = payload_of(TrafficCapture.decode(record))
+        if terminal is None or payload is None:
+            self.counts["orphans"] += 1
+            return
+
+        txn_id = payload.get("txn_id")
+        if txn_id:
+            if txn_id not in self.txn_ids:
+                # The request was sent before the capture started
+                self.counts["orphans"] += 1
+                return
+            payload["txn_id"] = self.txn_ids[txn_id]
+            if payload.get("type") in ("transaction_result", "error") and payload.get("status") != "ipp_plans":
+                # Only the first final answer counts, as on the Kiosk
+                self.captured_status.setdefault(txn_id, str(payload.get("status") or payload.get("type")))
+            elif payload.get("type") == "ack" and payload.get("status") != "processing" and txn_id in self.cancelled:
+                # The terminal confirmed the cancel before sending any result
+                self.captured_status.setdefault(txn_id, "cancelled")
+
+        terminal.send(payload)
+        self.counts["inbound"] += 1
+        if payload.get("type") == "hello":
+            terminal.terminal_id = payload.get("terminal_id")
+            self._await_registration(terminal, "codecs" in payload)
+
+    def _await_registration(self, terminal: ReplayTerminal, negotiated: bool):
+        """Wait until the local Kiosk has bound the terminal id to this socket"""
+        deadline = time.monotonic() + self.timeout
+        if negotiated and not terminal.acked.wait(self.timeout):
+            raise TimeoutError(f"no hello_ack for {terminal.terminal_id}")
+        while time.monotonic() < deadline:
+            connection = self.sender.router.get(terminal.terminal_id)
+            if connection is not None and connection.address == terminal.address:
+                return
+            time.sleep(0.001)
+        raise TimeoutError(f"{terminal.terminal_id} was not registered")
+
+    def _outbound(self, key: Tuple[int, int], record: CaptureRecord):
+        """Make the local Kiosk send what the captured one did, through the sender API"""
+        message = payload_of(TrafficCapture.decode(record))
+        message_type = message.get("type") if message is not None else None
+        terminal = self.terminals.get(key)
+        if message_type not in ("transaction_request", "cancel_transaction", "ipp_plan_selection"):
+            # Heartbeats and hello_acks: the local Kiosk sends its own
+            self.counts["skipped"] += 1
+            return
+        if terminal is None or terminal.terminal_id is None:
+            self.counts["orphans"] += 1
+            return
+
+        captured_id = message.get("txn_id")
+        if message_type == "transaction_request":
+            handle = self.sender.pay(message["payment_mode"], message["amount"], terminal.terminal_id)
+            if handle is None:
+                raise RuntimeError(f"payment {captured_id} was not sent to {terminal.terminal_id}")
+            self.txn_ids[captured_id] = handle.txn_id
+            self.handles[captured_id] = handle
+            self.counts["payments"] += 1
+            self.counts["outbound"] += 1
+            return
+
+        txn_id = self.txn_ids.get(captured_id)
+        if txn_id is None:
+            self.counts["orphans"] += 1
+            return
+        if message_type == "cancel_transaction":
+            self.cancelled.add(captured_id)
+            self.sender.cancel_transaction(txn_id)
+        else:
+            # The plans were sent just before; wait for the local Kiosk to take them
+            self.sender.plans_for(txn_id).result(self.timeout)
+            self.sender.select_plan(txn_id, message["plan_id"])
+        self.counts["outbound"] += 1
+
+    def finish(self) -> Dict[str, Any]:
+        """Wait for the replayed payments to end and compare them with the capture"""
+        deadline = time.monotonic() + self.timeout
+        mismatches = []
+        unfinished = 0
+        for captured_id, handle in self.handles.items():
+            try:
+                result = handle.result(max(0.0, deadline - time.monotonic()))
+            except Exception:
+                unfinished += 1
+                continue
+            expected = self.captured_status.get(captured_id)
+            if expected is not None and result.status != expected:
+                mismatches.append({"captured": captured_id, "replayed": handle.txn_id,
+                                   "expected": expected, "got": result.status})
+
+        for terminal in self.terminals.values():
+            terminal.close()
+        self.terminals.clear()
+        return {"mismatches": mismatches, "unfinished": unfinished}
+
+
+def replay(sources: List[str], engine: str, port: int, speed: float, timeout: float) -> Dict[str, Any]:
+    # A faster replay sends faster than the terminals did, so the rate limit is off
+    sender = ENGINES[engine](host="127.0.0.1", port=port, heartbeat_interval=0,
+                             admission=kiosk.AdmissionControl(rate=0))
+    if not sender.start_server():
+        raise RuntimeError(f"{engine} engine failed to start")
+    failures_before = sum(kiosk.metrics.counter_values("kiosk_validation_failures_total").values())
+    try:
+        replayer = Replayer(sender, speed, timeout)
+        elapsed = replayer.run(merged_records(sources))
+        outcome = replayer.finish()
+    finally:
+        sender.stop_server()
+
+    frames = replayer.counts["inbound"] + replayer.counts["outbound"]
+    return {
+        "sources": sources,
+        "engine": engine,
+        "speed": speed or "max",
+        "elapsed_s": round(elapsed, 3),
+        "frames_per_second": round(frames / elapsed, 1) if elapsed else None,
+        **replayer.counts,
+        "validation_failures": sum(kiosk.metrics.counter_values("kiosk_validation_failures_total").values())
+        - failures_before,
+        **outcome,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a Kiosk traffic capture against a local Kiosk")
+    parser.add_argument("capture", nargs="+", help="capture directory (from kiosk.py --capture) or segment file")
+    parser.add_argument("--speed", type=parse_speed, default=1.0,
+                        help="1 for the captured pace, N or Nx for N times faster, max for no pacing (default: 1)")
+    parser.add_argument("--engine", choices=list(ENGINES), default="thread", help="connection engine")
+    parser.add_argument("--port", type=int, default=18100, help="port of the local Kiosk")
+    parser.add_argument("--timeout", type=float, default=10.0,
+                        help="seconds to wait for a registration, a plan offer or the last results")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="WARNING",
+                        help="log level of the local Kiosk")
+    parser.add_argument("--json", metavar="PATH", help="write the report as JSON to PATH ('-' for stdout)")
+    args = parser.parse_args()
+
+    kiosk.configure_logging(getattr(logging, args.log_level), stream=sys.stderr)
+    try:
+        report = replay(capture_sources(args.capture), args.engine, args.port, args.speed, args.timeout)
+    except KeyError as e:
+        print(f"❌ The capture uses the {e} codec, which is not installed here")
+        sys.exit(1)
+    except (OSError, RuntimeError) as e:
+        print(f"❌ Replay failed: {e}")
+        sys.exit(1)
+
+    if args.json:
+        if args.json == "-":
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+
+    if args.json != "-":
+        print(f"🎬 Replayed {report['connections']} connection(s), {report['payments']} payment(s) "
+              f"at {'max speed' if report['speed'] == 'max' else str(report['speed']) + 'x'}")
+        print(f"   Frames:      {report['inbound']} from terminals, {report['outbound']} from the Kiosk "
+              f"in {report['elapsed_s']:.3f}s ({report['frames_per_second']} frames/s)")
+        print(f"   Skipped:     {report['skipped']} heartbeat/hello_ack frame(s), {report['orphans']} orphan(s)")
+        print(f"   Validation:  {report['validation_failures']} failure(s)")
+        print(f"   Outcomes:    {len(report['mismatches'])} mismatch(es), {report['unfinished']} unfinished")
+        for mismatch in report["mismatches"]:
+            print(f"   ❗ {mismatch['captured']} -> {mismatch['replayed']}: "
+                  f"captured {mismatch['expected']}, replayed {mismatch['got']}")
+
+    if report["mismatches"] or report["validation_failures"] or report["unfinished"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
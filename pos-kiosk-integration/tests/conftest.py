@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+# The Kiosk modules sit next to this directory rather than in an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import kiosk  # noqa: E402
+from kiosk_codec import JSON_CODEC  # noqa: E402
+from kiosk_security import NonceReplayCache, SecurityHelper  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_nonce_cache():
+    """Every test starts with an empty process-wide nonce cache"""
+    previous = SecurityHelper._nonce_cache
+    SecurityHelper._nonce_cache = NonceReplayCache()
+    yield
+    SecurityHelper._nonce_cache = previous
+
+
+def signed_frame(data, codec=JSON_CODEC):
+    """A frame as a terminal would send it"""
+    return codec.encode(SecurityHelper.create_secure_message(data))
+
+
+def sent_payloads(connection):
+    """Payloads of the frames queued for a connection since the last call"""
+    codec = connection.codec
+    return [codec.decode(body)["payload"]
+            for frame, _ in connection.outbound.take() for body in codec.framer().feed(frame)]
+
+
+@pytest.fixture
+def sender():
+    """A TcpSender that is never started; tests drive it through its handlers"""
+    sender = kiosk.TcpSender(host="127.0.0.1", port=0)
+    sender.CANCEL_TIMEOUT = 5.0
+    return sender
+
+
+def add_terminal(sender, terminal_id, port):
+    """A connection registered as terminal_id; nothing drains its send queue"""
+    connection = sender._register_client(object(), ("127.0.0.1", port))
+    sender._handle_data(connection, signed_frame({"type": "hello", "terminal_id": terminal_id}))
+    return connection
+
+
+@pytest.fixture
+def terminal(sender):
+    """A connection registered as terminal POS-1"""
+    return add_terminal(sender, "POS-1", 40001)
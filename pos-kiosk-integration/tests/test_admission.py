@@ -0,0 +1,101 @@
+import socket
+
+import pytest
+
+import kiosk
+from conftest import signed_frame
+from kiosk_codec import JSON_CODEC
+from kiosk_transactions import TransactionState
+from kiosk_transport import AdmissionControl, PosConnection, TokenBucket
+
+GOOD = JSON_CODEC.encode({"payload": {"type": "ping"}, "signature": "x"})[:-1]
+
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = TokenBucket(rate=2.0, burst=4)
+    now = bucket.updated
+    assert bucket.take(6, now) == 4
+    assert bucket.take(1, now) == 0
+    assert bucket.take(3, now + 1.0) == 2
+    # Never more than the burst, however long it was idle
+    assert bucket.take(10, now + 100.0) == 4
+
+
+def test_frames_beyond_the_rate_are_dropped():
+    admission = AdmissionControl(rate=1.0, burst=2, quarantine_after=0)
+    connection = PosConnection(object(), "10.0.0.1:5000")
+    connection.bucket = admission.bucket()
+    assert admission.admit(connection, [GOOD] * 3, JSON_CODEC) == [GOOD] * 2
+    assert connection.rejected == 1
+    assert AdmissionControl(rate=0).bucket() is None
+
+
+def test_prefilter_drops_frames_that_cannot_be_signed_messages():
+    admission = AdmissionControl(rate=0, quarantine_after=0)
+    connection = PosConnection(object(), "10.0.0.1:5000")
+    assert admission.admit(connection, [b"GET / HTTP/1.1", GOOD, b"[1, 2]"], JSON_CODEC) == [GOOD]
+    assert connection.rejected == 2 and not connection.quarantined
+
+
+def test_steady_strikes_quarantine_the_host():
+    admission = AdmissionControl(rate=0, quarantine_after=3, quarantine_seconds=60.0)
+    connection = PosConnection(object(), "10.0.0.1:5000")
+    admission.reject(connection, AdmissionControl.INVALID, 2)
+    assert not connection.quarantined and admission.admit_host("10.0.0.1")
+    admission.reject(connection, AdmissionControl.MALFORMED)
+    assert connection.quarantined
+    assert not admission.admit_host("10.0.0.1")
+    assert admission.admit_host("10.0.0.2")
+    assert list(admission.quarantined()) == ["10.0.0.1"]
+
+
+def test_strikes_drain_over_the_window(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr("kiosk_transport.time.monotonic", lambda: clock[0])
+    admission = AdmissionControl(rate=0, quarantine_after=3, strike_window=10.0)
+    connection = PosConnection(object(), "10.0.0.1:5000")
+    admission.reject(connection, AdmissionControl.INVALID, 2)
+    # Two strikes drain in 2/3 of the window
+    clock[0] += 7.0
+    admission.reject(connection, AdmissionControl.INVALID)
+    admission.reject(connection, AdmissionControl.INVALID)
+    assert connection.strikes == 2 and not connection.quarantined
+
+
+def test_quarantine_ends():
+    admission = AdmissionControl()
+    admission.quarantine_host("10.0.0.1", 0.0)
+    assert admission.admit_host("10.0.0.1")
+    assert admission.quarantined() == {}
+
+
+@pytest.fixture
+def strict_sender():
+    sender = kiosk.TcpSender(host="127.0.0.1", port=0,
+                             admission=AdmissionControl(rate=0, quarantine_after=3, quarantine_seconds=60.0))
+    kiosk_side, terminal_side = socket.socketpair()
+    connection = sender._register_client(kiosk_side, ("127.0.0.1", 40001))
+    sender._handle_data(connection, signed_frame({"type": "hello", "terminal_id": "POS-1"}))
+    yield sender, connection
+    kiosk_side.close()
+    terminal_side.close()
+
+
+def test_bad_frames_stop_dispatch_until_a_clean_read(strict_sender):
+    sender, connection = strict_sender
+    sender._handle_data(connection, b"garbage\n")
+    assert not connection.responsive and sender.router.candidates() == []
+    sender._handle_data(connection, signed_frame({"type": "pong", "terminal_id": "POS-1"}))
+    assert connection.responsive
+
+
+def test_quarantined_terminal_is_dropped_and_its_payments_fail(strict_sender):
+    sender, connection = strict_sender
+    handle = sender.pay("card", 12.5)
+    # Bad signatures count as well as frames the prefilter catches
+    forged = JSON_CODEC.encode({"payload": {"type": "ping"}, "signature": "forged", "timestamp": "0"})
+    sender._handle_data(connection, b"garbage\n" + forged + b"garbage\n")
+    assert connection.quarantined
+    assert sender.router.get("POS-1") is None
+    assert sender.transactions.get(handle.txn_id).state == TransactionState.FAILED
+    assert not sender.admission.admit_host("127.0.0.1")
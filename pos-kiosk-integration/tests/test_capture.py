@@ -0,0 +1,120 @@
+import socket
+import time
+
+import pytest
+
+import kiosk
+import replay_capture
+from conftest import signed_frame
+from kiosk_codec import JSON_CODEC
+from kiosk_journal import TrafficCapture
+from kiosk_prefork import SocketHandoff
+from kiosk_transport import PosConnection
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def records(directory, kind=None):
+    return [record for record in TrafficCapture.read(str(directory)) if kind is None or record.kind == kind]
+
+
+def test_connection_numbers_are_not_reused_by_a_later_run(tmp_path):
+    first = TrafficCapture(str(tmp_path))
+    first.open()
+    crashed = PosConnection(object(), "10.0.0.1:5000")
+    first.opened(crashed)
+    crashed.terminal_id = "POS-1"
+    first.identified(crashed)
+    # The process dies: the connection never gets a close record
+    first.close()
+
+    second = TrafficCapture(str(tmp_path))
+    second.open()
+    later = PosConnection(object(), "10.0.0.2:5000")
+    second.opened(later)
+    later.terminal_id = "POS-2"
+    second.identified(later)
+    second.close()
+
+    assert crashed.capture_id != later.capture_id
+    identified = {record.connection: TrafficCapture.decode(record)["terminal_id"]
+                  for record in records(tmp_path, TrafficCapture.IDENTIFY)}
+    assert identified == {crashed.capture_id: "POS-1", later.capture_id: "POS-2"}
+
+
+def test_segments_repeat_open_connections_but_read_returns_them_once(tmp_path):
+    capture = TrafficCapture(str(tmp_path), segment_bytes=256)
+    capture.open()
+    connection = PosConnection(object(), "10.0.0.1:5000")
+    capture.opened(connection)
+    for n in range(20):
+        capture.inbound(connection, [JSON_CODEC.encode({"n": n})[:-1]], JSON_CODEC)
+        time.sleep(0.002)
+    capture.close()
+
+    assert len([name for name in tmp_path.iterdir()]) > 1
+    assert len(records(tmp_path, TrafficCapture.OPEN)) == 1
+    assert [TrafficCapture.decode(record)["n"] for record in records(tmp_path, TrafficCapture.INBOUND)] \
+        == list(range(20))
+
+
+def test_handed_off_connection_is_closed_in_the_capture(tmp_path):
+    path = str(tmp_path / "handoff.sock")
+    directory = tmp_path / "capture"
+    old = kiosk.TcpSender(host="127.0.0.1", port=0, handoff=SocketHandoff(path),
+                          capture=TrafficCapture(str(directory)))
+    new = kiosk.TcpSender(host="127.0.0.1", port=0, handoff=SocketHandoff(path),
+                          capture=TrafficCapture(str(directory)))
+    assert old.start_server()
+    pos = socket.create_connection(old.server_socket.getsockname())
+    try:
+        pos.sendall(signed_frame({"type": "hello", "terminal_id": "POS-1"}))
+        assert wait_for(lambda: old.router.get("POS-1") is not None)
+        assert new.start_server()
+        assert old.handed_off.wait(5)
+    finally:
+        pos.close()
+        new.stop_server()
+        old.stop_server()
+
+    opened = records(directory, TrafficCapture.OPEN)
+    closed = {record.connection: TrafficCapture.decode(record) for record in records(directory, TrafficCapture.CLOSE)}
+    assert len(opened) == 2 and opened[0].connection != opened[1].connection
+    assert closed[opened[0].connection] == {"handed_off": True}
+    identified = [(record.connection, TrafficCapture.decode(record)["terminal_id"])
+                  for record in records(directory, TrafficCapture.IDENTIFY)]
+    assert (opened[1].connection, "POS-1") in identified
+
+
+@pytest.mark.parametrize("engine", ["thread", "asyncio"])
+def test_replay_reproduces_a_captured_payment(tmp_path, engine):
+    sender = kiosk.TcpSender(host="127.0.0.1", port=free_port(), heartbeat_interval=0,
+                             capture=TrafficCapture(str(tmp_path)))
+    assert sender.start_server()
+    pos = socket.create_connection(("127.0.0.1", sender.port))
+    try:
+        pos.sendall(signed_frame({"type": "hello", "terminal_id": "POS-1"}))
+        assert wait_for(lambda: sender.router.get("POS-1") is not None)
+        handle = sender.pay("card", 12.5)
+        pos.sendall(signed_frame({"type": "ack", "txn_id": handle.txn_id, "status": "processing"}))
+        pos.sendall(signed_frame({"type": "transaction_result", "txn_id": handle.txn_id, "status": "success"}))
+        assert handle.result(5).succeeded
+    finally:
+        pos.close()
+        sender.stop_server()
+
+    report = replay_capture.replay([str(tmp_path)], engine, free_port(), 0.0, 5.0)
+    assert report["payments"] == 1 and report["inbound"] == 3
+    assert report["mismatches"] == [] and report["unfinished"] == 0
+    assert report["validation_failures"] == 0
@@ -0,0 +1,117 @@
+import struct
+
+import pytest
+
+from conftest import add_terminal, sent_payloads, signed_frame
+from kiosk_codec import CODECS, JSON_CODEC, LengthPrefixedFramer, MessageFramer, negotiate_codec
+
+
+def prefixed(body):
+    return struct.pack(">I", len(body)) + body
+
+
+def test_newline_framer_splits_frames_across_reads():
+    framer = MessageFramer()
+    assert framer.feed(b'{"a":1}\n{"b"') == [b'{"a":1}']
+    assert framer.pending == 4
+    assert framer.feed(b':2}\r\n\n{"c":3}\n') == [b'{"b":2}', b'{"c":3}']
+    assert framer.pending == 0
+
+
+def test_newline_framer_drops_oversized_frame_and_resyncs():
+    framer = MessageFramer(max_frame_size=8)
+    assert framer.feed(b"0123456789") == []
+    assert framer.dropped_frames == 1
+    # The tail of the dropped frame is skipped up to its delimiter
+    assert framer.feed(b"abc\nok\n") == [b"ok"]
+    assert framer.dropped_frames == 1
+    assert framer.feed(b"0123456789abc\nfine\n") == [b"fine"]
+    assert framer.dropped_frames == 2
+
+
+def test_newline_framer_partial_carries_over():
+    framer = MessageFramer()
+    framer.feed(b'{"a":1}\n{"half')
+    assert framer.partial() == b'{"half'
+    other = MessageFramer()
+    other.feed(framer.partial())
+    assert other.feed(b'":2}\n') == [b'{"half":2}']
+
+
+def test_length_prefixed_framer_splits_frames_across_reads():
+    framer = LengthPrefixedFramer()
+    data = prefixed(b"first") + prefixed(b"second")
+    assert framer.feed(data[:3]) == []
+    assert framer.feed(data[3:12]) == [b"first"]
+    assert framer.feed(data[12:]) == [b"second"]
+    assert framer.pending == 0
+
+
+def test_length_prefixed_framer_skips_oversized_frame():
+    framer = LengthPrefixedFramer(max_frame_size=4)
+    big = prefixed(b"x" * 10)
+    assert framer.feed(big[:8]) == []
+    assert framer.dropped_frames == 1
+    assert framer.partial() == b""
+    assert framer.feed(big[8:] + prefixed(b"ok")) == [b"ok"]
+
+
+def test_json_codec_round_trip_and_prefilter():
+    message = {"payload": {"type": "ping"}, "signature": "abc"}
+    frame = JSON_CODEC.encode(message)
+    assert frame.endswith(b"\n")
+    assert JSON_CODEC.decode(frame[:-1]) == message
+    assert JSON_CODEC.plausible(frame[:-1])
+    assert not JSON_CODEC.plausible(b"hello")
+
+
+@pytest.mark.skipif("msgpack" not in CODECS, reason="msgpack is not installed")
+def test_msgpack_codec_round_trip():
+    codec = CODECS["msgpack"]
+    message = {"payload": {"type": "ping", "amount": 12.5}, "signature": "abc"}
+    frames = codec.framer().feed(codec.encode(message))
+    assert [codec.decode(frame) for frame in frames] == [message]
+
+
+def test_negotiate_codec_takes_first_supported():
+    assert negotiate_codec(["cbor", "json"]) is JSON_CODEC
+    assert negotiate_codec("msgpack") is JSON_CODEC
+    assert negotiate_codec(None) is JSON_CODEC
+
+
+def test_hello_without_codecs_gets_no_ack(sender, terminal):
+    assert sent_payloads(terminal) == []
+    assert terminal.codec is JSON_CODEC
+
+
+def test_hello_with_unknown_codecs_is_acked_in_json(sender):
+    connection = sender._register_client(object(), ("127.0.0.1", 40001))
+    sender._handle_data(connection, signed_frame({"type": "hello", "terminal_id": "POS-1", "codecs": ["cbor"]}))
+    assert [(payload["type"], payload["codec"]) for payload in sent_payloads(connection)] == [("hello_ack", "json")]
+    assert connection.codec is JSON_CODEC
+
+
+@pytest.mark.skipif("msgpack" not in CODECS, reason="msgpack is not installed")
+def test_negotiated_codec_is_used_after_hello_ack(sender):
+    codec = CODECS["msgpack"]
+    connection = sender._register_client(object(), ("127.0.0.1", 40001))
+    sender._handle_data(connection, signed_frame({"type": "hello", "terminal_id": "POS-1",
+                                                  "codecs": ["msgpack", "json"]}))
+    # The ack itself still goes out in JSON, which the terminal reads until it arrives
+    [(ack, _)] = connection.outbound.take()
+    ack = JSON_CODEC.decode(ack[:-1])["payload"]
+    assert (ack["type"], ack["codec"]) == ("hello_ack", "msgpack")
+    assert connection.codec is codec
+
+    handle = sender.pay("card", 12.5)
+    assert sent_payloads(connection)[-1]["txn_id"] == handle.txn_id
+    sender._handle_data(connection, signed_frame({"type": "transaction_result", "txn_id": handle.txn_id,
+                                                  "status": "success", "amount": 12.5}, codec))
+    assert handle.result(5).succeeded
+
+
+def test_reconnected_terminal_starts_again_in_json(sender):
+    first = sender._register_client(object(), ("127.0.0.1", 40001))
+    sender._handle_data(first, signed_frame({"type": "hello", "terminal_id": "POS-1", "codecs": list(CODECS)}))
+    second = add_terminal(sender, "POS-1", 40002)
+    assert second.codec is JSON_CODEC
@@ -0,0 +1,173 @@
+import argparse
+import array
+import json
+import os
+import socket
+import time
+import urllib.request
+
+import pytest
+
+import kiosk
+from conftest import signed_frame
+from kiosk_codec import JSON_CODEC
+from kiosk_metrics import MetricsServer
+from kiosk_prefork import SocketHandoff
+from kiosk_security import NonceReplayCache, SecurityHelper
+from kiosk_transactions import TransactionState
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="handoff needs Unix sockets")
+
+
+class ReceivedHandoff:
+    """Stands in for SocketHandoff.take_over() with a snapshot already received"""
+    
+    def __init__(self, channel, snapshot, fds):
+        self.takeover = (channel, snapshot, fds)
+    
+    def take_over(self):
+        return self.takeover
+
+
+def test_send_and_receive_pass_snapshot_and_descriptors():
+    left, right = socket.socketpair(socket.AF_UNIX)
+    read_fd, write_fd = os.pipe()
+    try:
+        SocketHandoff.send(left, {"port": 9999, "nonces": [["n1", 1000]]}, [read_fd])
+        snapshot, fds = SocketHandoff.receive(right)
+        assert snapshot == {"port": 9999, "nonces": [["n1", 1000]]}
+        assert len(fds) == 1 and fds[0] != read_fd
+        # The received descriptor is the same pipe
+        os.write(write_fd, b"x")
+        assert os.read(fds[0], 1) == b"x"
+        os.close(fds[0])
+    finally:
+        for fd in (read_fd, write_fd):
+            os.close(fd)
+        left.close()
+        right.close()
+
+
+def test_receive_closes_descriptors_when_the_channel_drops():
+    left, right = socket.socketpair(socket.AF_UNIX)
+    read_fd, write_fd = os.pipe()
+    try:
+        # Descriptors arrive, then the sender goes away before the snapshot
+        left.sendmsg([b"F"], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [read_fd]))])
+        left.close()
+        with pytest.raises(ConnectionError):
+            SocketHandoff.receive(right)
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+        right.close()
+
+
+def test_snapshot_round_trip_restores_state(sender, terminal):
+    handle = sender.pay("card", 12.5)
+    sender._handle_data(terminal, signed_frame({"type": "ack", "txn_id": handle.txn_id, "status": "processing"}))
+    done = sender.pay("card", 5.0)
+    sender._handle_data(terminal, signed_frame({"type": "transaction_result", "txn_id": done.txn_id, "status": "failed"}))
+    sender.admission.quarantine_host("10.0.0.9", 60)
+    replayed = SecurityHelper.create_secure_message({"type": "ping"})
+    sender._handle_data(terminal, JSON_CODEC.encode(replayed))
+
+    snapshot = sender._handoff_snapshot([terminal])
+    # The snapshot crosses the handoff socket as JSON
+    snapshot = json.loads(json.dumps(snapshot))
+    assert snapshot["connections"][0]["terminal_id"] == "POS-1"
+
+    SecurityHelper._nonce_cache = NonceReplayCache()
+    successor = kiosk.TcpSender(host="127.0.0.1", port=0)
+    listener, connection = socket.socketpair(socket.AF_UNIX)
+    channel, peer = socket.socketpair(socket.AF_UNIX)
+    successor.handoff = ReceivedHandoff(channel, snapshot, [os.dup(listener.fileno()), os.dup(connection.fileno())])
+    try:
+        _, _, sockets = successor._take_over()
+        for sock in sockets:
+            sock.close()
+    finally:
+        for sock in (listener, connection, channel, peer):
+            sock.close()
+
+    assert successor.transactions.get(handle.txn_id).state == TransactionState.ACKED
+    assert successor.transactions.get(done.txn_id).state == TransactionState.FAILED
+    assert successor.transactions.outstanding("POS-1") == 1
+    assert successor.current_txn_id == sender.current_txn_id
+    assert not successor.admission.admit_host("10.0.0.9")
+    # A message the previous process accepted is a replay here too
+    assert not SecurityHelper.validate_secure_message(replayed)["is_valid"]
+
+
+def test_takeover_with_mismatched_port_is_refused(sender, terminal):
+    snapshot = json.loads(json.dumps(sender._handoff_snapshot([])))
+    successor = kiosk.TcpSender(host="127.0.0.1", port=1)
+    listener, other = socket.socketpair(socket.AF_UNIX)
+    channel, peer = socket.socketpair(socket.AF_UNIX)
+    successor.handoff = ReceivedHandoff(channel, snapshot, [os.dup(listener.fileno())])
+    try:
+        with pytest.raises(ValueError):
+            successor._take_over()
+        # The running Kiosk is told to carry on
+        assert json.loads(peer.recv(4096))["ok"] is False
+    finally:
+        for sock in (listener, other, peer):
+            sock.close()
+
+
+def test_takeover_keeps_terminal_and_payment(tmp_path):
+    path = str(tmp_path / "handoff.sock")
+    old = kiosk.TcpSender(host="127.0.0.1", port=0, handoff=SocketHandoff(path))
+    new = kiosk.TcpSender(host="127.0.0.1", port=0, handoff=SocketHandoff(path))
+    assert old.start_server()
+    pos = socket.create_connection(old.server_socket.getsockname())
+    pos.settimeout(5)
+    reader = pos.makefile("rb")
+    try:
+        pos.sendall(signed_frame({"type": "hello", "terminal_id": "POS-1"}))
+        deadline = time.monotonic() + 5
+        while old.router.get("POS-1") is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        handle = old.pay("card", 12.5)
+        assert JSON_CODEC.decode(reader.readline())["payload"]["txn_id"] == handle.txn_id
+
+        assert new.start_server()
+        assert old.handed_off.wait(5)
+        assert new.transactions.get(handle.txn_id).state == TransactionState.REQUESTED
+
+        pos.sendall(signed_frame({"type": "transaction_result", "txn_id": handle.txn_id, "status": "success"}))
+        deadline = time.monotonic() + 5
+        while new.transactions.get(handle.txn_id).state != TransactionState.COMPLETED and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert new.transactions.get(handle.txn_id).state == TransactionState.COMPLETED
+    finally:
+        reader.close()
+        pos.close()
+        new.stop_server()
+        old.stop_server()
+
+
+def test_takeover_passes_on_the_metrics_endpoint(tmp_path):
+    path = str(tmp_path / "handoff.sock")
+    old = kiosk.TcpSender(host="127.0.0.1", port=0, handoff=SocketHandoff(path))
+    new = kiosk.TcpSender(host="127.0.0.1", port=0, handoff=SocketHandoff(path))
+    assert old.start_server()
+    old.metrics_server = MetricsServer(old.render_metrics, "127.0.0.1", 0)
+    old.metrics_server.start()
+    port = old.metrics_server.listener.getsockname()[1]
+    args = argparse.Namespace(metrics_host="127.0.0.1", metrics_port=port)
+    new_metrics = None
+    try:
+        assert new.start_server()
+        assert old.handed_off.wait(5)
+        new_metrics = kiosk.start_metrics_server(new, args)
+        assert new_metrics is not None and new.metrics_socket is None
+        # The previous process lets go of its copy; the port stays open
+        old.metrics_server.stop()
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            assert b'kiosk_handoffs_total{result="completed"}' in response.read()
+    finally:
+        if new_metrics is not None:
+            new_metrics.stop()
+        new.stop_server()
+        old.stop_server()
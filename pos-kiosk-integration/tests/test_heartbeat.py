@@ -0,0 +1,99 @@
+import socket
+
+import pytest
+
+from conftest import add_terminal, sent_payloads, signed_frame
+from kiosk_transport import TimerWheel
+
+
+def test_timer_wheel_returns_items_once_due():
+    wheel = TimerWheel(tick=1.0, slots=8)
+    start = float(wheel._next_tick)
+    wheel.schedule("soon", start + 1.5)
+    wheel.schedule("later", start + 3.0)
+    assert len(wheel) == 2
+    assert wheel.advance(start + 1.0) == []
+    assert wheel.advance(start + 2.0) == ["soon"]
+    assert wheel.advance(start + 2.5) == []
+    assert wheel.advance(start + 3.0) == ["later"]
+    assert len(wheel) == 0
+
+
+def test_timer_wheel_keeps_far_deadlines_in_its_last_slot():
+    wheel = TimerWheel(tick=1.0, slots=8)
+    start = float(wheel._next_tick)
+    wheel.schedule("far", start + 100.0)
+    # Due early, for the owner to check the real deadline and schedule it again
+    assert wheel.advance(start + 7.0) == ["far"]
+
+
+def test_timer_wheel_catches_up_after_a_stall():
+    wheel = TimerWheel(tick=1.0, slots=8)
+    start = float(wheel._next_tick)
+    wheel.schedule("a", start + 2.0)
+    wheel.schedule("b", start + 5.0)
+    assert sorted(wheel.advance(start + 50.0)) == ["a", "b"]
+
+
+@pytest.fixture
+def beating(sender):
+    sender.heartbeat_interval = 30.0
+    sender.idle_timeout = 90.0
+    kiosk_side, terminal_side = socket.socketpair()
+    connection = sender._register_client(kiosk_side, ("127.0.0.1", 40001))
+    sender._handle_data(connection, signed_frame({"type": "hello", "terminal_id": "POS-1"}))
+    yield connection
+    kiosk_side.close()
+    terminal_side.close()
+
+
+def test_idle_connection_is_pinged(sender, beating):
+    sent_payloads(beating)
+    now = beating.last_seen + 30.0
+    due = sender._check_heartbeat(beating, now)
+    assert [payload["type"] for payload in sent_payloads(beating)] == ["ping"]
+    assert beating.last_ping == now and due > now
+    # Not pinged again before the next interval
+    sender._check_heartbeat(beating, now + 1.0)
+    assert sent_payloads(beating) == []
+
+
+def test_terminal_ping_is_answered_with_pong(sender, beating):
+    sent_payloads(beating)
+    sender._handle_data(beating, signed_frame({"type": "ping", "terminal_id": "POS-1"}))
+    assert beating.answers_ping
+    assert [payload["type"] for payload in sent_payloads(beating)] == ["pong"]
+
+
+def test_missed_pong_stops_dispatch_until_the_terminal_is_heard(sender, beating):
+    sender._handle_data(beating, signed_frame({"type": "pong", "terminal_id": "POS-1"}))
+    now = beating.last_seen + 30.0
+    sender._check_heartbeat(beating, now)
+    sender._check_heartbeat(beating, now + sender.PONG_TIMEOUT)
+    assert not beating.responsive
+    assert sender.router.candidates() == []
+
+    sender._handle_data(beating, signed_frame({"type": "pong", "terminal_id": "POS-1"}))
+    assert beating.responsive
+    assert sender.router.candidates() == [beating]
+
+
+def test_silent_connection_is_reaped_only_if_it_answers_pings(sender, beating):
+    quiet = add_terminal(sender, "POS-2", 40002)
+    # POS-2 never sent a ping or pong, so silence is no sign it is gone
+    assert sender._check_heartbeat(quiet, quiet.last_seen + 120.0) is not None
+    assert sender.router.get("POS-2") is quiet
+
+    sender._handle_data(beating, signed_frame({"type": "pong", "terminal_id": "POS-1"}))
+    assert sender._check_heartbeat(beating, beating.last_seen + 90.0) is None
+    assert sender.router.get("POS-1") is None
+    assert beating.client.fileno() == -1
+
+
+def test_reaper_tick_checks_due_connections(sender, beating, monkeypatch):
+    sender._handle_data(beating, signed_frame({"type": "pong", "terminal_id": "POS-1"}))
+    sent_payloads(beating)
+    later = beating.last_seen + 31.0
+    monkeypatch.setattr("kiosk.time.monotonic", lambda: later)
+    sender._reap_tick()
+    assert [payload["type"] for payload in sent_payloads(beating)] == ["ping"]
@@ -0,0 +1,155 @@
+import os
+import time
+
+import pytest
+
+import kiosk
+from kiosk_journal import TransactionJournal
+from kiosk_transactions import TransactionRegistry, TransactionState
+
+
+@pytest.fixture
+def journalled(tmp_path):
+    """A registry whose changes are journalled; the journal is left open, as if the process died"""
+    journal = TransactionJournal(str(tmp_path))
+    assert journal.open() == []
+    registry = TransactionRegistry()
+    registry.add_recorder(journal.record)
+    yield journal, registry
+    journal.close()
+
+
+def recover(directory):
+    """Transactions a restarted Kiosk would reinstate from the journal in directory"""
+    journal = TransactionJournal(str(directory))
+    try:
+        return journal.open()
+    finally:
+        journal.close()
+
+
+def segment_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".mpj"))
+
+
+def test_crash_recovers_unfinished_transactions(tmp_path, journalled):
+    journal, registry = journalled
+    registry.create("T1", "POS-1", "card", 10.0)
+    registry.transition("T1", TransactionState.ACKED)
+    registry.create("T2", "POS-2", "ewallet", 20.0)
+    registry.transition("T2", TransactionState.COMPLETED, {"status": "success"})
+    registry.create("T3", "POS-1", "card", 30.0)
+    registry.transition("T3", TransactionState.CANCELLING)
+    registry.create("T4", "POS-1", "card", 40.0)
+    registry.discard("T4")
+    assert journal.wait(timeout=5)
+
+    recovered = recover(tmp_path)
+    assert [(txn.txn_id, txn.state) for txn in recovered] == [
+        ("T1", TransactionState.ACKED),
+        ("T3", TransactionState.CANCELLING),
+    ]
+    assert recovered[0].terminal == "POS-1" and recovered[0].amount == 10.0
+
+
+def test_torn_tail_record_is_ignored(tmp_path, journalled):
+    journal, registry = journalled
+    registry.create("T1", "POS-1", "card", 10.0)
+    assert journal.wait(timeout=5)
+    registry.transition("T1", TransactionState.ACKED)
+    assert journal.wait(timeout=5)
+
+    # Cut the last record in half, as a crash in the middle of a write would
+    path = os.path.join(str(tmp_path), segment_files(str(tmp_path))[-1])
+    size = os.path.getsize(path)
+    with open(path, "r+b") as f:
+        f.truncate(size - 10)
+
+    recovered = recover(tmp_path)
+    assert [(txn.txn_id, txn.state) for txn in recovered] == [("T1", TransactionState.REQUESTED)]
+
+
+def test_corrupt_record_stops_replay(tmp_path, journalled):
+    journal, registry = journalled
+    registry.create("T1", "POS-1", "card", 10.0)
+    assert journal.wait(timeout=5)
+    registry.transition("T1", TransactionState.FAILED)
+    assert journal.wait(timeout=5)
+
+    path = os.path.join(str(tmp_path), segment_files(str(tmp_path))[-1])
+    with open(path, "r+b") as f:
+        f.seek(-2, os.SEEK_END)
+        f.write(b"!!")
+
+    recovered = recover(tmp_path)
+    assert [txn.txn_id for txn in recovered] == ["T1"]
+
+
+def test_recovered_transactions_survive_a_second_restart(tmp_path, journalled):
+    journal, registry = journalled
+    registry.create("T1", "POS-1", "card", 10.0)
+    assert journal.wait(timeout=5)
+
+    second = TransactionJournal(str(tmp_path), keep_segments=1)
+    assert [txn.txn_id for txn in second.open()] == ["T1"]
+    second.close()
+    # Only the newest segment is kept, and its checkpoint still holds T1
+    assert len(segment_files(str(tmp_path))) == 1
+
+    third = TransactionJournal(str(tmp_path))
+    assert [txn.txn_id for txn in third.open()] == ["T1"]
+    third.close()
+
+
+def test_rotation_keeps_unfinished_transactions(tmp_path):
+    journal = TransactionJournal(str(tmp_path), segment_bytes=512, keep_segments=2)
+    journal.open()
+    registry = TransactionRegistry()
+    registry.add_recorder(journal.record)
+    registry.create("OPEN", "POS-1", "card", 10.0)
+    for n in range(20):
+        registry.create(f"T{n}", "POS-1", "card", 1.0)
+        registry.transition(f"T{n}", TransactionState.COMPLETED)
+        assert journal.wait(timeout=5)
+    journal.close()
+
+    assert len(segment_files(str(tmp_path))) == 2
+    recovered = recover(tmp_path)
+    assert [txn.txn_id for txn in recovered] == ["OPEN"]
+
+
+def test_recorders_see_every_change_in_order():
+    registry = TransactionRegistry()
+    recorded = []
+    registry.add_recorder(lambda txn: recorded.append(txn.state))
+
+    def complete_on_ack(txn):
+        if txn.state == TransactionState.ACKED:
+            registry.transition(txn.txn_id, TransactionState.COMPLETED)
+    # A listener that changes the transaction again runs before later listeners see the first change
+    registry.add_listener(complete_on_ack)
+
+    registry.create("T1", "POS-1", "card", 10.0)
+    registry.transition("T1", TransactionState.ACKED)
+    registry.record_conflict("T1", {"status": "failed"})
+    assert recorded == [TransactionState.REQUESTED, TransactionState.ACKED,
+                        TransactionState.COMPLETED, TransactionState.COMPLETED]
+
+
+def test_recovered_cancel_times_out(tmp_path, journalled):
+    journal, registry = journalled
+    registry.create("TXN1", "POS-1", "card", 10.0)
+    registry.transition("TXN1", TransactionState.CANCELLING)
+    assert journal.wait(timeout=5)
+
+    sender = kiosk.TcpSender(host="127.0.0.1", port=0, journal=TransactionJournal(str(tmp_path)))
+    sender.CANCEL_TIMEOUT = 5.0
+    sender._open_journal()
+    try:
+        assert sender.transactions.get("TXN1").state == TransactionState.CANCELLING
+        now = time.monotonic() + sender.CANCEL_TIMEOUT + sender.wheel.tick
+        for pending in sender.wheel.advance(now):
+            sender._expire_cancel(pending, now)
+        assert sender.transactions.get("TXN1").state == TransactionState.CANCELLED
+    finally:
+        sender._close_journal()
@@ -0,0 +1,122 @@
+import concurrent.futures
+
+import pytest
+
+from conftest import add_terminal, sent_payloads, signed_frame
+from kiosk_transactions import IdempotencyCache, TransactionState
+
+
+def answer(sender, terminal, handle, message_type, status, **fields):
+    sender._handle_data(terminal, signed_frame(dict(fields, type=message_type, txn_id=handle.txn_id, status=status)))
+
+
+def expire(sender, handle):
+    """Run the wheel check for a handle as if its stage deadline had passed"""
+    sender._check_payment_stage(handle, handle.deadline)
+
+
+def test_handle_resolves_with_the_result(sender, terminal):
+    handle = sender.pay("card", 12.5)
+    assert not handle.acked.done()
+    answer(sender, terminal, handle, "ack", "processing")
+    assert handle.acked.result(0) is True and not handle.done()
+    answer(sender, terminal, handle, "transaction_result", "success", authorization_code="A1", card_last4="4242")
+    result = handle.result(0)
+    assert result.succeeded and result.status == "success"
+    assert (result.authorization_code, result.card_last4) == ("A1", "4242")
+
+
+def test_result_without_ack_counts_as_acked(sender, terminal):
+    handle = sender.pay("card", 12.5)
+    answer(sender, terminal, handle, "transaction_result", "failed", message="declined")
+    assert handle.acked.result(0) is True
+    result = handle.result(0)
+    assert result.state == TransactionState.FAILED and result.message == "declined"
+
+
+def test_missing_ack_cancels_and_times_out(sender, terminal):
+    handle = sender.pay("card", 12.5, ack_timeout=2.0)
+    sent_payloads(terminal)
+    sender._check_payment_stage(handle, handle.deadline - 1.0)
+    assert sent_payloads(terminal) == []
+
+    expire(sender, handle)
+    assert handle.timed_out == "ACK"
+    assert sent_payloads(terminal)[-1]["type"] == "cancel_transaction"
+    # The terminal confirms a cancel with an ACK that is not "processing"
+    answer(sender, terminal, handle, "ack", "received")
+    result = handle.result(0)
+    assert result.state == TransactionState.CANCELLED
+    assert (result.status, result.message) == ("timeout", "no ACK in time")
+    with pytest.raises(ConnectionError):
+        handle.acked.result(0)
+
+
+def test_result_timeout_starts_at_the_ack(sender, terminal):
+    handle = sender.pay("card", 12.5, ack_timeout=2.0, result_timeout=60.0)
+    ack_deadline = handle.deadline
+    answer(sender, terminal, handle, "ack", "processing")
+    assert handle.deadline > ack_deadline + 50.0
+    expire(sender, handle)
+    assert handle.timed_out == "result"
+
+
+def test_result_before_the_cancel_confirmation_decides_the_payment(sender, terminal):
+    handle = sender.pay("card", 12.5, ack_timeout=2.0)
+    expire(sender, handle)
+    answer(sender, terminal, handle, "transaction_result", "success")
+    assert handle.result(0).succeeded
+
+
+def test_no_timeout_without_one(sender, terminal):
+    handle = sender.pay("card", 12.5)
+    assert handle.deadline is None
+
+
+def test_stopping_the_server_fails_running_handles(sender, terminal):
+    handle = sender.pay("card", 12.5)
+    sender._abandon_payments()
+    with pytest.raises(ConnectionError):
+        handle.acked.result(0)
+    with pytest.raises((ConnectionError, concurrent.futures.CancelledError)):
+        handle.result(0)
+
+
+def test_idempotency_cache_expires_and_evicts():
+    cache = IdempotencyCache(capacity=2, ttl=10.0)
+    cache.put("a", "A", now=0.0)
+    cache.put("b", "B", now=1.0)
+    assert cache.get("a", now=2.0) == "A"
+    # "b" is now the least recently used
+    cache.put("c", "C", now=3.0)
+    assert (cache.get("b", now=3.0), len(cache)) == (None, 2)
+    assert cache.get("a", now=10.0) is None
+    assert cache.get("c", now=12.0) == "C"
+
+
+def test_retry_with_the_same_key_is_not_sent_again(sender, terminal):
+    handle = sender.pay("card", 12.5, idempotency_key="order-1")
+    sent_payloads(terminal)
+    assert sender.pay("card", 12.5, idempotency_key="order-1") is handle
+    assert sent_payloads(terminal) == []
+    answer(sender, terminal, handle, "transaction_result", "success")
+    # Still the same payment once it has finished
+    assert sender.pay("card", 12.5, idempotency_key="order-1") is handle
+    assert sender.pay("card", 12.5, idempotency_key="order-2") is not handle
+
+
+def test_reused_key_for_another_payment_is_refused(sender, terminal):
+    sender.pay("card", 12.5, idempotency_key="order-1")
+    with pytest.raises(ValueError):
+        sender.pay("card", 13.0, idempotency_key="order-1")
+
+
+def test_request_that_was_never_written_is_sent_again(sender, terminal):
+    handle = sender.pay("card", 12.5, idempotency_key="order-1")
+    # The writer never took the request off the queue before the connection closed
+    terminal.outbound.close()
+    assert handle.sent.exception(0) is not None
+    retry_terminal = add_terminal(sender, "POS-1", 40002)
+    retry = sender.pay("card", 12.5, idempotency_key="order-1")
+    assert retry is not handle
+    assert sent_payloads(retry_terminal)[-1]["txn_id"] == retry.txn_id
@@ -0,0 +1,82 @@
+import time
+
+from conftest import sent_payloads, signed_frame
+from kiosk_transactions import PlanOffer, TransactionState, lowest_fee_plan, plan_by_id
+
+PLANS = [
+    {"planId": "P3", "frequency": "monthly", "totalInstallments": 3,
+     "installmentDetails": [{"installmentFee": 1.0}] * 3},
+    {"planId": "P6", "frequency": "monthly", "totalInstallments": 6,
+     "installmentDetails": [{"installmentFee": 0.25}] * 6},
+]
+
+
+def offer_plans(sender, terminal, amount=120.0):
+    """Start an IPP payment and have the terminal offer PLANS for it"""
+    handle = sender.pay("ipp", amount)
+    sender._handle_data(terminal, signed_frame({"type": "transaction_result", "txn_id": handle.txn_id,
+                                                "status": "ipp_plans", "amount": amount, "plans": PLANS}))
+    return handle
+
+
+def test_policies_pick_a_plan():
+    offer = PlanOffer.from_response({"txn_id": "T1", "amount": 120.0, "plans": PLANS + [{"frequency": "x"}]}, 0.0)
+    assert [plan.plan_id for plan in offer.plans] == ["P3", "P6"]
+    assert lowest_fee_plan(offer) == "P6"
+    assert plan_by_id("P3")(offer) == "P3"
+    assert plan_by_id("P12")(offer) is None
+
+
+def test_policy_selects_right_away(sender, terminal):
+    sender.plan_policy = lowest_fee_plan
+    handle = offer_plans(sender, terminal)
+    assert sent_payloads(terminal)[-1]["plan_id"] == "P6"
+    assert sender.transactions.get(handle.txn_id).state == TransactionState.PLAN_SELECTED
+    assert sender.pending_plan_offers() == []
+
+
+def test_offer_waits_for_select_plan(sender, terminal):
+    offered = []
+    sender.add_plan_listener(offered.append)
+    waiter = sender.plans_for(offer_plans(sender, terminal).txn_id)
+    offer = waiter.result(0)
+    assert offered == [offer]
+    assert sender.pending_plan_offers() == [offer]
+
+    assert sender.select_plan(offer.txn_id, "P12") is None
+    assert sender.select_plan(offer.txn_id, "P3") is not None
+    assert offer.selection.result(0) == "P3"
+    assert sent_payloads(terminal)[-1]["plan_id"] == "P3"
+    # Answered once only
+    assert sender.select_plan(offer.txn_id, "P6") is None
+
+
+def test_declined_plans_cancel_the_payment(sender, terminal):
+    handle = offer_plans(sender, terminal)
+    [offer] = sender.pending_plan_offers()
+    sent_payloads(terminal)
+    assert sender.decline_plans(handle.txn_id) is not None
+    assert offer.selection.result(0) is None
+    assert sent_payloads(terminal)[-1]["type"] == "cancel_transaction"
+    assert sender.transactions.get(handle.txn_id).state == TransactionState.CANCELLING
+    assert sender.pending_plan_offers() == []
+
+
+def test_unanswered_offer_is_cancelled(sender, terminal):
+    handle = offer_plans(sender, terminal)
+    [offer] = sender.pending_plan_offers()
+    sender._expire_plan_offer(offer, offer.deadline - 1.0)
+    assert sender.pending_plan_offers() == [offer]
+    sender._expire_plan_offer(offer, offer.deadline)
+    assert offer.selection.result(0) is None
+    assert sender.transactions.get(handle.txn_id).state == TransactionState.CANCELLING
+
+
+def test_offer_stays_open_when_the_selection_cannot_be_sent(sender, terminal):
+    handle = offer_plans(sender, terminal)
+    sent_payloads(terminal)
+    terminal.outbound.close()
+    assert sender.select_plan(handle.txn_id, "P3") is None
+    [offer] = sender.pending_plan_offers()
+    assert not offer.selection.done() and offer.deadline > time.monotonic()
+    assert sender.transactions.get(handle.txn_id).state == TransactionState.IPP_PLANS
@@ -0,0 +1,99 @@
+import random
+import socket
+import time
+
+import pytest
+
+import kiosk
+from kiosk_codec import CODECS
+from kiosk_transactions import lowest_fee_plan
+from pos_client import Backoff, PaymentHandler, PosClient, SimulatedHandler
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_backoff_grows_to_its_maximum_with_jitter():
+    backoff = Backoff(initial=1.0, maximum=5.0, rng=random.Random(7))
+    ceilings = []
+    for _ in range(5):
+        ceilings.append(backoff.ceiling())
+        assert 0 <= backoff.next_delay() <= ceilings[-1]
+    assert ceilings == [1.0, 2.0, 4.0, 5.0, 5.0]
+    backoff.reset()
+    assert backoff.ceiling() == 1.0
+
+
+def test_unknown_codec_is_refused():
+    with pytest.raises(ValueError):
+        PosClient("127.0.0.1", 1, "POS-1", codec="cbor")
+
+
+@pytest.fixture
+def server():
+    sender = kiosk.TcpSender(host="127.0.0.1", port=free_port(), heartbeat_interval=0)
+    assert sender.start_server()
+    yield sender
+    sender.stop_server()
+
+
+@pytest.fixture
+def client_for(server):
+    clients = []
+
+    def start(handler, **options):
+        client = PosClient("127.0.0.1", server.port, "POS-1", handler, heartbeat_interval=0,
+                           backoff=Backoff(initial=0.05, maximum=0.2), **options)
+        client.start()
+        clients.append(client)
+        assert client.wait_connected(5)
+        assert wait_for(lambda: server.router.get("POS-1") is not None)
+        return client
+
+    yield start
+    for client in clients:
+        client.stop()
+
+
+def test_simulated_terminal_completes_a_card_payment(server, client_for):
+    client_for(SimulatedHandler())
+    result = server.pay("card", 12.5).result(5)
+    assert result.succeeded and result.authorization_code == "AUTH123"
+
+
+def test_simulated_terminal_completes_an_ipp_payment(server, client_for):
+    server.plan_policy = lowest_fee_plan
+    client_for(SimulatedHandler())
+    result = server.pay("ipp", 300.0).result(5)
+    assert result.succeeded and result.plan_id == "IPP_3M"
+    assert [plan.plan_id for plan in result.plans] == ["IPP_3M"]
+
+
+@pytest.mark.skipif("msgpack" not in CODECS, reason="msgpack is not installed")
+def test_client_negotiates_msgpack(server, client_for):
+    client = client_for(SimulatedHandler(outcome="failed"), codec="msgpack")
+    assert wait_for(lambda: server.router.get("POS-1").codec is CODECS["msgpack"])
+    assert wait_for(lambda: client.codec is CODECS["msgpack"])
+    assert server.pay("card", 12.5).result(5).status == "failed"
+
+
+def test_result_sent_while_disconnected_is_delivered_after_reconnecting(server, client_for):
+    client = client_for(PaymentHandler())
+    handle = server.pay("card", 12.5)
+    assert handle.acked.result(5)
+    client.stop()
+    assert wait_for(lambda: server.router.get("POS-1") is None)
+
+    assert not client.send_result(handle.txn_id, "success")
+    client.start()
+    assert handle.result(5).succeeded
@@ -0,0 +1,82 @@
+from conftest import add_terminal, sent_payloads, signed_frame
+from kiosk_transactions import TransactionState
+from kiosk_transport import TerminalRouter
+
+PLANS = [
+    {"planId": "P3", "frequency": "monthly", "totalInstallments": 3,
+     "installmentDetails": [{"installmentFee": 1.0}] * 3},
+    {"planId": "P6", "frequency": "monthly", "totalInstallments": 6,
+     "installmentDetails": [{"installmentFee": 0.5}] * 6},
+]
+
+
+def test_first_policy_tries_terminals_in_connection_order(sender):
+    first = add_terminal(sender, "POS-1", 40001)
+    second = add_terminal(sender, "POS-2", 40002)
+    assert sender.router.candidates() == [first, second]
+    first.responsive = False
+    assert sender.router.candidates() == [second]
+    assert sender.router.candidates("POS-1") == []
+
+
+def test_least_outstanding_policy_prefers_the_idlest_terminal(sender):
+    sender.router.policy = TerminalRouter.LEAST_OUTSTANDING
+    first = add_terminal(sender, "POS-1", 40001)
+    second = add_terminal(sender, "POS-2", 40002)
+    assert sender.pay("card", 1.0).txn_id in [txn.txn_id for txn in sender.transactions.active("POS-1")]
+    assert sender.router.candidates() == [second, first]
+    assert sender.transactions.active("POS-2") == []
+    sender.pay("card", 2.0)
+    assert len(sender.transactions.active("POS-2")) == 1
+
+
+def test_explicit_terminal_gets_the_request(sender):
+    add_terminal(sender, "POS-1", 40001)
+    second = add_terminal(sender, "POS-2", 40002)
+    handle = sender.pay("card", 9.0, terminal_id="POS-2")
+    assert sender.transactions.get(handle.txn_id).terminal == "POS-2"
+    assert sent_payloads(second)[-1]["txn_id"] == handle.txn_id
+    assert sender.pay("card", 9.0, terminal_id="POS-9") is None
+
+
+def test_reconnected_terminal_keeps_its_transactions(sender):
+    old = add_terminal(sender, "POS-1", 40001)
+    handle = sender.pay("card", 9.0)
+    new = add_terminal(sender, "POS-1", 40002)
+    assert sender.router.get("POS-1") is new and old is not new
+    sender.cancel_transaction(handle.txn_id)
+    assert sent_payloads(new)[-1]["type"] == "cancel_transaction"
+
+
+def test_cancel_reaches_an_unresponsive_owner(sender, terminal):
+    other = add_terminal(sender, "POS-2", 40002)
+    handle = sender.pay("card", 12.5, terminal_id="POS-1")
+    sent_payloads(terminal)
+    # A late pong or one rejected frame takes the terminal out of dispatch, not off its transaction
+    terminal.responsive = False
+    assert sender.cancel_transaction(handle.txn_id) is not None
+    assert [payload["type"] for payload in sent_payloads(terminal)] == ["cancel_transaction"]
+    assert sent_payloads(other) == []
+    assert sender.transactions.get(handle.txn_id).state == TransactionState.CANCELLING
+
+
+def test_plan_selection_reaches_an_unresponsive_owner(sender, terminal):
+    handle = sender.pay("ipp", 120.0)
+    sender._handle_data(terminal, signed_frame({"type": "transaction_result", "txn_id": handle.txn_id,
+                                                "status": "ipp_plans", "amount": 120.0, "plans": PLANS}))
+    sent_payloads(terminal)
+    terminal.responsive = False
+    assert sender.select_plan(handle.txn_id, "P6") is not None
+    assert sent_payloads(terminal)[-1]["plan_id"] == "P6"
+    assert sender.transactions.get(handle.txn_id).state == TransactionState.PLAN_SELECTED
+
+
+def test_cancel_is_refused_once_the_owner_is_gone(sender, terminal):
+    other = add_terminal(sender, "POS-2", 40002)
+    handle = sender.pay("card", 12.5, terminal_id="POS-1")
+    sent_payloads(terminal)
+    terminal.outbound.close()
+    assert sender.cancel_transaction(handle.txn_id) is None
+    # Not moved to another terminal, which knows nothing of the payment
+    assert sent_payloads(other) == []
+    assert sender.transactions.get(handle.txn_id).state == TransactionState.REQUESTED
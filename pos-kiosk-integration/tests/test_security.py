@@ -0,0 +1,55 @@
+from kiosk_security import NonceReplayCache, SecurityHelper
+
+
+def test_nonce_cache_rejects_replay_inside_window():
+    cache = NonceReplayCache(window_ms=60000, bucket_ms=5000)
+    assert cache.add("n1", now_ms=1000000)
+    assert not cache.add("n1", now_ms=1000000)
+    # A message may be up to a window old or ahead, so the nonce is kept for two windows
+    assert not cache.add("n1", now_ms=1000000 + 2 * 60000 - 5000)
+    assert len(cache) == 1
+
+
+def test_nonce_cache_forgets_nonces_past_retention():
+    cache = NonceReplayCache(window_ms=60000, bucket_ms=5000, shards=1)
+    cache.add("old", now_ms=1000000)
+    cache.add("new", now_ms=1000000 + 100000)
+    assert cache.add("old", now_ms=1000000 + 2 * 60000 + 10000)
+    assert not cache.add("new", now_ms=1000000 + 2 * 60000 + 10000)
+
+
+def test_nonce_cache_clock_stepping_back_keeps_nonce():
+    cache = NonceReplayCache(window_ms=60000, bucket_ms=5000, shards=1)
+    cache.add("a", now_ms=2000000)
+    cache.add("b", now_ms=1990000)
+    assert not cache.add("b", now_ms=2000000)
+
+
+def test_nonce_cache_entries_seed_another_cache():
+    cache = NonceReplayCache(window_ms=60000, bucket_ms=5000)
+    for n in range(50):
+        cache.add(f"n{n}", now_ms=1000000 + n * 1000)
+    entries = cache.entries()
+    assert sorted(nonce for nonce, _ in entries) == sorted(f"n{n}" for n in range(50))
+
+    other = NonceReplayCache(window_ms=60000, bucket_ms=5000)
+    other.load(entries)
+    assert len(other) == 50
+    assert not other.add("n49", now_ms=1060000)
+    assert other.add("n50", now_ms=1060000)
+
+
+def test_secure_message_validates_once():
+    message = SecurityHelper.create_secure_message({"type": "ping"})
+    assert SecurityHelper.validate_secure_message(message)["is_valid"]
+    replayed = SecurityHelper.validate_secure_message(message)
+    assert not replayed["is_valid"]
+    assert "nonce" in replayed["error"].lower()
+
+
+def test_tampered_payload_fails_signature():
+    message = SecurityHelper.create_secure_message({"type": "transaction_result", "status": "failed"})
+    message["payload"]["status"] = "success"
+    result = SecurityHelper.validate_secure_message(message)
+    assert not result["is_valid"]
+    assert "signature" in result["error"].lower()
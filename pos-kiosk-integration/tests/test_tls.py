@@ -0,0 +1,106 @@
+import shutil
+import socket
+import ssl
+import time
+
+import pytest
+
+import kiosk
+import make_test_certs
+from conftest import signed_frame
+from kiosk_codec import JSON_CODEC
+from kiosk_transport import certificate_name, create_tls_context
+
+pytestmark = pytest.mark.skipif(shutil.which("openssl") is None, reason="openssl is not installed")
+
+TERMINAL = "POS-COUNTER-01"
+
+
+@pytest.fixture(scope="module")
+def certs(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("certs")
+    make_test_certs.generate(str(directory), ["localhost", "127.0.0.1"], [TERMINAL])
+    return directory
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def client_context(certs, with_certificate=True):
+    context = ssl.create_default_context(cafile=str(certs / "ca.crt"))
+    if with_certificate:
+        context.load_cert_chain(str(certs / f"{TERMINAL}.crt"), str(certs / f"{TERMINAL}.key"))
+    return context
+
+
+def test_client_certificate_needs_a_ca(certs):
+    with pytest.raises(ValueError):
+        create_tls_context(str(certs / "kiosk.crt"), str(certs / "kiosk.key"), require_client_cert=True)
+    context = create_tls_context(str(certs / "kiosk.crt"), str(certs / "kiosk.key"), str(certs / "ca.crt"))
+    assert context.verify_mode == ssl.CERT_OPTIONAL
+
+
+def test_certificate_name_reads_the_common_name():
+    assert certificate_name({"subject": ((("organizationName", "MobyPay Test"),), (("commonName", "POS-1"),))}) \
+        == "POS-1"
+    assert certificate_name(None) is None
+
+
+@pytest.fixture(params=["thread", "asyncio"])
+def tls_sender(request, certs):
+    engine = kiosk.TcpSender if request.param == "thread" else kiosk.AsyncTcpSender
+    tls = create_tls_context(str(certs / "kiosk.crt"), str(certs / "kiosk.key"), str(certs / "ca.crt"),
+                             require_client_cert=True)
+    sender = engine(host="127.0.0.1", port=free_port(), heartbeat_interval=0, tls=tls)
+    assert sender.start_server()
+    yield sender
+    sender.stop_server()
+
+
+def connect(sender, context):
+    raw = socket.create_connection(("127.0.0.1", sender.port), timeout=5)
+    return context.wrap_socket(raw, server_hostname="127.0.0.1")
+
+
+def test_payment_over_mutual_tls(certs, tls_sender):
+    with connect(tls_sender, client_context(certs)) as pos:
+        pos.sendall(signed_frame({"type": "hello", "terminal_id": TERMINAL}))
+        assert wait_for(lambda: tls_sender.router.get(TERMINAL) is not None)
+        assert tls_sender.router.get(TERMINAL).peer_name == TERMINAL
+
+        handle = tls_sender.pay("card", 12.5)
+        request = b""
+        while not request.endswith(b"\n"):
+            request += pos.recv(4096)
+        assert JSON_CODEC.decode(request[:-1])["payload"]["txn_id"] == handle.txn_id
+        pos.sendall(signed_frame({"type": "transaction_result", "txn_id": handle.txn_id, "status": "success"}))
+        assert handle.result(5).succeeded
+
+
+def test_hello_must_match_the_client_certificate(certs, tls_sender):
+    with connect(tls_sender, client_context(certs)) as pos:
+        pos.sendall(signed_frame({"type": "hello", "terminal_id": "POS-OTHER"}))
+        # Frames are handled in order, so once the second hello is in the first was refused
+        pos.sendall(signed_frame({"type": "hello", "terminal_id": TERMINAL}))
+        assert wait_for(lambda: tls_sender.router.get(TERMINAL) is not None)
+        assert tls_sender.router.get("POS-OTHER") is None
+
+
+def test_connection_without_a_client_certificate_is_refused(certs, tls_sender):
+    with pytest.raises((ssl.SSLError, OSError)):
+        with connect(tls_sender, client_context(certs, with_certificate=False)) as pos:
+            # TLS 1.3 reports the refusal on the first read, not in the handshake
+            pos.sendall(signed_frame({"type": "hello", "terminal_id": TERMINAL}))
+            if not pos.recv(1):
+                raise ConnectionResetError("closed by the Kiosk")
+    assert tls_sender.router.get(TERMINAL) is None
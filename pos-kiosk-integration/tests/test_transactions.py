@@ -0,0 +1,163 @@
+import time
+
+from conftest import sent_payloads, signed_frame
+from kiosk_metrics import metrics
+from kiosk_transactions import PendingCancel, TransactionRegistry, TransactionState
+
+
+def counter(name, *labels):
+    return metrics.counter_values(name).get(labels, 0)
+
+
+def result_frame(txn_id, status, **extra):
+    return signed_frame(dict({"type": "transaction_result", "txn_id": txn_id, "status": status}, **extra))
+
+
+def test_registry_moves_through_states_and_releases_terminal():
+    registry = TransactionRegistry()
+    seen = []
+    registry.add_listener(lambda txn: seen.append(txn.state))
+    registry.create("T1", "POS-1", "card", 10.0)
+    assert registry.outstanding("POS-1") == 1
+
+    assert registry.transition("T1", TransactionState.ACKED).state == TransactionState.ACKED
+    txn = registry.transition("T1", TransactionState.COMPLETED, {"status": "success"})
+    assert txn.result == {"status": "success"}
+    assert registry.outstanding("POS-1") == 0
+    assert registry.active() == [] and registry.finished() == [txn]
+    assert registry.get("T1") is txn
+    assert seen == [TransactionState.REQUESTED, TransactionState.ACKED, TransactionState.COMPLETED]
+
+
+def test_registry_refuses_moves_out_of_final_or_unexpected_states():
+    registry = TransactionRegistry()
+    registry.create("T1", "POS-1", "card", 10.0)
+    assert registry.transition("T1", TransactionState.CANCELLED, expect=(TransactionState.CANCELLING,)) is None
+    assert registry.get("T1").state == TransactionState.REQUESTED
+
+    registry.transition("T1", TransactionState.FAILED)
+    assert registry.transition("T1", TransactionState.COMPLETED) is None
+    assert registry.transition("unknown", TransactionState.COMPLETED) is None
+    assert registry.get("T1").state == TransactionState.FAILED
+
+
+def test_registry_records_conflicts_only_on_finished_transactions():
+    registry = TransactionRegistry()
+    registry.create("T1", "POS-1", "card", 10.0)
+    assert registry.record_conflict("T1", {"status": "success"}) is None
+    registry.transition("T1", TransactionState.CANCELLED)
+    assert registry.record_conflict("T1", {"status": "success"}).conflicts == [{"status": "success"}]
+
+
+def test_registry_restore_and_discard():
+    registry = TransactionRegistry()
+    txn = registry.create("T1", "POS-1", "card", 10.0)
+    assert not registry.restore(txn)
+    registry.discard("T1")
+    assert txn.discarded and registry.get("T1") is None
+    assert registry.outstanding("POS-1") == 0
+
+    assert registry.restore(txn)
+    assert registry.outstanding("POS-1") == 1
+
+
+def test_registry_evicts_finished_after_retention():
+    registry = TransactionRegistry(retention=0.0)
+    registry.create("T1", "POS-1", "card", 10.0)
+    registry.transition("T1", TransactionState.COMPLETED)
+    registry.create("T2", "POS-1", "card", 10.0)
+    assert registry.get("T1") is None
+
+
+def test_payment_acked_then_completed(sender, terminal):
+    handle = sender.pay("card", 12.5)
+    request = sent_payloads(terminal)[-1]
+    assert request["txn_id"] == handle.txn_id and request["amount"] == 12.5
+
+    sender._handle_data(terminal, signed_frame({"type": "ack", "txn_id": handle.txn_id, "status": "processing"}))
+    assert sender.transactions.get(handle.txn_id).state == TransactionState.ACKED
+    sender._handle_data(terminal, result_frame(handle.txn_id, "success", authorization_code="A1"))
+
+    result = handle.result(0)
+    assert result.succeeded
+    assert result.state == TransactionState.COMPLETED
+    assert sender.transactions.outstanding("POS-1") == 0
+
+
+def test_cancel_confirmed_by_terminal(sender, terminal):
+    handle = sender.pay("card", 12.5)
+    sender._handle_data(terminal, signed_frame({"type": "ack", "txn_id": handle.txn_id, "status": "processing"}))
+    assert sender.cancel_transaction(handle.txn_id) is not None
+    assert sent_payloads(terminal)[-1]["type"] == "cancel_transaction"
+    assert sender.transactions.get(handle.txn_id).state == TransactionState.CANCELLING
+
+    sender._handle_data(terminal, signed_frame({"type": "ack", "txn_id": handle.txn_id, "status": "received"}))
+    assert sender.transactions.get(handle.txn_id).state == TransactionState.CANCELLED
+    assert handle.result(0).state == TransactionState.CANCELLED
+
+
+def test_success_crossing_a_cancel_completes(sender, terminal):
+    handle = sender.pay("card", 12.5)
+    sender.cancel_transaction(handle.txn_id)
+    sender._handle_data(terminal, result_frame(handle.txn_id, "success"))
+    assert handle.result(0).state == TransactionState.COMPLETED
+
+    # The cancel confirmation that follows does not undo the payment
+    sender._handle_data(terminal, signed_frame({"type": "ack", "txn_id": handle.txn_id, "status": "received"}))
+    assert sender.transactions.get(handle.txn_id).state == TransactionState.COMPLETED
+
+
+def test_unconfirmed_cancel_times_out(sender, terminal):
+    handle = sender.pay("card", 12.5)
+    sender.cancel_transaction(handle.txn_id)
+    now = time.monotonic() + sender.CANCEL_TIMEOUT + 1
+    pending = [item for item in sender.wheel.advance(now) if isinstance(item, PendingCancel)]
+    assert [item.txn_id for item in pending] == [handle.txn_id]
+
+    sender._expire_cancel(pending[0], now)
+    txn = sender.transactions.get(handle.txn_id)
+    assert txn.state == TransactionState.CANCELLED
+    assert txn.result["message"] == "cancel not confirmed by the terminal"
+
+
+def test_cancel_expiry_beyond_deadline_is_rescheduled(sender, terminal):
+    handle = sender.pay("card", 12.5)
+    pending = PendingCancel(handle.txn_id, time.monotonic() + 60)
+    sender._expire_cancel(pending, time.monotonic())
+    assert sender.transactions.get(handle.txn_id).state == TransactionState.REQUESTED
+    assert pending in sender.wheel.advance(pending.deadline + 1)
+
+
+def test_duplicate_result_is_ignored_and_counted(sender, terminal):
+    handle = sender.pay("card", 12.5)
+    sender._handle_data(terminal, result_frame(handle.txn_id, "failed"))
+    before = counter("kiosk_duplicate_results_total", "failed")
+
+    sender._handle_data(terminal, result_frame(handle.txn_id, "failed"))
+    txn = sender.transactions.get(handle.txn_id)
+    assert txn.state == TransactionState.FAILED and txn.conflicts == []
+    assert counter("kiosk_duplicate_results_total", "failed") == before + 1
+
+
+def test_late_conflicting_result_is_kept_for_reconciliation(sender, terminal):
+    conflicts = []
+    sender.add_conflict_listener(lambda txn, response: conflicts.append((txn.txn_id, response["status"])))
+    handle = sender.pay("card", 12.5)
+    sender.cancel_transaction(handle.txn_id)
+    now = time.monotonic() + sender.CANCEL_TIMEOUT + 1
+    for item in sender.wheel.advance(now):
+        if isinstance(item, PendingCancel):
+            sender._expire_cancel(item, now)
+    before = counter("kiosk_conflicting_results_total", "cancelled", "completed")
+
+    sender._handle_data(terminal, result_frame(handle.txn_id, "approved"))
+    txn = sender.transactions.get(handle.txn_id)
+    assert txn.state == TransactionState.CANCELLED
+    assert [conflict["status"] for conflict in txn.conflicts] == ["approved"]
+    assert conflicts == [(handle.txn_id, "approved")]
+    assert counter("kiosk_conflicting_results_total", "cancelled", "completed") == before + 1
+
+
+def test_result_for_unknown_transaction_changes_nothing(sender, terminal):
+    sender._handle_data(terminal, result_frame("TXN-UNKNOWN", "success"))
+    assert sender.transactions.get("TXN-UNKNOWN") is None
@@ -0,0 +1,75 @@
+import socket
+import threading
+
+import pytest
+
+from kiosk_transport import OutboundQueue
+
+
+def test_outbound_queue_batches_frames_in_order():
+    queue = OutboundQueue()
+    first, second = queue.put(b"a\n"), queue.put(b"b\n")
+    assert queue.pending_bytes == 4
+    assert [frame for frame, _ in queue.take()] == [b"a\n", b"b\n"]
+    assert queue.pending_bytes == 0
+    assert first.running() and second.running()
+
+
+def test_outbound_queue_refuses_frames_once_full():
+    queue = OutboundQueue(max_bytes=4)
+    # A frame larger than the limit still goes out on its own
+    queue.put(b"12345\n")
+    with pytest.raises(BufferError):
+        queue.put(b"x")
+
+
+def test_outbound_queue_close_fails_queued_frames():
+    queue = OutboundQueue()
+    future = queue.put(b"a\n")
+    queue.close(ConnectionResetError("gone"))
+    assert isinstance(future.exception(0), ConnectionResetError)
+    assert queue.closed
+    with pytest.raises(ConnectionError):
+        queue.put(b"b\n")
+    assert queue.take(timeout=None) == []
+
+
+def test_outbound_queue_wait_outlasts_cancelled_frames():
+    queue = OutboundQueue()
+    queue.put(b"cancelled\n").cancel()
+    taken = []
+    taker = threading.Thread(target=lambda: taken.extend(queue.take(timeout=None)))
+    taker.start()
+    taker.join(0.2)
+    # The cancelled frame alone does not end the wait
+    assert taker.is_alive()
+    queue.put(b"live\n")
+    taker.join(5)
+    assert [frame for frame, _ in taken] == [b"live\n"]
+
+
+def test_outbound_queue_timed_take_of_cancelled_frames_comes_back_empty():
+    queue = OutboundQueue()
+    queue.put(b"cancelled\n").cancel()
+    assert queue.take(timeout=0.05) == []
+    assert queue.take() == []
+
+
+def test_writer_keeps_writing_after_a_cancelled_send(sender):
+    kiosk_side, terminal_side = socket.socketpair()
+    try:
+        connection = sender._register_client(kiosk_side, ("127.0.0.1", 40002))
+        # Cancelled before the writer takes it, so the writer's first batch is empty
+        connection.outbound.put(b"cancelled\n").cancel()
+        sender._start_writer(connection)
+
+        written = connection.outbound.put(b"next\n")
+        assert written.result(5) == 5
+        terminal_side.settimeout(5)
+        assert terminal_side.recv(64) == b"next\n"
+        assert connection.writer.is_alive()
+    finally:
+        connection.outbound.close()
+        connection.writer.join(5)
+        kiosk_side.close()
+        terminal_side.close()